@@ -0,0 +1,259 @@
+"""
+response times of the analysis, plan and task endpoints, called through the fastapi app
+
+    python benchmarks/bench_api.py [--rows 100000] [--labels 20] [--error-rate 0.01] [--plans 200]
+                                   [--tasks 500] [--thread-groups 10] [--samplers 100] [--repeat 5]
+                                   [--work DIR] [--output bench.json] [--compare old.json] [--threshold 0.2]
+
+every run starts from an empty webmeter directory: a plan with a generated plan.jmx, a baseline
+and a candidate task with generated result.jtl files (no dashboard, like a run that skipped it),
+and --plans / --tasks filler rows for the listings. the generated files are kept in --work and
+reused by later runs with the same sizes
+
+the first call of an endpoint is reported as cold, the first analysis call also builds the
+column cache, aggregates and rollups of the task. --output writes the results with the commit
+they were measured on, --compare prints the median change against such a file and exits with
+1 when an endpoint got slower than --threshold. it also exits with 1 when an endpoint answers
+with an error, or with no data where the bench data has some. needs httpx for fastapi's TestClient
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+PLAN = 'bench'
+# cases that must answer with samples, statistics or points, and the key of the response holding them
+EXPECT_DATA = {'plan_all': 'plan_list', 'plan_page': 'plan_list', 'plan_info': 'plan_info', 'task_all': 'data',
+               'base_info': 'data', 'statistics': 'data', 'statistics_window': 'data', 'request_summary': 'data',
+               'request_summary_filtered': 'data', 'request_summary_errors': 'data', 'response_time': 'data',
+               'response_time_label': 'data', 'response_time_window': 'data', 'connect_time': 'data',
+               'latency': 'data', 'task_compare': 'data'}
+
+
+def commit() -> str:
+    try:
+        head = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True,
+                              text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO,
+                               capture_output=True, text=True).stdout.strip()
+        return head + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def link(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def prepare(args, work: str) -> dict:
+    """generated inputs in work, and a fresh webmeter directory in the current one"""
+    from generate import write_jtl, write_jmx
+    inputs = dict()
+    for name, seed in (('baseline', 0), ('candidate', 1)):
+        path = os.path.join(work, 'result-{}-{}-{}-{}.jtl'.format(args.rows, args.labels, args.error_rate, seed))
+        if not os.path.exists(path):
+            print('generate {}'.format(path))
+            write_jtl(path + '.tmp', args.rows, args.labels, args.error_rate, seed=seed, start=1700000000000)
+            os.replace(path + '.tmp', path)
+        inputs[name] = path
+    jmx_path = os.path.join(work, 'plan-{}-{}.jmx'.format(args.thread_groups, args.samplers))
+    if not os.path.exists(jmx_path):
+        write_jmx(jmx_path, args.thread_groups, args.samplers)
+    inputs['jmx'] = jmx_path
+
+    from webmeter.core.sqlhandle import crud, database, models
+    from webmeter.core.task import TaskBase
+    models.Base.metadata.create_all(bind=database.engine)
+    template = os.path.join(REPO, 'webmeter', 'core', 'file', 'template.jmx')
+    stime = datetime.datetime(2024, 1, 1)
+    plans = [PLAN] + ['plan-{}'.format(i) for i in range(args.plans)]
+    for plan in plans:
+        os.makedirs(os.path.join(TaskBase.ROOT_DIR, plan))
+        link(inputs['jmx'] if plan == PLAN else template, os.path.join(TaskBase.ROOT_DIR, plan, 'plan.jmx'))
+        crud.save_plan(plan)
+    tasks = list()
+    for i in range(args.tasks):
+        when = (stime + datetime.timedelta(minutes=i)).strftime('%y-%m-%d %H:%M:%S')
+        tasks.append({'plan': plans[i % len(plans)], 'task': 'filler-{}'.format(i), 'model': 'local',
+                      'status': 'Done', 'threads': 50, 'success_num': 1000, 'fail_num': 10,
+                      'stime': when, 'etime': when, 'exit_code': 0, 'duration': 60.0})
+    for name in ('baseline', 'candidate'):
+        report_dir = os.path.join(TaskBase.ROOT_DIR, PLAN, 'report', name)
+        os.makedirs(report_dir)
+        os.makedirs(os.path.join(TaskBase.ROOT_DIR, PLAN, 'log', name))
+        link(inputs[name], os.path.join(report_dir, 'result.jtl'))
+        # same keys as the filler rows, the rows of one batch are inserted with one statement
+        tasks.append({'plan': PLAN, 'task': name, 'model': 'local', 'status': 'Done', 'threads': 50,
+                      'success_num': 0, 'fail_num': 0, 'stime': stime.strftime('%y-%m-%d %H:%M:%S'),
+                      'etime': stime.strftime('%y-%m-%d %H:%M:%S'), 'exit_code': 0, 'duration': None})
+    database.bulk_insert(models.Task.__table__, tasks)
+    return inputs
+
+
+def cases(args) -> list:
+    """(name, path, body) in call order, body may be a function of the earlier responses"""
+    start = 1700000000000
+    middle = start + args.rows // 2
+    analysis = {'plan': PLAN, 'task': 'candidate'}
+
+    def save(responses):
+        info = responses['plan_info']['plan_info']
+        return dict(info, old_plan_name=PLAN, new_plan_name=PLAN, plan_comment=info.get('comments'))
+
+    return [
+        ('plan_all', '/api/plan/all', {}),
+        ('plan_page', '/api/plan/all', {'page': 2, 'limit': 20}),
+        ('plan_info', '/api/plan/info', {'plan_name': PLAN}),
+        ('plan_save', '/api/plan/save', save),
+        ('task_all', '/api/task/query/all', None),
+        ('task_status', '/api/task/status', analysis),
+        ('base_info', '/api/task/analysis/base_info', analysis),
+        ('statistics', '/api/task/analysis/statistics', analysis),
+        ('statistics_window', '/api/task/analysis/statistics',
+         dict(analysis, start=start, end=middle, labels=['label-0', 'label-1'])),
+        ('request_summary', '/api/task/analysis/request_summary', dict(analysis, page=1, limit=50)),
+        ('request_summary_filtered', '/api/task/analysis/request_summary',
+         dict(analysis, page=2, limit=50, label='label-3', sort='responseTime', order='desc')),
+        ('request_summary_errors', '/api/task/analysis/request_summary', dict(analysis, page=1, limit=50, success=False)),
+        ('response_time', '/api/task/analysis/response_time', dict(analysis, points=1000)),
+        ('response_time_label', '/api/task/analysis/response_time', dict(analysis, points=1000, label='label-0')),
+        ('response_time_window', '/api/task/analysis/response_time', dict(analysis, points=200, start=start, end=middle)),
+        ('connect_time', '/api/task/analysis/connect_time', dict(analysis, points=1000)),
+        ('latency', '/api/task/analysis/latency', dict(analysis, points=1000)),
+        ('task_compare', '/api/task/compare', {'plan': PLAN, 'baseline': 'baseline', 'candidate': 'candidate'})
+    ]
+
+
+def empty(content: dict, key: str) -> bool:
+    data = content.get(key)
+    if isinstance(data, dict) and 'rows' in data:
+        return not data['rows']
+    return not data
+
+
+def measure(client, args) -> dict:
+    results = dict()
+    responses = dict()
+    for name, path, body in cases(args):
+        if callable(body):
+            body = body(responses)
+        timings = list()
+        error = None
+        for _ in range(args.repeat + 1):
+            start = time.perf_counter()
+            response = client.post(path, json=body)
+            timings.append((time.perf_counter() - start) * 1000)
+            content = response.json()
+            if response.status_code != 200 or (isinstance(content, dict) and content.get('status') == 0):
+                error = content.get('msg') if isinstance(content, dict) else response.status_code
+            elif name in EXPECT_DATA and empty(content, EXPECT_DATA[name]):
+                # a broken filter answers fast with nothing, that is no result to time
+                error = 'empty response'
+        responses[name] = content
+        warm = timings[1:] or timings
+        results[name] = {
+            'cold_ms': round(timings[0], 3),
+            'min_ms': round(min(warm), 3),
+            'median_ms': round(statistics.median(warm), 3),
+            'max_ms': round(max(warm), 3),
+            'repeat': len(warm),
+            'error': error
+        }
+        print('{:26} cold={:>10.2f}ms median={:>10.2f}ms min={:>10.2f}ms{}'.format(
+            name, timings[0], results[name]['median_ms'], results[name]['min_ms'],
+            ' ERROR {}'.format(error) if error else ''))
+    return results
+
+
+def compare(current: dict, baseline_path: str, threshold: float) -> int:
+    with open(file=baseline_path, mode='r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    changed = [key for key in ('rows', 'labels', 'plans', 'tasks', 'samplers', 'thread_groups')
+               if baseline['meta'].get(key) != current['meta'].get(key)]
+    if changed:
+        print('warning: {} differ from the baseline'.format(', '.join(changed)))
+    print('\n{} -> {}'.format(baseline['meta'].get('commit'), current['meta'].get('commit')))
+    slower = 0
+    for name, result in current['results'].items():
+        old = baseline['results'].get(name)
+        if not old or not old['median_ms']:
+            continue
+        ratio = result['median_ms'] / old['median_ms']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'SLOWER'
+            slower += 1
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        print('{:26} {:>10.2f}ms -> {:>10.2f}ms  x{:<6.2f} {}'.format(name, old['median_ms'], result['median_ms'],
+                                                                    ratio, flag))
+    return 1 if slower else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--labels', type=int, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--plans', type=int, default=200)
+    parser.add_argument('--tasks', type=int, default=500)
+    parser.add_argument('--thread-groups', type=int, default=10)
+    parser.add_argument('--samplers', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--work', default=os.path.join(tempfile.gettempdir(), 'webmeter-bench'))
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+    sys.path.insert(0, REPO)
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+    os.makedirs(args.work, exist_ok=True)
+    run_dir = tempfile.mkdtemp(dir=args.work, prefix='run-')
+    output = os.path.abspath(args.output) if args.output else None
+    # webmeter keeps its plans and app.db under the working directory it is imported from
+    os.chdir(run_dir)
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level='ERROR')
+    try:
+        prepare(args, args.work)
+        from fastapi.testclient import TestClient
+        from webmeter.web import app
+        # no context manager, the lifespan (scheduler, samplers) is not started
+        client = TestClient(app)
+        current = {
+            'meta': {'commit': commit(), 'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                     'python': platform.python_version(), 'platform': platform.platform(),
+                     'rows': args.rows, 'labels': args.labels, 'error_rate': args.error_rate,
+                     'plans': args.plans, 'tasks': args.tasks, 'thread_groups': args.thread_groups,
+                     'samplers': args.samplers, 'repeat': args.repeat},
+            'results': measure(client, args)
+        }
+    finally:
+        os.chdir(args.work)
+        shutil.rmtree(run_dir, True)
+    if output:
+        with open(file=output, mode='w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+        print('results written to {}'.format(output))
+    failed = [name for name, result in current['results'].items() if result['error']]
+    if failed:
+        print('failed: {}'.format(', '.join(failed)))
+    if args.compare:
+        sys.exit(compare(current, args.compare, args.threshold) or (1 if failed else 0))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
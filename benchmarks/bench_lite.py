@@ -0,0 +1,149 @@
+"""
+throughput of the lite engine against a local keep-alive http server
+
+    python benchmarks/bench_lite.py [--threads 50] [--loops 200] [--delay 0] [--jmeter]
+
+the server runs in a child process and answers every request with a small body after --delay ms,
+the plan is the bundled template pointed at it; --jmeter runs the same plan with the bundled
+jmeter as well when java is installed. result.jtl is read back with webmeter's own reader
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BODY = b'{"status": "ok"}'
+
+
+def serve(port: int, delay: float, ready) -> None:
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = [int(line.split(b':')[1]) for line in head.split(b'\r\n') if line.lower().startswith(b'content-length')]
+                if length:
+                    await reader.readexactly(length[0])
+                if delay:
+                    await asyncio.sleep(delay / 1000)
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s'
+                             % (len(BODY), BODY))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=1024)
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def free_port() -> int:
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def write_plan(path: str, port: int, threads: int, loops: int) -> None:
+    from webmeter.core.utils import Common, JMX
+    shutil.copy(os.path.join(Common.STATICPATH, 'file', 'template.jmx'), path)
+    with JMX.edit(path) as document:
+        document.write_text('stringProp', 'HTTPSampler.domain', '127.0.0.1')
+        document.write_text('stringProp', 'HTTPSampler.port', str(port))
+        document.write_text('stringProp', 'HTTPSampler.path', '/bench')
+        document.write_text('stringProp', 'ThreadGroup.num_threads', str(threads))
+        document.write_text('stringProp', 'ThreadGroup.ramp_time', '0')
+        document.write_text('stringProp', 'LoopController.loops', str(loops))
+
+
+def report(name: str, jtl_path: str, seconds: float, rss: float) -> None:
+    import numpy as np
+    from webmeter.core.task import JTLReader
+    samples = list(JTLReader(jtl_path))
+    elapsed = np.asarray([sample.elapsed for sample in samples])
+    errors = sum(1 for sample in samples if not sample.success)
+    print('{:7} samples={:<7} errors={:<5} seconds={:<7} rps={:<7} p50={}ms p99={}ms memory={}MB'.format(
+        name, len(samples), errors, round(seconds, 2), round(len(samples) / seconds),
+        int(np.percentile(elapsed, 50)) if len(elapsed) else '-', int(np.percentile(elapsed, 99)) if len(elapsed) else '-',
+        round(rss, 1)))
+
+
+def run_lite(jmx_path: str, work: str) -> None:
+    import json
+    import psutil
+    from webmeter.core.task import JTL_FIELDS
+    jtl_path = os.path.join(work, 'lite.jtl')
+    # the same subprocess the server starts for a lite run, it stops early once its stdin is closed
+    command = [sys.executable, '-m', 'webmeter.core.lite', jmx_path, jtl_path, os.path.join(work, 'lite.log'),
+               '--fields', json.dumps(list(JTL_FIELDS))]
+    environ = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    start = time.perf_counter()
+    process = psutil.Popen(command, stdin=subprocess.PIPE, env=environ)
+    peak = 0
+    while process.poll() is None:
+        try:
+            peak = max(peak, process.memory_info().rss)
+        except psutil.Error:
+            pass
+        time.sleep(0.1)
+    report('lite', jtl_path, time.perf_counter() - start, peak / 1024 / 1024)
+
+
+def run_jmeter(jmx_path: str, work: str) -> None:
+    import psutil
+    from webmeter.core.engine import EngineServie
+    from webmeter.core.utils import Common
+    if shutil.which('java') is None:
+        print('jmeter  skipped, no java found')
+        return
+    jtl_path = os.path.join(work, 'jmeter.jtl')
+    command = [EngineServie.JMETER_PATH.get(Common.pc_platform()), '-n', '-t', jmx_path, '-l', jtl_path,
+               '-j', os.path.join(work, 'jmeter.log')]
+    start = time.perf_counter()
+    process = psutil.Popen(command, stdout=subprocess.DEVNULL)
+    peak = 0
+    while process.poll() is None:
+        try:
+            peak = max(peak, sum(p.memory_info().rss for p in [process] + process.children(recursive=True)))
+        except psutil.Error:
+            pass
+        time.sleep(0.1)
+    report('jmeter', jtl_path, time.perf_counter() - start, peak / 1024 / 1024)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=50)
+    parser.add_argument('--loops', type=int, default=200)
+    parser.add_argument('--delay', type=float, default=0, help='server think time in ms')
+    parser.add_argument('--jmeter', action='store_true')
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    work = tempfile.mkdtemp()
+    os.chdir(work)
+    port = free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(port, args.delay, ready), daemon=True)
+    server.start()
+    ready.wait()
+    try:
+        jmx_path = os.path.join(work, 'plan.jmx')
+        write_plan(jmx_path, port, args.threads, args.loops)
+        run_lite(jmx_path, work)
+        if args.jmeter:
+            run_jmeter(jmx_path, work)
+    finally:
+        server.terminate()
+        shutil.rmtree(work, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+write throughput of the task store under concurrent readers
+
+    python benchmarks/bench_sqlite.py [--rows 20000] [--readers 4]
+
+runs against a throwaway app.db in a temporary directory, once with the tuned engine of
+webmeter.core.sqlhandle.database (wal, busy_timeout, pooled) and once with a default mode
+engine like the one used before, writing monitor rows one session per row and in batches
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+def run(engine, rows: int, readers: int, batch: bool) -> dict:
+    from sqlalchemy import insert, select, func
+    from sqlalchemy.orm import sessionmaker
+    from webmeter.core.sqlhandle import models
+    Session = sessionmaker(bind=engine)
+    stop = threading.Event()
+    stats = {'reads': 0, 'read_errors': 0, 'write_errors': 0}
+
+    def read():
+        while not stop.is_set():
+            try:
+                with Session() as session:
+                    session.execute(select(func.count()).select_from(models.Monitor)).scalar()
+                    session.query(models.Task).order_by(models.Task.stime.desc()).limit(50).all()
+                stats['reads'] += 1
+            except Exception:
+                stats['read_errors'] += 1
+
+    threads = [threading.Thread(target=read, daemon=True) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    data = [{'machine': 'bench', 'task': 'bench-{}'.format(i % 10), 'cpu': 1.0, 'memory': 2.0,
+             'network': 3.0, 'disk_read': 0.0, 'disk_write': 0.0, 'timestamp': i, 'ctime': ''} for i in range(rows)]
+    start = time.perf_counter()
+    if batch:
+        with engine.begin() as connection:
+            for i in range(0, rows, 500):
+                connection.execute(insert(models.Monitor.__table__), data[i:i + 500])
+    else:
+        for row in data:
+            try:
+                with Session() as session:
+                    session.add(models.Monitor(**row))
+                    session.commit()
+            except Exception:
+                stats['write_errors'] += 1
+    seconds = time.perf_counter() - start
+    stop.set()
+    for thread in threads:
+        thread.join()
+    stats['rows_per_sec'] = round(rows / seconds)
+    stats['seconds'] = round(seconds, 3)
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--readers', type=int, default=4)
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    os.chdir(tempfile.mkdtemp())
+    from sqlalchemy import create_engine
+    from webmeter.core.sqlhandle import database, models
+    models.Base.metadata.create_all(bind=database.engine)
+    legacy = create_engine('sqlite:///{}/legacy.db'.format(database.SQL_DIR), connect_args={"check_same_thread": False})
+    models.Base.metadata.create_all(bind=legacy)
+    for name, engine in (('default', legacy), ('tuned', database.engine)):
+        for batch in (False, True):
+            rows = args.rows if batch else args.rows // 10
+            stats = run(engine, rows, args.readers, batch)
+            print('{:8} {:7} rows={:<7} {}'.format(name, 'batch' if batch else 'per-row', rows, stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+synthetic inputs for the benchmarks
+
+    python benchmarks/generate.py jtl result.jtl [--rows 1000000] [--labels 20] [--error-rate 0.01] [--rps 1000]
+    python benchmarks/generate.py jmx plan.jmx [--thread-groups 10] [--samplers 100]
+
+result.jtl has jmeter's default csv columns, per label response times are log-normal around
+their own median and labels are picked with zipf-like weights, so a few dominate like in real
+plans. the same seed writes the same file. plan.jmx is the bundled template with its thread
+group and http request repeated
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+from xml.etree import ElementTree
+
+FIELDS = ('timeStamp', 'elapsed', 'label', 'responseCode', 'responseMessage', 'threadName', 'dataType',
+          'success', 'failureMessage', 'bytes', 'sentBytes', 'grpThreads', 'allThreads', 'URL', 'Latency',
+          'IdleTime', 'Connect')
+CHUNK = 200000
+
+
+def write_jtl(path: str, rows: int, labels: int = 20, error_rate: float = 0.01, rps: int = 1000,
+              threads: int = 50, seed: int = 0, start: int = None) -> str:
+    import numpy as np
+    random = np.random.default_rng(seed)
+    start = int(time.time() * 1000) - rows * 1000 // rps if start is None else start
+    names = ['label-{}'.format(i) for i in range(labels)]
+    weights = 1 / np.arange(1, labels + 1)
+    weights /= weights.sum()
+    medians = random.uniform(20, 400, labels)
+    with open(file=path, mode='w', encoding='utf-8', newline='') as f:
+        f.write(','.join(FIELDS) + '\n')
+        for first in range(0, rows, CHUNK):
+            size = min(CHUNK, rows - first)
+            stamp = start + (np.arange(first, first + size) * 1000 // rps)
+            label = random.choice(labels, size, p=weights)
+            elapsed = np.maximum(random.lognormal(np.log(medians[label]), 0.5), 1).astype('int64')
+            connect = random.integers(0, 5, size)
+            latency = np.maximum(elapsed - random.integers(0, 10, size), connect)
+            error = random.random(size) < error_rate
+            received = random.integers(200, 4000, size)
+            thread = random.integers(1, threads + 1, size)
+            lines = list()
+            for s, e, l, fail, b, t, lat, c in zip(stamp.tolist(), elapsed.tolist(), label.tolist(), error.tolist(),
+                                                  received.tolist(), thread.tolist(), latency.tolist(),
+                                                  connect.tolist()):
+                lines.append('{},{},{},{},{},Thread Group 1-{},text,{},{},{},120,{},{},http://bench.local/{},{},0,{}\n'.format(
+                    s, e, names[l], '500' if fail else '200', 'Internal Server Error' if fail else 'OK', t,
+                    'false' if fail else 'true', 'Test failed: code expected to be 200' if fail else '', b,
+                    threads, threads, names[l], lat, c))
+            f.writelines(lines)
+    return path
+
+
+def write_jmx(path: str, thread_groups: int = 10, samplers: int = 100) -> str:
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    from webmeter.core.utils import Common
+    tree = ElementTree.parse(os.path.join(Common.STATICPATH, 'file', 'template.jmx'))
+    plan_tree = tree.getroot().find('hashTree').find('hashTree')
+    group, group_tree = list(plan_tree)
+    sampler, sampler_tree = list(group_tree)
+    for element in (group, group_tree):
+        plan_tree.remove(element)
+    group_tree.remove(sampler)
+    group_tree.remove(sampler_tree)
+    for g in range(thread_groups):
+        new_group = copy.deepcopy(group)
+        new_group.set('testname', 'Thread Group {}'.format(g))
+        new_tree = copy.deepcopy(group_tree)
+        for s in range(samplers):
+            new_sampler = copy.deepcopy(sampler)
+            new_sampler.set('testname', 'label-{}'.format(g * samplers + s))
+            for prop in new_sampler.iter('stringProp'):
+                if prop.get('name') == 'HTTPSampler.domain':
+                    prop.text = 'bench.local'
+                elif prop.get('name') == 'HTTPSampler.path':
+                    prop.text = '/label-{}'.format(g * samplers + s)
+            new_tree.extend([new_sampler, copy.deepcopy(sampler_tree)])
+        plan_tree.extend([new_group, new_tree])
+    tree.write(path, encoding='UTF-8', xml_declaration=True)
+    return path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='kind', required=True)
+    jtl = commands.add_parser('jtl')
+    jtl.add_argument('path')
+    jtl.add_argument('--rows', type=int, default=1000000)
+    jtl.add_argument('--labels', type=int, default=20)
+    jtl.add_argument('--error-rate', type=float, default=0.01)
+    jtl.add_argument('--rps', type=int, default=1000)
+    jtl.add_argument('--seed', type=int, default=0)
+    jmx = commands.add_parser('jmx')
+    jmx.add_argument('path')
+    jmx.add_argument('--thread-groups', type=int, default=10)
+    jmx.add_argument('--samplers', type=int, default=100)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    if args.kind == 'jtl':
+        write_jtl(args.path, args.rows, args.labels, args.error_rate, args.rps, seed=args.seed)
+    else:
+        write_jmx(args.path, args.thread_groups, args.samplers)
+    print('{} {} bytes in {}s'.format(args.path, os.path.getsize(args.path), round(time.perf_counter() - start, 2)))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,8 @@ with open("README.md", "r") as fh:
 
 setuptools.setup(
     install_requires=['fastapi','uvicorn', 'requests', 'loguru', 'fire','pyfiglet','psutil',
-    'pyyaml','python-multipart','sqlalchemy'],
+    'pyyaml','python-multipart','sqlalchemy','numpy'],
+    extras_require={'export': ['pyarrow']},
     version='1.0.15',
     python_requires='>=3.10',
     long_description=long_description,
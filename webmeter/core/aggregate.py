@@ -0,0 +1,378 @@
+import math
+import os
+import threading
+import numpy as np
+from typing import Optional, Union
+from loguru import logger
+from webmeter.core.task import JTLCache, JTLColumns, TaskBase
+from webmeter.core.metrics import ServerMetrics
+
+
+class LatencySketch(object):
+    """
+    log-bucketed latency histogram (HDR style)
+    exact below LINEAR ms and within GAMMA relative error above it, the size is fixed
+    whatever the sample count, and two sketches merge by adding their counts
+    """
+
+    LINEAR = 100
+    GAMMA = 1.01
+    MAX_VALUE = 3600000
+    SIZE = LINEAR + int(math.ceil(math.log(MAX_VALUE / LINEAR) / math.log(GAMMA))) + 1
+
+    def __init__(self, counts: Optional[np.ndarray] = None, total: float = 0,
+                 minimum: Optional[int] = None, maximum: Optional[int] = None):
+        self.counts = np.zeros(self.SIZE, dtype='int64') if counts is None else counts
+        self.total = total
+        self.minimum = minimum
+        self.maximum = maximum
+
+    @classmethod
+    def index(cls, values: np.ndarray) -> np.ndarray:
+        values = np.clip(np.asarray(values, dtype='float64'), 0, cls.MAX_VALUE)
+        index = values.astype('int64')
+        large = values >= cls.LINEAR
+        index[large] = cls.LINEAR + np.floor(
+            np.log(values[large] / cls.LINEAR) / math.log(cls.GAMMA)).astype('int64')
+        return index
+
+    @classmethod
+    def value(cls, index: int) -> float:
+        """representative value of one bin"""
+        if index < cls.LINEAR:
+            return float(index)
+        return cls.LINEAR * cls.GAMMA ** (index - cls.LINEAR) * (1 + cls.GAMMA) / 2
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def add(self, values: np.ndarray) -> 'LatencySketch':
+        values = np.asarray(values)
+        if len(values):
+            self.counts += np.bincount(self.index(values), minlength=self.SIZE)
+            self.total += float(values.sum())
+            self.minimum = int(values.min()) if self.minimum is None else min(self.minimum, int(values.min()))
+            self.maximum = int(values.max()) if self.maximum is None else max(self.maximum, int(values.max()))
+        return self
+
+    def merge(self, other: 'LatencySketch') -> 'LatencySketch':
+        self.counts += other.counts
+        self.total += other.total
+        for attr, pick in (('minimum', min), ('maximum', max)):
+            values = [v for v in (getattr(self, attr), getattr(other, attr)) if v is not None]
+            setattr(self, attr, pick(values) if values else None)
+        return self
+
+    def mean(self) -> Optional[float]:
+        count = self.count
+        return self.total / count if count else None
+
+    def percentile(self, q: float) -> Optional[float]:
+        count = self.count
+        if not count:
+            return None
+        rank = max(int(math.ceil(q / 100 * count)), 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(max(self.value(index), self.minimum), self.maximum)
+
+
+class TaskAggregate(object):
+    """
+    per label and per time bucket aggregates of one task, built in one pass over its
+    column cache and persisted as aggregate.npz beside result.jtl
+    every (bucket, label) cell keeps its counters and the non-empty bins of its sketch,
+    so any window or label set is answered by merging cells
+    """
+
+    FILE = 'aggregate.npz'
+    BUCKET = 10000
+    VERSION = 1
+    CELL_FIELDS = ('cell_bucket', 'cell_label', 'cell_count', 'cell_errors', 'cell_total',
+                   'cell_min', 'cell_max', 'cell_first', 'cell_last', 'cell_bytes', 'cell_sent')
+    BIN_FIELDS = ('bin_cell', 'bin_index', 'bin_count')
+
+    _opened = dict()
+    _locks = dict()  # per result directory, like JTLCache
+
+    def __init__(self, labels: list, arrays: dict):
+        self.labels = list(labels)
+        self.arrays = arrays
+
+    def __getitem__(self, field: str) -> np.ndarray:
+        return self.arrays[field]
+
+    @classmethod
+    def build(cls, columns: JTLColumns) -> 'TaskAggregate':
+        if not len(columns):
+            return cls(list(), {field: np.zeros(0, dtype='int64') for field in cls.CELL_FIELDS + cls.BIN_FIELDS})
+        timestamps = np.asarray(columns['timeStamp'])
+        elapsed = np.asarray(columns['elapsed'], dtype='int64')
+        labels = np.asarray(columns['label'], dtype='int64')
+        buckets = timestamps // cls.BUCKET
+        # one cell per (bucket, label), the cache is time sorted so cells come out in time order
+        cell_keys, cell = np.unique(np.stack([buckets, labels], axis=1), axis=0, return_inverse=True)
+        cell = cell.reshape(-1)
+        size = len(cell_keys)
+
+        def reduce(ufunc, values, initial):
+            result = np.full(size, initial, dtype='int64')
+            ufunc.at(result, cell, values)
+            return result
+
+        arrays = {
+            'cell_bucket': cell_keys[:, 0] * cls.BUCKET,
+            'cell_label': cell_keys[:, 1],
+            'cell_count': np.bincount(cell, minlength=size).astype('int64'),
+            'cell_errors': np.bincount(cell, weights=~np.asarray(columns['success']), minlength=size).astype('int64'),
+            'cell_total': np.bincount(cell, weights=elapsed, minlength=size).astype('int64'),
+            'cell_min': reduce(np.minimum, elapsed, np.iinfo('int64').max),
+            'cell_max': reduce(np.maximum, elapsed, np.iinfo('int64').min),
+            'cell_first': reduce(np.minimum, timestamps, np.iinfo('int64').max),
+            'cell_last': reduce(np.maximum, timestamps + elapsed, np.iinfo('int64').min),
+            'cell_bytes': np.bincount(cell, weights=columns['bytes'], minlength=size).astype('int64'),
+            'cell_sent': np.bincount(cell, weights=columns['sentBytes'], minlength=size).astype('int64')
+        }
+        bin_keys, bin_count = np.unique(cell * LatencySketch.SIZE + LatencySketch.index(elapsed), return_counts=True)
+        arrays['bin_cell'] = bin_keys // LatencySketch.SIZE
+        arrays['bin_index'] = bin_keys % LatencySketch.SIZE
+        arrays['bin_count'] = bin_count.astype('int64')
+        return cls(columns.strings['label'], arrays)
+
+    @classmethod
+    def load(cls, plan: str, task: str) -> 'TaskAggregate':
+        """aggregates of one task, rebuilt when its result.jtl changed"""
+        jtl_path = TaskBase.result_file_path(plan, task)
+        if not os.path.exists(jtl_path):
+            # the raw samples of an old task are pruned, its aggregates are kept
+            aggregate = cls.read(os.path.join(os.path.dirname(jtl_path), cls.FILE))
+            if aggregate is None:
+                logger.warning('No file found')
+                return cls.build(JTLColumns(dict(), dict()))
+            return aggregate
+        with cls._locks.setdefault(os.path.dirname(jtl_path), threading.Lock()), ServerMetrics.phase('read'):
+            stamp = JTLCache.stamp(jtl_path)
+            opened = cls._opened.get(jtl_path)
+            if opened and opened[0] == stamp:
+                ServerMetrics.cache('aggregate', True)
+                return opened[1]
+            aggregate_path = os.path.join(os.path.dirname(jtl_path), cls.FILE)
+            aggregate = cls.read(aggregate_path, stamp)
+            ServerMetrics.cache('aggregate', aggregate is not None)
+            if aggregate is None:
+                logger.info('build task aggregate: {}'.format(jtl_path))
+                aggregate = cls.build(TaskBase.read_result_columns(plan, task))
+                aggregate.save(aggregate_path, stamp)
+            cls._opened[jtl_path] = (stamp, aggregate)
+            return aggregate
+
+    @classmethod
+    def read(cls, aggregate_path: str, stamp: Optional[list] = None) -> Optional['TaskAggregate']:
+        """the persisted aggregates, None when missing or not built from the jtl of stamp"""
+        if not os.path.exists(aggregate_path):
+            return None
+        try:
+            with np.load(aggregate_path) as data:
+                if data['version'] != cls.VERSION or (stamp is not None and data['stamp'].tolist() != stamp):
+                    return None
+                return cls(data['labels'].tolist(), {field: data[field] for field in cls.CELL_FIELDS + cls.BIN_FIELDS})
+        except (OSError, ValueError, KeyError):
+            logger.warning('broken task aggregate: {}'.format(aggregate_path))
+            return None
+
+    @classmethod
+    def restamp(cls, jtl_path: str, stamp: list) -> None:
+        """move the aggregates built for stamp over to jtl_path, which holds the same records"""
+        aggregate_path = os.path.join(os.path.dirname(jtl_path), cls.FILE)
+        with cls._locks.setdefault(os.path.dirname(jtl_path), threading.Lock()):
+            aggregate = cls.read(aggregate_path, stamp)
+            if aggregate is not None:
+                aggregate.save(aggregate_path, JTLCache.stamp(jtl_path))
+            for path in [path for path in list(cls._opened) if os.path.dirname(path) == os.path.dirname(jtl_path)]:
+                cls._opened.pop(path, None)
+
+    def save(self, aggregate_path: str, stamp: list) -> None:
+        temp_path = aggregate_path + '.tmp.npz'
+        np.savez(temp_path, version=self.VERSION, stamp=np.asarray(stamp, dtype='int64'),
+                 labels=np.asarray(self.labels, dtype='str'), **self.arrays)
+        os.replace(temp_path, aggregate_path)
+
+    @classmethod
+    def merge(cls, aggregates: list) -> 'TaskAggregate':
+        """combine several tasks, cells of the same label name are merged on query"""
+        labels = list()
+        arrays = {field: list() for field in cls.CELL_FIELDS + cls.BIN_FIELDS}
+        offset = 0
+        for aggregate in aggregates:
+            for label in aggregate.labels:
+                if label not in labels:
+                    labels.append(label)
+            mapping = np.asarray([labels.index(label) for label in aggregate.labels], dtype='int64')
+            for field in cls.CELL_FIELDS + cls.BIN_FIELDS:
+                values = aggregate[field]
+                if field == 'cell_label' and len(values):
+                    values = mapping[values]
+                elif field == 'bin_cell':
+                    values = values + offset
+                arrays[field].append(values)
+            offset += len(aggregate['cell_count'])
+        return cls(labels, {field: np.concatenate(values) if values else np.zeros(0, dtype='int64')
+                            for field, values in arrays.items()})
+
+    def select(self, label: Union[str, list, None] = None, start: Optional[int] = None,
+               end: Optional[int] = None) -> np.ndarray:
+        """mask of the cells of one label or a list of labels (all when None) whose bucket overlaps [start, end]"""
+        mask = np.ones(len(self['cell_count']), dtype='bool')
+        if label is not None:
+            names = [label] if isinstance(label, str) else label
+            mask &= np.isin(self['cell_label'], [self.labels.index(name) for name in names if name in self.labels])
+        if start is not None:
+            mask &= self['cell_bucket'] + self.BUCKET > int(start)
+        if end is not None:
+            mask &= self['cell_bucket'] <= int(end)
+        return mask
+
+    def sketch(self, label: Union[str, list, None] = None, start: Optional[int] = None,
+               end: Optional[int] = None) -> LatencySketch:
+        mask = self.select(label, start, end)
+        bins = mask[self['bin_cell']]
+        counts = np.bincount(self['bin_index'][bins], weights=self['bin_count'][bins],
+                             minlength=LatencySketch.SIZE).astype('int64')
+        if not mask.any():
+            return LatencySketch(counts)
+        return LatencySketch(counts, float(self['cell_total'][mask].sum()),
+                             int(self['cell_min'][mask].min()), int(self['cell_max'][mask].max()))
+
+    def percentile(self, q: float, label: Union[str, list, None] = None, start: Optional[int] = None,
+                   end: Optional[int] = None) -> Optional[float]:
+        return self.sketch(label, start, end).percentile(q)
+
+    def summary(self, label: Union[str, list, None] = None, start: Optional[int] = None,
+                end: Optional[int] = None) -> dict:
+        """one transaction in the format of jmeter's statistics.json"""
+        mask = self.select(label, start, end)
+        sketch = self.sketch(label, start, end)
+        count = int(self['cell_count'][mask].sum())
+        errors = int(self['cell_errors'][mask].sum())
+        seconds = (int(self['cell_last'][mask].max()) - int(self['cell_first'][mask].min())) / 1000 if count else 0
+        rate = (lambda value: value / seconds) if seconds > 0 else (lambda value: 0.0)
+        return {
+            'transaction': label if isinstance(label, str) else 'Total',
+            'sampleCount': count,
+            'errorCount': errors,
+            'errorPct': round(errors * 100 / count, 2) if count else 0.0,
+            'meanResTime': sketch.mean(),
+            'medianResTime': sketch.percentile(50),
+            'minResTime': sketch.minimum,
+            'maxResTime': sketch.maximum,
+            'pct1ResTime': sketch.percentile(90),
+            'pct2ResTime': sketch.percentile(95),
+            'pct3ResTime': sketch.percentile(99),
+            'throughput': rate(count),
+            'receivedKBytesPerSec': rate(int(self['cell_bytes'][mask].sum()) / 1024),
+            'sentKBytesPerSec': rate(int(self['cell_sent'][mask].sum()) / 1024)
+        }
+
+    def statistics(self, start: Optional[int] = None, end: Optional[int] = None,
+                   labels: Optional[list] = None) -> dict:
+        """statistics.json equivalent for a window and a subset of labels"""
+        result = {'Total': self.summary(labels, start, end)}
+        for label in labels or self.labels:
+            result[label] = self.summary(label, start, end)
+        return result
+
+
+class TaskComparison(object):
+    """
+    per label deltas between a baseline and a candidate task, with two-sided tests computed
+    from the aggregates alone: mann-whitney u on the latency sketches, a two proportion z test
+    on the error rate and a poisson rate z test on the throughput
+    """
+
+    ALPHA = 0.05
+    PERCENTILES = (50, 90, 95, 99)
+
+    @classmethod
+    def p_value(cls, z: float) -> float:
+        return math.erfc(abs(z) / math.sqrt(2))
+
+    @classmethod
+    def latency_test(cls, baseline: LatencySketch, candidate: LatencySketch) -> Optional[float]:
+        """mann-whitney u over the shared bins, ties within a bin get the average rank"""
+        n1, n2 = baseline.count, candidate.count
+        if not n1 or not n2:
+            return None
+        a = baseline.counts.astype('float64')
+        b = candidate.counts.astype('float64')
+        ties = a + b
+        ranks = np.cumsum(ties) - ties + (ties + 1) / 2
+        u = float((b * ranks).sum()) - n2 * (n2 + 1) / 2
+        total = n1 + n2
+        variance = n1 * n2 / 12 * ((total + 1) - float((ties ** 3 - ties).sum()) / (total * (total - 1)))
+        if variance <= 0:
+            return 1.0
+        return cls.p_value((u - n1 * n2 / 2) / math.sqrt(variance))
+
+    @classmethod
+    def error_test(cls, baseline: dict, candidate: dict) -> Optional[float]:
+        n1, n2 = baseline['sampleCount'], candidate['sampleCount']
+        if not n1 or not n2:
+            return None
+        pooled = (baseline['errorCount'] + candidate['errorCount']) / (n1 + n2)
+        variance = pooled * (1 - pooled) * (1 / n1 + 1 / n2)
+        if variance <= 0:
+            return 1.0
+        return cls.p_value((candidate['errorCount'] / n2 - baseline['errorCount'] / n1) / math.sqrt(variance))
+
+    @classmethod
+    def throughput_test(cls, baseline: dict, candidate: dict) -> Optional[float]:
+        r1, r2 = baseline['throughput'], candidate['throughput']
+        if not r1 or not r2:
+            return None
+        # samples / rate is the window length, the variance of a poisson rate is count / seconds^2
+        variance = r1 ** 2 / baseline['sampleCount'] + r2 ** 2 / candidate['sampleCount']
+        return cls.p_value((r2 - r1) / math.sqrt(variance))
+
+    @staticmethod
+    def delta(baseline: Optional[float], candidate: Optional[float]) -> dict:
+        if baseline is None or candidate is None:
+            return {'baseline': baseline, 'candidate': candidate, 'delta': None, 'delta_pct': None}
+        return {'baseline': baseline, 'candidate': candidate, 'delta': candidate - baseline,
+                'delta_pct': round((candidate - baseline) * 100 / baseline, 2) if baseline else None}
+
+    @classmethod
+    def compare_label(cls, baseline: TaskAggregate, candidate: TaskAggregate, label: Union[str, list, None]) -> dict:
+        summaries = baseline.summary(label), candidate.summary(label)
+        sketches = baseline.sketch(label), candidate.sketch(label)
+        result = {
+            'samples': cls.delta(summaries[0]['sampleCount'], summaries[1]['sampleCount']),
+            'throughput': cls.delta(summaries[0]['throughput'], summaries[1]['throughput']),
+            'error_rate': cls.delta(summaries[0]['errorPct'], summaries[1]['errorPct']),
+            'mean': cls.delta(sketches[0].mean(), sketches[1].mean())
+        }
+        for q in cls.PERCENTILES:
+            result['p{}'.format(q)] = cls.delta(sketches[0].percentile(q), sketches[1].percentile(q))
+        tests = {
+            'latency': cls.latency_test(*sketches),
+            'error_rate': cls.error_test(*summaries),
+            'throughput': cls.throughput_test(*summaries)
+        }
+        result['p_values'] = tests
+        worse = {
+            'latency': (result['p50']['delta'] or 0) > 0 or (result['p95']['delta'] or 0) > 0,
+            'error_rate': (result['error_rate']['delta'] or 0) > 0,
+            'throughput': (result['throughput']['delta'] or 0) < 0
+        }
+        result['regressions'] = [name for name, p in tests.items() if p is not None and p < cls.ALPHA and worse[name]]
+        result['regression'] = bool(result['regressions'])
+        return result
+
+    @classmethod
+    def compare(cls, baseline: TaskAggregate, candidate: TaskAggregate, labels: Optional[list] = None) -> dict:
+        """{'Total': ..., label: ...} over the labels of either task, or only the given ones"""
+        if labels is None:
+            labels = baseline.labels + [label for label in candidate.labels if label not in baseline.labels]
+        result = {'Total': cls.compare_label(baseline, candidate, labels)}
+        for label in labels:
+            result[label] = cls.compare_label(baseline, candidate, label)
+        return result
@@ -0,0 +1,155 @@
+import asyncio
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+from typing import Optional
+from loguru import logger
+from webmeter.core.sqlhandle import crud
+from webmeter.core.task import JTLCache, TaskBase
+from webmeter.core.aggregate import TaskAggregate
+from webmeter.core.rollup import TaskRollup
+
+
+class TaskArchive(object):
+    """
+    compress the result.jtl and logs of finished tasks, and after retention_days drop their
+    raw samples, the statistics, aggregates and rollups of a pruned task stay analyzable
+    """
+
+    INTERVAL = 3600.0
+    LEVEL = 6
+    # retention_days 0 keeps the raw samples forever, compress is opt in: gzip has no random access,
+    # every request_summary page of a compressed task decompresses result.jtl up to its rows
+    DEFAULTS = {'compress': 0, 'retention_days': 0}
+    FINISHED = ('Done', 'Error')
+
+    sweeper = None
+    LOCKS = dict()  # per (plan, task), a finishing run and the sweep thread may archive the same task
+
+    @classmethod
+    def config(cls) -> dict:
+        return {key: int(crud.query_value('archive_{}'.format(key), default) or default)
+                for key, default in cls.DEFAULTS.items()}
+
+    @classmethod
+    def set_config(cls, content: dict) -> dict:
+        for key in cls.DEFAULTS:
+            if content.get(key) is not None:
+                value = int(content.get(key))
+                if value < 0:
+                    raise Exception('{} must not be negative'.format(key))
+                crud.save_value('archive_{}'.format(key), str(value))
+        return cls.config()
+
+    @classmethod
+    def compress_file(cls, file_path: str) -> Optional[str]:
+        """
+        gzip file_path beside itself and remove it, readers pick the .gz up through TaskBase.stored_path
+        None when there is nothing left to compress
+        """
+        compressed_path = file_path + TaskBase.COMPRESSED
+        if not os.path.exists(file_path) or os.path.exists(compressed_path):
+            return None
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(compressed_path) + '.', suffix='.tmp',
+                                         dir=os.path.dirname(file_path))
+        try:
+            with os.fdopen(fd, mode='wb') as raw, open(file=file_path, mode='rb') as src, \
+                    gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=cls.LEVEL) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            shutil.copymode(file_path, temp_path)
+            os.replace(temp_path, compressed_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        os.remove(file_path)
+        return compressed_path
+
+    @classmethod
+    def lock(cls, plan: str, task: str) -> threading.Lock:
+        return cls.LOCKS.setdefault((plan, task), threading.Lock())
+
+    @classmethod
+    def compress(cls, plan: str, task: str) -> None:
+        with cls.lock(plan, task):
+            jtl_path = TaskBase.result_file_path(plan, task)
+            if os.path.exists(jtl_path) and not jtl_path.endswith(TaskBase.COMPRESSED):
+                stamp = JTLCache.stamp(jtl_path)
+                compressed_path = cls.compress_file(jtl_path)
+                if compressed_path is not None:
+                    # the column cache and the aggregates hold the same records, keep them
+                    JTLCache.restamp(compressed_path, stamp, TaskBase.cache_path(plan, task))
+                    TaskAggregate.restamp(compressed_path, stamp)
+                    logger.info('compressed {}: {} -> {} bytes'.format(jtl_path, stamp[1],
+                                                                       os.path.getsize(compressed_path)))
+            log_dir = os.path.join(TaskBase.ROOT_DIR, plan, 'log', task)
+            if os.path.isdir(log_dir):
+                for name in os.listdir(log_dir):
+                    if name.endswith('.log'):
+                        cls.compress_file(os.path.join(log_dir, name))
+
+    @classmethod
+    def prune(cls, plan: str, task: str) -> None:
+        """drop the raw samples of a task once its aggregates and rollups are persisted"""
+        with cls.lock(plan, task):
+            jtl_path = TaskBase.result_file_path(plan, task)
+            if not os.path.exists(jtl_path):
+                return
+            TaskAggregate.load(plan, task)
+            TaskRollup.ensure(plan, task)
+            logger.warning('prune raw samples of {}'.format(task))
+            shutil.rmtree(TaskBase.cache_path(plan, task), True)
+            # where the cache of tasks of older versions was built
+            shutil.rmtree(os.path.join(os.path.dirname(jtl_path), JTLCache.CACHE_DIR), True)
+            os.remove(jtl_path)
+
+    @classmethod
+    def archive(cls, plan: str, task: str) -> None:
+        if cls.config().get('compress'):
+            try:
+                cls.compress(plan, task)
+            except Exception as e:
+                logger.exception(e)
+
+    @classmethod
+    def sweep(cls) -> None:
+        """compress what finished and prune what expired"""
+        config = cls.config()
+        expired = datetime.datetime.now() - datetime.timedelta(days=config.get('retention_days'))
+        for task in crud.query_task_all() or []:
+            if task.get('status') not in cls.FINISHED:
+                continue
+            try:
+                if config.get('retention_days') and datetime.datetime.strptime(
+                        task.get('etime'), '%y-%m-%d %H:%M:%S') < expired:
+                    cls.prune(task.get('plan'), task.get('task'))
+                elif config.get('compress'):
+                    cls.compress(task.get('plan'), task.get('task'))
+            except Exception as e:
+                logger.exception(e)
+
+    @classmethod
+    async def loop(cls) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(cls.sweep)
+            except Exception as e:
+                logger.exception(e)
+            await asyncio.sleep(cls.INTERVAL)
+
+    @classmethod
+    def start(cls) -> None:
+        cls.sweeper = asyncio.create_task(cls.loop())
+
+    @classmethod
+    async def shutdown(cls) -> None:
+        if cls.sweeper is not None:
+            cls.sweeper.cancel()
+            try:
+                await cls.sweeper
+            except asyncio.CancelledError:
+                pass
+            cls.sweeper = None
@@ -1,13 +1,45 @@
 import os
+import json
+import math
+import shutil
+import time
+import asyncio
 import datetime
+import psutil
+from concurrent.futures import ProcessPoolExecutor
 from loguru import logger
 from typing import Optional
-from webmeter.core.utils import Common, Platform
+from webmeter.core.utils import Common, Platform, JMX
 from webmeter.core.sqlhandle import crud
 from webmeter.core.task import TaskBase
+from webmeter.core.aggregate import TaskAggregate
+from webmeter.core.rollup import TaskRollup
+from webmeter.core.archive import TaskArchive
+from webmeter.core.lite import LiteEngine
+from webmeter.core.live import LiveMetrics
+from webmeter.core.profile import RunProfile, ResultProfile
+
+class AdoptedProcess(object):
+    """a run left by a previous server process, it is not a child of this one so its exit code is lost"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+
+    async def wait(self) -> int:
+        try:
+            await asyncio.to_thread(psutil.Process(self.pid).wait)
+        except psutil.NoSuchProcess:
+            pass
+        # finish still looks for results before it marks the task Done
+        return 0
 
 class EngineServie(TaskBase):
 
+    WAITERS = set()
+    START_FAILED = -1  # exit_code of a task whose run could not be started
+    REPORT_POOL = None
+    DASHBOARD_LOCKS = dict()
+
     JMETER_DIR = os.path.join(Common.STATICPATH, 'jmeter', 'apache-jmeter-5.6.2')
 
     JMETER_PATH = {
@@ -22,6 +54,23 @@ class EngineServie(TaskBase):
         'linux': os.path.join(JMETER_DIR, 'bin', 'jmeter-server')
     }
 
+    REMOTE_PORT = 1099
+    # evaluated by every jmeter-server of a sharded run for each thread group (bound to group), it is
+    # sent as a -G property so only the __groovy call in the plan has to do without commas
+    SHARD_SCRIPT = ' '.join([
+        "def port = System.getProperty('server_port') ?: props.getProperty('server_port') ?: '1099';",
+        "def local = InetAddress.getLocalHost();",
+        "def names = [System.getProperty('java.rmi.server.hostname'), local.getHostName(),"
+        " local.getCanonicalHostName(), local.getHostAddress()];",
+        "NetworkInterface.getNetworkInterfaces().each { nic ->"
+        " names.addAll(nic.getInetAddresses().findAll { it instanceof Inet4Address }*.getHostAddress()) };",
+        "def prefix = 'webmeter.threads.' + group;",
+        "def key = names.findAll().collect { it + ':' + port }.find { props.getProperty(prefix + '.' + it) != null };",
+        "if (key == null) { log.warn('webmeter: no thread share for ' + names + ' on port ' + port +"
+        " ' in thread group ' + group + ', running an even split'); return props.getProperty(prefix) };",
+        "return props.getProperty(prefix + '.' + key)"
+    ])
+
     @classmethod
     def check_JavaEnvironment(cls):
         result = Common.exec_cmd('java -version')
@@ -78,7 +127,72 @@ class EngineServie(TaskBase):
 
 
     @classmethod
-    def run(cls, content: dict, model='local') -> int:
+    def host_capacity(cls) -> dict:
+        """declared capacity weight per remote host, hosts without one weigh 1"""
+        return json.loads(crud.query_value('host_capacity', '{}') or '{}')
+
+    @classmethod
+    def set_host_capacity(cls, capacity: dict) -> dict:
+        for host, weight in capacity.items():
+            if float(weight) < 0:
+                raise Exception('capacity of {} must not be negative'.format(host))
+        crud.save_value('host_capacity', json.dumps({host: float(weight) for host, weight in capacity.items()}))
+        return cls.host_capacity()
+
+    @classmethod
+    def shard_threads(cls, threads: int, hosts: list, capacity: Optional[dict] = None) -> dict:
+        """split threads across hosts in proportion to their capacity, the largest remainders get the leftovers"""
+        capacity = cls.host_capacity() if capacity is None else capacity
+        weights = [float(capacity.get(host, capacity.get(host.split(':')[0], 1))) for host in hosts]
+        if sum(weights) <= 0:
+            raise Exception('no capacity declared for {}'.format(','.join(hosts)))
+        quotas = [threads * weight / sum(weights) for weight in weights]
+        shares = [int(quota) for quota in quotas]
+        leftovers = sorted(range(len(hosts)), key=lambda i: quotas[i] - shares[i], reverse=True)
+        for i in leftovers[:threads - sum(shares)]:
+            shares[i] += 1
+        return dict(zip(hosts, shares))
+
+    @classmethod
+    def shard_key(cls, host: str) -> str:
+        """host:port of a remote host as given to -R, jmeter connects to 1099 when no port is given"""
+        host = host.strip()
+        return host if ':' in host else '{}:{}'.format(host, cls.REMOTE_PORT)
+
+    @classmethod
+    def shard_plan(cls, jmx_path: str, log_path: str, hosts: list) -> tuple:
+        """
+        copy the plan for a distributed run with every thread group reading its thread count from
+        a -G property named after the server's host:port in the remote host list. a server matches
+        its rmi hostname, host names and interface addresses with its server_port against those
+        names, one that matches none runs an even split of the group and warns in its log
+        returns the plan copy, the threads per host and per thread group, and the -G arguments
+        """
+        assignment = {host: list() for host in hosts}
+        properties = ['-Gwebmeter.shard={}'.format(cls.SHARD_SCRIPT)]
+        document = JMX.parse(jmx_path)
+        for group, element in enumerate(document.find_name('stringProp', 'ThreadGroup.num_threads')):
+            if not (element.text or '').strip().isdigit():
+                logger.warning('thread group {} has no fixed thread count: {}'.format(group, element.text))
+                continue
+            shares = cls.shard_threads(int(element.text), hosts)
+            for host, threads in shares.items():
+                assignment[host].append(threads)
+                properties.append('-Gwebmeter.threads.{}.{}={}'.format(group, cls.shard_key(host), threads))
+            started = len([threads for threads in shares.values() if threads]) or 1
+            properties.append('-Gwebmeter.threads.{}={}'.format(group, math.ceil(int(element.text) / started)))
+            # no commas inside the function, they would split its arguments
+            element.text = "${{__groovy(group = {}; evaluate(props.getProperty('webmeter.shard')))}}".format(group)
+            document.changed = True
+        if not document.changed:
+            return jmx_path, assignment, list()
+        shard_path = os.path.join(log_path, 'plan.jmx')
+        JMX.save(shard_path, document)
+        logger.info('threads per host : {}'.format(assignment))
+        return shard_path, assignment, properties
+
+    @classmethod
+    async def run(cls, content: dict, model='local') -> str:
         """
         execute jmeter command
          -n This specifies JMeter is to run in cli mode
@@ -95,59 +209,244 @@ class EngineServie(TaskBase):
          -P [proxy server port]
         ex1: jmeter -n -t {jmx_path} 
         ex2: jmeter -n -t {jmx_path} -l {jtl_path} -e -o {report_path} -R 192.168.30.132:1099,192.168.30.130:1099
+        the run is queued, RunScheduler starts it once a slot and enough cpu and memory are free
         """
+        if model == 'lite':
+            # refuse plans the lite engine cannot run before they are queued
+            LiteEngine.settings(os.path.join(TaskBase.ROOT_DIR, content.get('plan_name'), 'plan.jmx'))
+        if content.get('results'):
+            # the result profile is kept on the plan for its next runs
+            ResultProfile.set_config(content.get('plan_name'), content.get('results'), model)
+        else:
+            ResultProfile.check_model(ResultProfile.config(content.get('plan_name')), model)
         task_format = '{}-{}'.format(content.get('plan_name'), datetime.datetime.now().strftime('%y%m%d%H%M%S'))
-        report_dir = Common.make_dir(os.path.join(TaskBase.ROOT_DIR, content.get('plan_name'), 'report'))
-        log_dir = Common.make_dir(os.path.join(TaskBase.ROOT_DIR, content.get('plan_name'), 'log'))
-        report_path = Common.make_dir(os.path.join(report_dir, task_format))
-        log_path = Common.make_dir(os.path.join(log_dir, task_format))
         crud.create_task(tasks={
             'plan': content.get('plan_name'),
             'task': task_format,
             'model': model,
-            'threads': int(content.get('threads'))
+            'threads': int(content.get('threads')),
+            'status': 'Queued',
+            'priority': int(content.get('priority') or 0),
+            'content': json.dumps(content)
         })
-        if model == 'local': 
-            #单机模式
-            result = Common.exec_cmd('{jmeter} -n -t {jmx_path} -l {jtl_path} -j {log_path} -e -o {report_path}'.format(
-                jmeter=cls.JMETER_PATH.get(Common.pc_platform()),
-                jmx_path=os.path.join(TaskBase.ROOT_DIR, content.get('plan_name'), 'plan.jmx'),
-                jtl_path=os.path.join(report_path, 'result.jtl'),
-                log_path=os.path.join(log_path, 'result.log'),
-                report_path=report_path,
-            ))
-        else:
+        logger.info('queue task : {}'.format(task_format))
+        RunScheduler.notify()
+        return task_format
+
+    @classmethod
+    async def start(cls, plan: str, task: str, content: dict, model='local') -> None:
+        """start a queued task, a task that fails to start is marked Error so the queue moves on"""
+        try:
+            await cls.launch(plan, task, content, model)
+        except Exception:
+            crud.update_task(tasks={'task': task, 'status': 'Error', 'exit_code': cls.START_FAILED})
+            raise
+
+    @classmethod
+    async def launch(cls, plan: str, task: str, content: dict, model='local') -> None:
+        """start jmeter as a subprocess for a queued task"""
+        report_dir = Common.make_dir(os.path.join(TaskBase.ROOT_DIR, plan, 'report'))
+        log_dir = Common.make_dir(os.path.join(TaskBase.ROOT_DIR, plan, 'log'))
+        report_path = Common.make_dir(os.path.join(report_dir, task))
+        log_path = Common.make_dir(os.path.join(log_dir, task))
+        jmx_path = os.path.join(TaskBase.ROOT_DIR, plan, 'plan.jmx')
+        properties = list()
+        if model == 'remote':
             #分布式模式
             if content.get('hosts') == 'All':
                 remote_hosts = cls.remote_hosts()
             else:
-                remote_hosts = content.get('hosts')   
-            result = Common.exec_cmd('{jmeter} -n -t {jmx_path} -l {jtl_path} -j {log_path} -e -o {report_path} -R {hosts}'.format(
-                jmeter=cls.JMETER_PATH.get(Common.pc_platform()),
-                jmx_path=os.path.join(TaskBase.ROOT_DIR, content.get('plan_name'), 'plan.jmx'),
-                jtl_path=os.path.join(report_path, 'result.jtl'),
-                log_path=os.path.join(log_path, 'result.log'),
-                report_path=report_path,
-                hosts=remote_hosts
-            ))
-        if result == 0:
-            task_result = TaskBase.read_statistics_file(content.get('plan_name'), task_format)
-            if task_result:
-                crud.update_task(tasks={
-                    'task': task_format,
-                    'success_num': task_result['Total']['sampleCount'] -  task_result['Total']['errorCount'] ,
-                    'fail_num': task_result['Total']['errorCount'],
-                    'status': 'Done'
-                })
-            else:
-                crud.update_task(tasks={'task': task_format,'status': 'Error'})
-                logger.error('remote_host connect failed')     
+                remote_hosts = content.get('hosts')
+            if not remote_hosts:
+                raise Exception('no remote hosts to run {} on'.format(task))
+            hosts = [host.strip() for host in remote_hosts.split(',') if host.strip()]
+            jmx_path, assignment, properties = cls.shard_plan(jmx_path, log_path, hosts)
+            if any(assignment.values()):
+                # hosts without a share are not started at all
+                remote_hosts = ','.join([host for host in hosts if sum(assignment.get(host)) > 0])
+            crud.update_task(tasks={'task': task, 'master_host': Common.ip(),
+                                    'slave_host': json.dumps(assignment)})
+        results = ResultProfile.config(plan)
+        command = [cls.JMETER_PATH.get(Common.pc_platform()), '-n', '-t', jmx_path]
+        if results['mode'] != 'aggregate':
+            command.extend(['-l', os.path.join(report_path, 'result.jtl')])
+        command.extend(['-j', os.path.join(log_path, 'result.log')])
+        if content.get('dashboard', True) not in (False, 'false') and results['mode'] != 'aggregate':
+            command.extend(['-e', '-o', report_path])
+        if model == 'remote':
+            command.extend(properties)
+            command.extend(['-R', remote_hosts])
+        warm = model == 'local' and bool(JmeterWorker.config().get('enabled'))
+        if warm:
+            try:
+                command.extend(['-R', await JmeterWorker.ensure()])
+            except Exception as e:
+                logger.warning('warm jmeter-server unavailable, start a new jvm: {}'.format(e))
+                warm = False
+        if model != 'lite':
+            command.extend(ResultProfile.properties(results, remote=model == 'remote' or warm))
+        profile = None
+        environ = None
+        if model == 'local' and not warm:
+            # the samplers run in this jvm, size it for the plan
+            profile = RunProfile.derive(RunProfile.threads(jmx_path))
+            command.extend(profile['properties'])
+            environ = RunProfile.environ(profile, log_path)
+        if model == 'lite':
+            # single sampler plans run in a python subprocess, no dashboard, wait summarizes result.jtl
+            process = await LiteEngine.start(task, jmx_path, os.path.join(report_path, 'result.jtl'),
+                                             os.path.join(log_path, 'result.log'),
+                                             None if results['mode'] == 'aggregate' else ResultProfile.fields(results),
+                                             results['rate'] if results['mode'] == 'sampled' else 1)
         else:
-            logger.error('task is failed')    
+            logger.info('start command : {}'.format(' '.join(command)))
+            process = await asyncio.create_subprocess_exec(*command, env=environ)
+        if warm:
+            JmeterWorker.acquire()
+        # no await below, the waiter cannot record the end of the run before it is marked Running
+        cls.watch(plan, task, process, warm, profile, results)
+        crud.update_task(tasks={'task': task, 'status': 'Running', 'pid': process.pid, 'warm': warm,
+                                'profile': json.dumps(profile) if profile else None,
+                                'results': json.dumps(results),
+                                'stime': datetime.datetime.now().strftime('%y-%m-%d %H:%M:%S')})
+        crud.save_plan(plan)
+
+    @classmethod
+    def watch(cls, plan: str, task: str, process, warm: bool = False, profile: Optional[dict] = None,
+              results: Optional[dict] = None, spawned: Optional[float] = None) -> None:
+        waiter = asyncio.create_task(cls.wait(plan, task, process, warm, profile, results, spawned))
+        # keep a reference, the event loop only holds weak references to tasks
+        cls.WAITERS.add(waiter)
+        waiter.add_done_callback(cls.WAITERS.discard)
+
+    @classmethod
+    async def wait(cls, plan: str, task: str, process: asyncio.subprocess.Process, warm: bool = False,
+                   profile: Optional[dict] = None, results: Optional[dict] = None,
+                   spawned: Optional[float] = None) -> Optional[int]:
+        """wait for jmeter (or a lite run) to exit and record the final task state"""
+        spawned = time.time() if spawned is None else spawned
+        start = time.monotonic() - (time.time() - spawned)
+        result = None
+        duration = None
+        try:
+            result = await process.wait()
+            duration = time.monotonic() - start
+            if result == 0 and not os.path.exists(os.path.join(TaskBase.ROOT_DIR, plan, 'report', task, 'statistics.json')):
+                # no dashboard was generated, summarize result.jtl in a worker process
+                await asyncio.get_running_loop().run_in_executor(cls.report_pool(), TaskReport.summarize,
+                                                                 plan, task, results)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            if warm:
+                JmeterWorker.release()
+            await asyncio.to_thread(cls.finish, plan, task, result, duration or time.monotonic() - start, spawned, profile)
+            # the charts read the rollups from now on
+            LiveMetrics.release(task)
+            RunScheduler.notify()
+        await asyncio.to_thread(TaskArchive.archive, plan, task)
         return result
 
+    @classmethod
+    def report_pool(cls) -> ProcessPoolExecutor:
+        if cls.REPORT_POOL is None:
+            cls.REPORT_POOL = ProcessPoolExecutor(max_workers=1)
+        return cls.REPORT_POOL
+
+    @staticmethod
+    def decompress(src_path: str, dst_path: str) -> str:
+        with Common.open_file(src_path, mode='rb') as src, open(file=dst_path, mode='wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        return dst_path
+
+    @classmethod
+    async def dashboard(cls, plan: str, task: str) -> str:
+        """directory of the html dashboard of a task, generated by jmeter -g the first time it is asked for"""
+        report_path = os.path.join(TaskBase.ROOT_DIR, plan, 'report', task)
+        if os.path.exists(os.path.join(report_path, 'index.html')):
+            return report_path
+        dashboard_path = os.path.join(report_path, 'dashboard')
+        lock = cls.DASHBOARD_LOCKS.setdefault(task, asyncio.Lock())
+        async with lock:
+            if not os.path.exists(os.path.join(dashboard_path, 'index.html')):
+                shutil.rmtree(dashboard_path, True)
+                jtl_path = TaskBase.result_file_path(plan, task)
+                if not os.path.exists(jtl_path):
+                    raise Exception('the raw samples of {} are pruned'.format(task))
+                if jtl_path.endswith(TaskBase.COMPRESSED):
+                    # jmeter reads plain csv only
+                    jtl_path = await asyncio.to_thread(cls.decompress, jtl_path, os.path.join(report_path, 'dashboard.jtl'))
+                command = [cls.JMETER_PATH.get(Common.pc_platform()),
+                           '-g', jtl_path, '-o', dashboard_path,
+                           '-j', os.path.join(TaskBase.ROOT_DIR, plan, 'log', task, 'dashboard.log')]
+                logger.info('start command : {}'.format(' '.join(command)))
+                try:
+                    process = await asyncio.create_subprocess_exec(*command)
+                    if await process.wait() != 0:
+                        raise Exception('generate dashboard failed')
+                finally:
+                    if jtl_path.endswith('dashboard.jtl'):
+                        os.remove(jtl_path)
+        cls.DASHBOARD_LOCKS.pop(task, None)
+        return dashboard_path
+
+    @classmethod
+    def finish(cls, plan: str, task: str, result: Optional[int], duration: float, spawned: Optional[float] = None,
+               profile: Optional[dict] = None) -> None:
+        tasks = {'task': task, 'status': 'Error', 'exit_code': result, 'duration': round(duration, 3)}
+        try:
+            if profile:
+                profile = RunProfile.inspect(profile, os.path.join(TaskBase.ROOT_DIR, plan, 'log', task), duration)
+                tasks['profile'] = json.dumps(profile)
+                tasks['suspect'] = bool(profile.get('suspect'))
+            if result == 0:
+                task_result = TaskBase.read_statistics_file(plan, task)
+                if not task_result:
+                    # no dashboard, fall back to the aggregates computed from result.jtl
+                    total = TaskAggregate.load(plan, task).summary()
+                    task_result = {'Total': total} if total['sampleCount'] else None
+                if task_result:
+                    tasks['success_num'] = task_result['Total']['sampleCount'] - task_result['Total']['errorCount']
+                    tasks['fail_num'] = task_result['Total']['errorCount']
+                    tasks['status'] = 'Done'
+                    TaskRollup.save(plan, task)
+                    columns = TaskBase.read_result_columns(plan, task)
+                    if spawned is not None and len(columns):
+                        # jvm startup and plan loading, what a warm jmeter-server saves
+                        tasks['startup'] = round(int(columns['timeStamp'][0]) / 1000 - spawned, 3)
+                else:
+                    logger.error('remote_host connect failed')
+            else:
+                logger.error('task is failed')
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            crud.update_task(tasks=tasks)
+
+    @classmethod
+    def recover(cls) -> None:
+        """
+        tasks left Running by a previous server process are marked Error when their process is gone,
+        the others are watched until it exits so they are finished and free their slot
+        """
+        for task in crud.query_task_running():
+            if task.get('pid') is None or not psutil.pid_exists(task.get('pid')):
+                logger.warning('task {} is not running anymore'.format(task.get('task')))
+                crud.update_task(tasks={'task': task.get('task'), 'status': 'Error'})
+                continue
+            task = crud.query_task_one(task.get('plan'), task.get('task'))
+            try:
+                spawned = datetime.datetime.strptime(task.get('stime'), '%y-%m-%d %H:%M:%S').timestamp()
+            except (TypeError, ValueError):
+                spawned = None
+            logger.info('task {} is still running, watch pid {}'.format(task.get('task'), task.get('pid')))
+            # a warm run was counted by the previous server's jmeter-server, there is nothing to release
+            cls.watch(task.get('plan'), task.get('task'), AdoptedProcess(task.get('pid')), False,
+                      task.get('profile'), task.get('results'), spawned)
+
     @classmethod
     def stop(cls) -> int:
+        LiteEngine.stop()
         if Common.pc_platform() == Platform.WINDOWS.value:
             result = Common.exec_cmd(os.path.join(cls.JMETER_DIR, 'bin', 'stoptest.cmd'))
         else:    
@@ -156,6 +455,309 @@ class EngineServie(TaskBase):
             logger.error('stop failed')    
         return result
         
+class TaskReport(object):
+    """statistics of a run that skipped jmeter's dashboard"""
+
+    @staticmethod
+    def summarize(plan: str, task: str, results: Optional[dict] = None) -> None:
+        """
+        one pass over result.jtl, builds the column cache and aggregates and writes statistics.json
+        runs that did not keep every sample take their totals from the summariser
+        """
+        mode = (results or ResultProfile.DEFAULTS).get('mode')
+        statistics = None
+        if mode != 'aggregate':
+            statistics = TaskAggregate.load(plan, task).statistics()
+            if not statistics['Total']['sampleCount']:
+                statistics = None
+        if mode in ('sampled', 'aggregate'):
+            summary = ResultProfile.summary(TaskBase.log_file_path(plan, task))
+            if summary:
+                statistics = ResultProfile.statistics(summary, statistics)
+        if statistics:
+            statistics_path = os.path.join(TaskBase.ROOT_DIR, plan, 'report', task, 'statistics.json')
+            Common.write_file_content(statistics_path + '.tmp', json.dumps(statistics, indent=4))
+            os.replace(statistics_path + '.tmp', statistics_path)
+
+class RunScheduler(object):
+    """
+    start queued runs in priority then submission order
+    a run is admitted while fewer than max_running tasks are running and the cpu and memory
+    usage of this machine stay under their limits, the queue lives in the tasks table
+    """
+
+    INTERVAL = 5.0
+    CPU_SAMPLE = 0.5
+    DEFAULTS = {'max_running': 1, 'max_cpu': 80, 'max_memory': 85}
+
+    wakeup = None
+    dispatcher = None
+
+    @classmethod
+    def config(cls) -> dict:
+        return {key: int(crud.query_value('run_{}'.format(key), default) or default)
+                for key, default in cls.DEFAULTS.items()}
+
+    @classmethod
+    def set_config(cls, content: dict) -> dict:
+        for key in cls.DEFAULTS:
+            if content.get(key) is not None:
+                value = int(content.get(key))
+                if value < 1:
+                    raise Exception('{} must be greater than 0'.format(key))
+                crud.save_value('run_{}'.format(key), str(value))
+        cls.notify()
+        return cls.config()
+
+    @classmethod
+    def queue(cls) -> list:
+        return [{key: value for key, value in task.items() if key != 'content'} for task in crud.query_task_queued()]
+
+    @classmethod
+    def cancel(cls, task: str) -> None:
+        if task not in [item.get('task') for item in crud.query_task_queued()]:
+            raise Exception('{} is not queued'.format(task))
+        crud.update_task(tasks={'task': task, 'status': 'Cancelled'})
+
+    @classmethod
+    def reorder(cls, tasks: list) -> list:
+        """move the given queued tasks, in their given order, ahead of the rest of the queue"""
+        queued = crud.query_task_queued()
+        names = [item.get('task') for item in queued]
+        for task in tasks:
+            if task not in names:
+                raise Exception('{} is not queued'.format(task))
+        top = max([item.get('priority') or 0 for item in queued] + [0])
+        for index, task in enumerate(tasks):
+            crud.update_task(tasks={'task': task, 'priority': top + len(tasks) - index})
+        cls.notify()
+        return cls.queue()
+
+    @classmethod
+    def notify(cls) -> None:
+        if cls.dispatcher is None or cls.dispatcher.done():
+            cls.start()
+        cls.wakeup.set()
+
+    @classmethod
+    async def admissible(cls, config: dict) -> bool:
+        if len(crud.query_task_running()) >= config.get('max_running'):
+            return False
+        cpu = await asyncio.to_thread(psutil.cpu_percent, cls.CPU_SAMPLE)
+        memory = psutil.virtual_memory().percent
+        if cpu >= config.get('max_cpu') or memory >= config.get('max_memory'):
+            logger.info('hold queued tasks, cpu {}% memory {}%'.format(cpu, memory))
+            return False
+        return True
+
+    @classmethod
+    async def dispatch(cls) -> None:
+        """start queued tasks while they are admissible"""
+        queued = crud.query_task_queued()
+        while queued and await cls.admissible(cls.config()):
+            task = queued.pop(0)
+            try:
+                await EngineServie.start(task.get('plan'), task.get('task'),
+                                         json.loads(task.get('content') or '{}'), task.get('model'))
+            except Exception as e:
+                logger.exception('task {} failed to start: {}'.format(task.get('task'), e))
+            queued = crud.query_task_queued()
+
+    @classmethod
+    async def loop(cls) -> None:
+        while True:
+            try:
+                await cls.dispatch()
+            except Exception as e:
+                logger.exception(e)
+            try:
+                # resources are polled, new and finished runs wake the loop right away
+                await asyncio.wait_for(cls.wakeup.wait(), cls.INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            cls.wakeup.clear()
+
+    @classmethod
+    def start(cls) -> None:
+        cls.wakeup = asyncio.Event()
+        cls.dispatcher = asyncio.create_task(cls.loop())
+
+    @classmethod
+    async def shutdown(cls) -> None:
+        if cls.dispatcher is not None:
+            cls.dispatcher.cancel()
+            try:
+                await cls.dispatcher
+            except asyncio.CancelledError:
+                pass
+            cls.dispatcher = None
+
+class JmeterWorker(object):
+    """
+    a jmeter-server kept running on this machine, local runs are sent to it with -R so the
+    engine jvm is started and warmed up once, it is restarted when it dies and stopped when idle
+    the jmeter client of every run still starts, the engine side of the run is what is saved
+    """
+
+    INTERVAL = 10.0
+    READY_TIMEOUT = 60.0
+    DEFAULTS = {'enabled': 0, 'port': 1099, 'idle': 600}
+
+    process = None
+    keeper = None
+    lock = None
+    busy = 0
+    last_used = 0.0
+    restarts = 0
+    boot = None
+
+    @classmethod
+    def config(cls) -> dict:
+        return {key: int(crud.query_value('warm_{}'.format(key), default) or default)
+                for key, default in cls.DEFAULTS.items()}
+
+    @classmethod
+    async def set_config(cls, content: dict) -> dict:
+        for key in cls.DEFAULTS:
+            if content.get(key) is not None:
+                value = content.get(key)
+                value = int(Common.MAPPING[value] if value in ('true', 'false') else value)
+                if value < 0 or (key != 'enabled' and value == 0):
+                    raise Exception('{} must be greater than 0'.format(key))
+                crud.save_value('warm_{}'.format(key), str(value))
+        if not cls.config().get('enabled'):
+            await cls.stop()
+        return cls.status()
+
+    @classmethod
+    def address(cls) -> str:
+        return '127.0.0.1:{}'.format(cls.config().get('port'))
+
+    @classmethod
+    def alive(cls) -> bool:
+        return cls.process is not None and cls.process.returncode is None
+
+    @classmethod
+    async def healthy(cls) -> bool:
+        """the process is up and its rmi registry accepts connections"""
+        if not cls.alive():
+            return False
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', cls.config().get('port')), 2)
+            writer.close()
+            return True
+        except (OSError, asyncio.TimeoutError):
+            return False
+
+    @classmethod
+    async def launch(cls) -> None:
+        port = cls.config().get('port')
+        command = [EngineServie.JMETER_SERVER_PATH.get(Common.pc_platform()),
+                   '-Dserver_port={}'.format(port), '-Djava.rmi.server.hostname=127.0.0.1',
+                   '-j', os.path.join(TaskBase.ROOT_DIR, 'jmeter-server.log')]
+        logger.info('start warm jmeter-server : {}'.format(' '.join(command)))
+        start = time.monotonic()
+        cls.process = await asyncio.create_subprocess_exec(*command)
+        while not await cls.healthy():
+            if not cls.alive() or time.monotonic() - start > cls.READY_TIMEOUT:
+                await cls.stop()
+                raise Exception('jmeter-server did not come up on port {}'.format(port))
+            await asyncio.sleep(0.5)
+        cls.boot = round(time.monotonic() - start, 3)
+        cls.last_used = time.monotonic()
+        logger.info('warm jmeter-server ready in {}s'.format(cls.boot))
+
+    @classmethod
+    async def ensure(cls) -> str:
+        """address of a healthy jmeter-server, (re)started when needed"""
+        if cls.lock is None:
+            cls.lock = asyncio.Lock()
+        async with cls.lock:
+            if not await cls.healthy():
+                if cls.process is not None:
+                    logger.warning('warm jmeter-server is down, restart it')
+                    cls.restarts += 1
+                    await cls.stop()
+                await cls.launch()
+        if cls.keeper is None or cls.keeper.done():
+            cls.start()
+        return cls.address()
+
+    @classmethod
+    def acquire(cls) -> None:
+        cls.busy += 1
+        cls.last_used = time.monotonic()
+
+    @classmethod
+    def release(cls) -> None:
+        cls.busy = max(cls.busy - 1, 0)
+        cls.last_used = time.monotonic()
+
+    @classmethod
+    async def stop(cls) -> None:
+        process, cls.process = cls.process, None
+        if process is not None and process.returncode is None:
+            logger.info('stop warm jmeter-server')
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), 10)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+
+    @classmethod
+    async def keep(cls) -> None:
+        """restart the server after a crash while it is in use, stop it after idle seconds without runs"""
+        while True:
+            await asyncio.sleep(cls.INTERVAL)
+            try:
+                config = cls.config()
+                if cls.process is None:
+                    continue
+                if not config.get('enabled'):
+                    await cls.stop()
+                elif cls.busy == 0 and time.monotonic() - cls.last_used > config.get('idle'):
+                    logger.info('warm jmeter-server idle for {}s'.format(config.get('idle')))
+                    await cls.stop()
+                elif not cls.alive():
+                    await cls.ensure()
+            except Exception as e:
+                logger.exception(e)
+
+    @classmethod
+    def status(cls) -> dict:
+        """worker state and the startup time warm runs saved compared to runs on a new jvm"""
+        stats = crud.query_startup_stats() or dict()
+        cold, cold_runs = stats.get(False, (None, 0))
+        warm, warm_runs = stats.get(True, (None, 0))
+        saved = None if cold is None or warm is None else round(cold - warm, 3)
+        return dict(cls.config(), **{
+            'running': cls.alive(),
+            'pid': cls.process.pid if cls.alive() else None,
+            'busy': cls.busy,
+            'restarts': cls.restarts,
+            'boot': cls.boot,
+            'startup': {'cold': None if cold is None else round(cold, 3), 'cold_runs': cold_runs,
+                        'warm': None if warm is None else round(warm, 3), 'warm_runs': warm_runs,
+                        'saved_per_run': saved,
+                        'saved_total': None if saved is None else round(saved * warm_runs, 3)}
+        })
+
+    @classmethod
+    def start(cls) -> None:
+        cls.keeper = asyncio.create_task(cls.keep())
+
+    @classmethod
+    async def shutdown(cls) -> None:
+        if cls.keeper is not None:
+            cls.keeper.cancel()
+            try:
+                await cls.keeper
+            except asyncio.CancelledError:
+                pass
+            cls.keeper = None
+        await cls.stop()
+
 class EngineAPI(object):
     """for python api"""
     # 接口：协议、路由、参数
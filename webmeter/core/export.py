@@ -0,0 +1,184 @@
+import csv
+import io
+import os
+from typing import Iterator, Optional
+from loguru import logger
+from webmeter.core.utils import Common
+from webmeter.core.task import JTL_FIELDS, JTLCache, TaskBase
+
+
+class ExportSink(io.RawIOBase):
+    """write-only file collecting what the writers produce until it is taken"""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = list()
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = list()
+        return data
+
+
+class TaskExport(object):
+    """
+    result.jtl of a task streamed as parquet or an arrow ipc stream, block by block, so the file is
+    never held in memory. columns are typed, timeStamp is a utc timestamp and the repetitive string
+    columns are dictionary encoded. needs pyarrow, installed with the export extra
+    """
+
+    FORMATS = {
+        'parquet': ('application/vnd.apache.parquet', 'parquet'),
+        'arrow': ('application/vnd.apache.arrow.stream', 'arrows')
+    }
+    BLOCK_BYTES = 8 * 1024 * 1024  # of csv parsed at a time
+    ROW_GROUP_ROWS = 256 * 1024
+    COMPRESSION = 'zstd'  # parquet only, an uncompressed ipc stream is read by every arrow library
+    DICTIONARY_FIELDS = ('label', 'responseCode', 'responseMessage', 'threadName', 'dataType', 'URL')
+
+    @classmethod
+    def arrow(cls):
+        try:
+            import pyarrow
+            return pyarrow
+        except ImportError:
+            raise Exception('export needs pyarrow, install it with: pip install webmeter[export]')
+
+    @classmethod
+    def check(cls, plan: str, task: str, format: str) -> str:
+        """result.jtl of the task, raises before anything is streamed"""
+        if format not in cls.FORMATS:
+            raise Exception('format must be one of {}'.format(', '.join(cls.FORMATS)))
+        cls.arrow()
+        jtl_path = TaskBase.result_file_path(plan, task)
+        if not os.path.exists(jtl_path):
+            raise Exception('task {} of plan {} has no result.jtl to export'.format(task, plan))
+        return jtl_path
+
+    @classmethod
+    def filename(cls, task: str, format: str) -> str:
+        return '{}.{}'.format(task, cls.FORMATS[format][1])
+
+    @classmethod
+    def header(cls, jtl_path: str) -> list:
+        with Common.open_file(jtl_path, mode='r') as f:
+            return next(csv.reader([f.readline()]), [])
+
+    @classmethod
+    def types(cls, columns: list) -> tuple:
+        """csv column types and the exported schema"""
+        pa = cls.arrow()
+        read = dict()
+        fields = list()
+        for name in columns:
+            if name in JTLCache.DTYPES:
+                read[name] = {'int64': pa.int64(), 'int32': pa.int32(), 'bool': pa.bool_()}[JTLCache.DTYPES[name]]
+            else:
+                read[name] = pa.string()
+            if name == 'timeStamp':
+                fields.append(pa.field(name, pa.timestamp('ms', tz='UTC')))
+            elif name in cls.DICTIONARY_FIELDS:
+                fields.append(pa.field(name, pa.dictionary(pa.int32(), pa.string())))
+            else:
+                fields.append(pa.field(name, read[name]))
+        return read, pa.schema(fields)
+
+    @classmethod
+    def batches(cls, jtl_path: str, labels: Optional[list] = None, start: Optional[int] = None,
+                end: Optional[int] = None) -> tuple:
+        """(schema, record batches) of the samples of one or more labels within [start, end]"""
+        pa = cls.arrow()
+        from pyarrow import csv as arrow_csv
+        import pyarrow.compute as pc
+        header = cls.header(jtl_path)
+        if 'timeStamp' in header:
+            names = None
+        else:
+            # jtl written without field names, in jmeter's default column order
+            names = header = list(JTL_FIELDS[:len(header)])
+        columns = [name for name in header if name in JTL_FIELDS]
+        read, schema = cls.types(columns)
+        reader = arrow_csv.open_csv(
+            pa.input_stream(jtl_path, compression='detect'),
+            read_options=arrow_csv.ReadOptions(column_names=names, block_size=cls.BLOCK_BYTES),
+            # failure messages may span lines, a short last row is a line jmeter is still writing
+            parse_options=arrow_csv.ParseOptions(newlines_in_values=True, invalid_row_handler=lambda row: 'skip'),
+            convert_options=arrow_csv.ConvertOptions(column_types=read, include_columns=columns,
+                                                     true_values=['true'], false_values=['false']))
+        value_set = pa.array([str(label) for label in labels], pa.string()) if labels else None
+
+        def convert() -> Iterator:
+            for batch in reader:
+                masks = list()
+                if value_set is not None:
+                    masks.append(pc.is_in(batch.column('label'), value_set=value_set))
+                if start is not None:
+                    masks.append(pc.greater_equal(batch.column('timeStamp'), int(start)))
+                if end is not None:
+                    masks.append(pc.less_equal(batch.column('timeStamp'), int(end)))
+                if masks:
+                    mask = masks[0]
+                    for other in masks[1:]:
+                        mask = pc.and_(mask, other)
+                    batch = batch.filter(mask)
+                if not batch.num_rows:
+                    continue
+                arrays = list()
+                for field in schema:
+                    column = batch.column(field.name)
+                    if field.name == 'timeStamp':
+                        column = column.cast(field.type)
+                    elif pa.types.is_dictionary(field.type):
+                        column = pc.dictionary_encode(column)
+                    arrays.append(column)
+                yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+        return schema, convert()
+
+    @classmethod
+    def stream(cls, jtl_path: str, format: str = 'parquet', labels: Optional[list] = None,
+               start: Optional[int] = None, end: Optional[int] = None) -> Iterator[bytes]:
+        """bytes of the export, yielded as every row group (parquet) or batch (arrow) is written"""
+        pa = cls.arrow()
+        import pyarrow.parquet as pq
+        schema, batches = cls.batches(jtl_path, labels, start, end)
+        sink = ExportSink()
+        if format == 'parquet':
+            writer = pq.ParquetWriter(sink, schema, compression=cls.COMPRESSION)
+        else:
+            writer = pa.ipc.new_stream(sink, schema)
+        rows = 0
+        try:
+            pending = list()
+            pending_rows = 0
+            for batch in batches:
+                rows += batch.num_rows
+                if format != 'parquet':
+                    writer.write_batch(batch)
+                    yield sink.take()
+                    continue
+                pending.append(batch)
+                pending_rows += batch.num_rows
+                if pending_rows >= cls.ROW_GROUP_ROWS:
+                    writer.write_table(pa.Table.from_batches(pending, schema), row_group_size=cls.ROW_GROUP_ROWS)
+                    pending, pending_rows = list(), 0
+                    yield sink.take()
+            if pending:
+                writer.write_table(pa.Table.from_batches(pending, schema), row_group_size=cls.ROW_GROUP_ROWS)
+        finally:
+            writer.close()
+        logger.info('exported {} samples of {} as {}'.format(rows, jtl_path, format))
+        yield sink.take()
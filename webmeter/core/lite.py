@@ -0,0 +1,410 @@
+import argparse
+import asyncio
+import csv
+import json
+import os
+import ssl
+import sys
+import threading
+import time
+from contextlib import nullcontext
+from typing import Optional
+from urllib.parse import urlencode, urlsplit
+from loguru import logger
+from webmeter.core.utils import Common, JMX
+from webmeter.core.task import JTL_FIELDS
+
+
+class LiteConnection(object):
+    """one keep-alive http/1.1 connection, a virtual user reuses it for every sample"""
+
+    def __init__(self, host: str, port: int, secure: bool):
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.reader = None
+        self.writer = None
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self, timeout: Optional[float]) -> None:
+        context = ssl.create_default_context() if self.secure else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context), timeout)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def read_body(self, headers: dict, status: int, method: str) -> int:
+        """read the body of a response, returns its size on the wire"""
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            return 0
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            size = 0
+            while True:
+                line = await self.reader.readuntil(b'\r\n')
+                length = int(line.split(b';')[0], 16)
+                size += len(line)
+                if length == 0:
+                    # trailers end with an empty line
+                    while True:
+                        line = await self.reader.readuntil(b'\r\n')
+                        size += len(line)
+                        if line == b'\r\n':
+                            return size
+                await self.reader.readexactly(length + 2)
+                size += length + 2
+        if 'content-length' in headers:
+            length = int(headers['content-length'])
+            await self.reader.readexactly(length)
+            return length
+        # no length, the body ends with the connection
+        body = await self.reader.read()
+        self.close()
+        return len(body)
+
+    async def request(self, method: str, head: bytes, body: bytes, timeout: Optional[float]) -> tuple:
+        """
+        send one request and read its response
+        returns status, reason, received bytes, connect ms, latency ms and keep_alive,
+        latency ends at the first response line and includes connecting, as in jmeter
+        """
+        connect = 0
+        reused = self.connected
+        begin = time.perf_counter()
+        while True:
+            if not self.connected:
+                start = time.perf_counter()
+                await self.connect(timeout)
+                connect = round((time.perf_counter() - start) * 1000)
+            try:
+                self.writer.write(head + body)
+                await self.writer.drain()
+                line = await asyncio.wait_for(self.reader.readuntil(b'\r\n'), timeout)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if not reused:
+                    raise
+                # the server closed the idle connection, retry once on a new one
+                reused = False
+        latency = round((time.perf_counter() - begin) * 1000)
+        raw = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), timeout)
+        version, status, reason = (line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        headers = dict()
+        for header in raw.decode('latin-1').split('\r\n'):
+            if ':' in header:
+                name, value = header.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        received = len(line) + len(raw)
+        received += await asyncio.wait_for(self.read_body(headers, int(status), method), timeout)
+        keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+        return int(status), reason, received, connect, latency, keep_alive
+
+
+class LiteRun(object):
+    """
+    the thread group of a plan as asyncio virtual users, every sample is written to result.jtl
+    in jmeter's csv format so the analysis of jmeter runs applies unchanged
+    fields selects the written columns, None writes no samples, and one in rate samples is kept,
+    the totals are logged like jmeter's summariser in any case
+    """
+
+    FLUSH = 1.0
+
+    def __init__(self, settings: dict, jtl_path: str, log_path: str, fields: Optional[list] = JTL_FIELDS,
+                 rate: int = 1):
+        self.settings = settings
+        self.jtl_path = jtl_path
+        self.log_path = log_path
+        self.fields = fields
+        self.index = None if fields is None or tuple(fields) == JTL_FIELDS else [JTL_FIELDS.index(field) for field in fields]
+        self.rate = max(int(rate), 1)
+        self.rows = list()
+        self.count = self.errors = self.total = 0
+        self.minimum = self.maximum = None
+        self.active = 0
+        self.stopped = asyncio.Event()
+
+    def log(self, message: str) -> None:
+        with open(file=self.log_path, mode='a', encoding='utf-8') as f:
+            f.write('{} {}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), message))
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def flush(self, f) -> None:
+        rows, self.rows = self.rows, list()
+        if rows and f is not None:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerows(rows)
+            f.flush()
+
+    async def flusher(self, f) -> None:
+        while not self.stopped.is_set():
+            await asyncio.sleep(self.FLUSH)
+            self.flush(f)
+
+    async def run(self) -> int:
+        settings = self.settings
+        self.log('lite run of {} users, loops {}, duration {}'.format(
+            settings['threads'], settings['loops'], settings['duration']))
+        began = time.monotonic()
+        with (nullcontext() if self.fields is None else
+              open(file=self.jtl_path, mode='w', encoding='utf-8', newline='')) as f:
+            if f is not None:
+                csv.writer(f, lineterminator='\n').writerow(self.fields)
+            flusher = asyncio.create_task(self.flusher(f))
+            try:
+                if settings['delay']:
+                    try:
+                        await asyncio.wait_for(self.stopped.wait(), settings['delay'])
+                    except asyncio.TimeoutError:
+                        pass
+                start = time.monotonic()
+                deadline = start + settings['duration'] if settings['duration'] else None
+                users = [asyncio.create_task(self.user(number, start, deadline))
+                         for number in range(settings['threads'])]
+                finished = asyncio.gather(*users, return_exceptions=True)
+                stop = asyncio.create_task(self.stopped.wait())
+                await asyncio.wait([finished, stop], return_when=asyncio.FIRST_COMPLETED,
+                                   timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+                # the duration is over or the run was stopped, samples in flight are dropped like jmeter does
+                for user in users:
+                    user.cancel()
+                await finished
+                stop.cancel()
+            except Exception as e:
+                logger.exception(e)
+                self.log('lite run failed: {}'.format(e))
+                return 1
+            finally:
+                self.stopped.set()
+                flusher.cancel()
+                self.flush(f)
+                self.summarize(time.monotonic() - began)
+        self.log('lite run finished')
+        return 0
+
+    async def user(self, number: int, start: float, deadline: Optional[float]) -> None:
+        settings = self.settings
+        await asyncio.sleep(max(start + settings['ramp_time'] * number / settings['threads'] - time.monotonic(), 0))
+        thread_name = '{} 1-{}'.format(settings['thread_group_name'], number + 1)
+        connection = LiteConnection(settings['host'], settings['port'], settings['secure'])
+        iteration = 0
+        self.active += 1
+        try:
+            while not self.stopped.is_set() and (settings['loops'] < 0 or iteration < settings['loops']):
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                iteration += 1
+                success = await self.sample(connection, thread_name)
+                if not settings['keep_alive'] or not settings['same_user']:
+                    connection.close()
+                if not success and settings['on_sample_error'] == 'stopthread':
+                    break
+                if not success and settings['on_sample_error'] in ('stoptest', 'stoptestnow'):
+                    self.stop()
+        finally:
+            connection.close()
+            self.active -= 1
+
+    async def sample(self, connection: LiteConnection, thread_name: str) -> bool:
+        settings = self.settings
+        stamp = int(time.time() * 1000)
+        start = time.perf_counter()
+        connect = latency = received = 0
+        sent = len(settings['head']) + len(settings['body'])
+        try:
+            status, reason, received, connect, latency, keep_alive = await connection.request(
+                settings['method'], settings['head'], settings['body'], settings['timeout'])
+            if not keep_alive:
+                connection.close()
+            code, message, success = str(status), reason, 200 <= status < 400
+        except (OSError, EOFError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            connection.close()
+            sent = 0
+            name = 'TimeoutError' if isinstance(e, asyncio.TimeoutError) else type(e).__name__
+            code, message, success = ('Non HTTP response code: {}'.format(name),
+                                      'Non HTTP response message: {}'.format(e), False)
+        elapsed = round((time.perf_counter() - start) * 1000)
+        self.count += 1
+        self.errors += not success
+        self.total += elapsed
+        self.minimum = elapsed if self.minimum is None else min(self.minimum, elapsed)
+        self.maximum = elapsed if self.maximum is None else max(self.maximum, elapsed)
+        if self.fields is not None and (self.count - 1) % self.rate == 0:
+            row = (stamp, elapsed, settings['label'], code, message, thread_name, 'text',
+                   'true' if success else 'false', '', received, sent,
+                   self.active, self.active, settings['url'], latency, 0, connect)
+            self.rows.append(row if self.index is None else [row[i] for i in self.index])
+        return success
+
+    def summarize(self, seconds: float) -> None:
+        """the final line of jmeter's summariser, read back by ResultProfile.summary"""
+        seconds = max(int(round(seconds)), 1)
+        self.log('summary = {:>6} in {:02d}:{:02d}:{:02d} = {:6.1f}/s Avg: {:5d} Min: {:5d} Max: {:5d} Err: {:5d} ({:.2f}%)'.format(
+            self.count, seconds // 3600, seconds // 60 % 60, seconds % 60, self.count / seconds,
+            round(self.total / self.count) if self.count else 0, self.minimum or 0, self.maximum or 0,
+            self.errors, self.errors * 100 / self.count if self.count else 0))
+
+
+class LiteEngine(object):
+    """
+    run plans made of one thread group and one http sampler without jmeter
+    every run is a python subprocess of its own, so the virtual users never share the event loop
+    of the server and the task has a real pid, closing its stdin stops it like jmeter's stoptest
+    """
+
+    # elements the lite engine either runs or can safely ignore
+    TESTCLASSES = frozenset(('TestPlan', 'Arguments', 'ThreadGroup', 'LoopController', 'HTTPSamplerProxy',
+                             'HeaderManager', 'ResultCollector', 'ConfigTestElement'))
+    BODY_METHODS = frozenset(('POST', 'PUT', 'PATCH', 'DELETE'))
+    RUNS = dict()
+
+    @classmethod
+    def check(cls, jmx_path: str) -> None:
+        document = JMX.document(jmx_path)
+        testclasses = [testclass for (_, testclass), elements in document.testclasses.items()
+                       for element in elements if element.attrib.get('enabled', 'true') == 'true']
+        unsupported = sorted(set(testclasses) - cls.TESTCLASSES)
+        if unsupported:
+            raise Exception('the lite engine does not support {}'.format(', '.join(unsupported)))
+        if testclasses.count('ThreadGroup') != 1 or testclasses.count('HTTPSamplerProxy') != 1:
+            raise Exception('the lite engine runs one thread group with one http request')
+
+    @classmethod
+    def number(cls, value: Optional[str], default: float = 0) -> float:
+        value = (value or '').strip()
+        if '${' in value:
+            raise Exception('the lite engine does not resolve {}'.format(value))
+        return float(value) if value else default
+
+    @classmethod
+    def settings(cls, jmx_path: str) -> dict:
+        """everything a virtual user needs, read once from the plan"""
+        from webmeter.core.plan import Samplers, Thread_Group
+        cls.check(jmx_path)
+        group = Thread_Group.info(jmx_path)
+        sampler = Samplers.info(jmx_path)
+        fields = [str(value) for value in group.values()] + [str(value) for value in sampler.values()]
+        if any('${' in value for value in fields):
+            raise Exception('the lite engine does not resolve jmeter variables')
+        protocol = (sampler.get('protocol') or 'http').lower()
+        path = sampler.get('path') or '/'
+        if path.startswith('http://') or path.startswith('https://'):
+            url = urlsplit(path)
+            protocol, domain, port = url.scheme, url.hostname, url.port
+            path = url.path + ('?' + url.query if url.query else '')
+        else:
+            domain, port = sampler.get('domain'), int(cls.number(sampler.get('port'), 0)) or None
+        if not domain:
+            raise Exception('no server name in the http request')
+        port = port or (443 if protocol == 'https' else 80)
+        method = (sampler.get('method') or 'GET').upper()
+        encoding = sampler.get('contentEncoding') or 'utf-8'
+        parameters = [(item.get('name') or '', item.get('value') or '') for item in sampler.get('parameters') or []]
+        body = b''
+        headers = list()
+        if sampler.get('postBodyRaw'):
+            body = (sampler.get('body_data') or '').encode(encoding)
+        elif parameters and method in cls.BODY_METHODS:
+            body = urlencode(parameters, encoding=encoding).encode('ascii')
+            headers.append(('Content-Type', 'application/x-www-form-urlencoded; charset={}'.format(encoding)))
+        elif parameters:
+            path += ('&' if '?' in path else '?') + urlencode(parameters, encoding=encoding)
+        document = JMX.document(jmx_path)
+        names = [element.text or '' for element in document.find_name('stringProp', 'Header.name')]
+        values = [element.text or '' for element in document.find_name('stringProp', 'Header.value')]
+        headers.extend(zip(names, values))
+        keep_alive = sampler.get('use_keepalive') is not False
+        host = domain if port in (80, 443) else '{}:{}'.format(domain, port)
+        lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: {}'.format(host),
+                 'Connection: {}'.format('keep-alive' if keep_alive else 'close')]
+        if body or method in cls.BODY_METHODS:
+            lines.append('Content-Length: {}'.format(len(body)))
+        lines.extend('{}: {}'.format(name, value) for name, value in headers if name.lower() not in ('host', 'connection', 'content-length'))
+        timeouts = [cls.number(element.text) for element in document.find_name('stringProp', 'HTTPSampler.response_timeout')]
+        scheduler = group.get('scheduler') is True
+        loops = int(cls.number(group.get('loops'), 1))
+        duration = cls.number(group.get('duration')) if scheduler else 0
+        if loops < 0 and not duration:
+            logger.warning('lite run loops forever until it is stopped')
+        return {
+            'threads': int(cls.number(group.get('num_threads'), 1)),
+            'ramp_time': cls.number(group.get('ramp_time'), 0),
+            'loops': loops,
+            'duration': duration,
+            'delay': cls.number(group.get('delay')) if scheduler else 0,
+            'on_sample_error': group.get('on_sample_error') or 'continue',
+            'same_user': group.get('same_user_on_next_iteration') is not False,
+            'thread_group_name': group.get('thread_group_name'),
+            'label': sampler.get('http_request_name'),
+            'host': domain,
+            'port': port,
+            'secure': protocol == 'https',
+            'keep_alive': keep_alive,
+            'method': method,
+            'url': '{}://{}{}'.format(protocol, host, path),
+            'head': ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'),
+            'body': body,
+            'timeout': timeouts[0] / 1000 if timeouts and timeouts[0] else None
+        }
+
+    @classmethod
+    async def start(cls, task: str, jmx_path: str, jtl_path: str, log_path: str,
+                    fields: Optional[list] = JTL_FIELDS, rate: int = 1) -> asyncio.subprocess.Process:
+        # refuse the plan here, the subprocess would only log why it failed
+        cls.settings(jmx_path)
+        Common.make_dir(os.path.dirname(log_path))
+        command = [sys.executable, '-m', 'webmeter.core.lite', jmx_path, jtl_path, log_path,
+                   '--fields', json.dumps(None if fields is None else list(fields)), '--rate', str(rate)]
+        # the subprocess imports the same webmeter as the server, installed or not
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        environ = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+        logger.info('start command : {}'.format(' '.join(command)))
+        process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE, env=environ)
+        cls.RUNS = {name: run for name, run in cls.RUNS.items() if run.returncode is None}
+        cls.RUNS[task] = process
+        return process
+
+    @classmethod
+    def stop(cls) -> int:
+        runs = [run for run in cls.RUNS.values() if run.returncode is None]
+        for run in runs:
+            run.stdin.close()
+        return len(runs)
+
+    @classmethod
+    async def serve(cls, jmx_path: str, jtl_path: str, log_path: str, fields: Optional[list], rate: int) -> int:
+        """the run inside the subprocess, it stops once stdin is closed (or the server is gone)"""
+        run = LiteRun(cls.settings(jmx_path), jtl_path, log_path, fields, rate)
+        loop = asyncio.get_running_loop()
+
+        def watch() -> None:
+            # raw reads, a daemon thread blocked in the buffered sys.stdin aborts the interpreter at exit
+            while os.read(sys.stdin.fileno(), 1024):
+                pass
+            loop.call_soon_threadsafe(run.stop)
+
+        threading.Thread(target=watch, daemon=True).start()
+        return await run.run()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m webmeter.core.lite')
+    parser.add_argument('jmx')
+    parser.add_argument('jtl')
+    parser.add_argument('log')
+    parser.add_argument('--fields', default='null', help='json list of the result.jtl columns, null for none')
+    parser.add_argument('--rate', type=int, default=1)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(LiteEngine.serve(args.jmx, args.jtl, args.log, json.loads(args.fields), args.rate)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+import asyncio
+import csv
+import io
+import json
+import math
+import os
+import numpy as np
+from collections import deque
+from typing import AsyncIterator, Optional
+from loguru import logger
+from webmeter.core.sqlhandle import crud
+from webmeter.core.task import JTL_FIELDS, JTLReader, TaskBase
+
+
+class JTLTailer(object):
+    """
+    follow result.jtl of one running task and aggregate it per second, for the live stream and
+    for the over time charts, which read the min/max/total/p95 of every settled second
+    """
+
+    INTERVAL = 1.0
+    SETTLE = 2  # seconds a bucket stays open for samples that finish late
+    HISTORY = 300
+    QUEUE_SIZE = 600
+    PERCENTILES = (50, 90, 99)
+    FIELDS = ('elapsed', 'Latency', 'Connect')
+
+    def __init__(self, plan: str, task: str):
+        self.plan = plan
+        self.task = task
+        self.path = TaskBase.result_file_path(plan, task)
+        self.position = 0
+        self.pending = b''
+        self.columns = None
+        self.buckets = dict()
+        self.history = deque(maxlen=self.HISTORY)
+        self.seconds = dict()  # label -> [(second, count, {field: (min, max, total, p95)})]
+        self.subscribers = set()
+        self.runner = None
+        self.polling = asyncio.Lock()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        for item in self.history:
+            queue.put_nowait(item)
+        self.subscribers.add(queue)
+        if self.runner is None:
+            self.runner = asyncio.create_task(self.run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.subscribers.discard(queue)
+
+    def publish(self, item: Optional[dict]) -> None:
+        if item is not None:
+            self.history.append(item)
+        for queue in self.subscribers:
+            if queue.full():
+                # a slow viewer loses its oldest points instead of stalling the others
+                queue.get_nowait()
+            queue.put_nowait(item)
+
+    def is_running(self) -> bool:
+        try:
+            return crud.query_task_one(self.plan, self.task).get('status') == 'Running'
+        except Exception:
+            return False
+
+    def read(self) -> list:
+        """parse the complete records appended since the last read"""
+        if not os.path.exists(self.path):
+            return []
+        with open(file=self.path, mode='rb') as f:
+            f.seek(self.position)
+            data = f.read()
+        self.position += len(data)
+        data = self.pending + data
+        lines = data.splitlines(keepends=True)
+        end = 0
+        consumed = 0
+        quotes = 0
+        # a record ends at a newline outside quotes, quoted newlines belong to the record
+        for line in lines:
+            quotes += line.count(b'"')
+            consumed += len(line)
+            if quotes % 2 == 0 and line.endswith(b'\n'):
+                end = consumed
+                quotes = 0
+        self.pending = data[end:]
+        rows = csv.reader(io.StringIO(data[:end].decode('utf-8'), newline=''))
+        samples = list()
+        for row in rows:
+            if self.columns is None:
+                header = row if 'timeStamp' in row else JTL_FIELDS[:len(row)]
+                self.columns = (JTLReader.columns(header), len(header))
+                if 'timeStamp' in row:
+                    continue
+            columns, width = self.columns
+            if len(row) >= width:
+                samples.append(JTLReader.sample(columns, row))
+        return samples
+
+    def aggregate(self, samples: list) -> None:
+        for sample in samples:
+            labels = self.buckets.setdefault(sample.timeStamp // 1000, dict())
+            for label in (sample.label, 'Total'):
+                values, errors = labels.setdefault(label, ([[] for _ in self.FIELDS], [0]))
+                for field, column in zip(self.FIELDS, values):
+                    column.append(getattr(sample, field))
+                if not sample.success:
+                    errors[0] += 1
+
+    def settle(self, flush: bool = False) -> None:
+        """publish the buckets no late sample is expected for anymore"""
+        if not self.buckets:
+            return
+        newest = max(self.buckets)
+        for second in sorted(self.buckets):
+            if not flush and second > newest - self.SETTLE:
+                break
+            labels = self.buckets.pop(second)
+            item = {'time': second * 1000, 'labels': dict()}
+            for label, (values, errors) in labels.items():
+                elapsed = values[0]
+                self.record(second * 1000, label, values)
+                percentiles = np.round(np.percentile(elapsed, self.PERCENTILES), 2).tolist()
+                item['labels'][label] = {
+                    'throughput': len(elapsed),
+                    'errors': errors[0],
+                    'error_rate': round(errors[0] * 100 / len(elapsed), 2),
+                    'p50': percentiles[0],
+                    'p90': percentiles[1],
+                    'p99': percentiles[2]
+                }
+            self.publish(item)
+
+    def record(self, second: int, label: str, values: list) -> None:
+        count = len(values[0])
+        fields = dict()
+        for field, column in zip(self.FIELDS, values):
+            column = sorted(column)
+            # nearest rank, like the rollups
+            fields[field] = (column[0], column[-1], sum(column), column[math.ceil(count * 0.95) - 1])
+        self.seconds.setdefault(label, list()).append((second, count, fields))
+
+    def over_time(self, field: str, start: Optional[int], end: Optional[int], points: int,
+                  label: Optional[str] = None) -> list:
+        """the settled seconds of one label (all when None) in the buckets of TaskRollup.initOverTime"""
+        start = None if start is None else int(start) // 1000 * 1000
+        end = None if end is None else int(end)
+        rows = [row for row in self.seconds.get('Total' if label is None else label, list())
+                if (start is None or row[0] >= start) and (end is None or row[0] <= end)]
+        if not rows:
+            return []
+        # a late sample may settle a second twice, its rows are merged like any other two
+        second = np.array([row[0] for row in rows], dtype='int64')
+        count = np.array([row[1] for row in rows], dtype='int64')
+        low, high, total, p95 = np.array([row[2][field] for row in rows], dtype='int64').T
+        begin = int(second.min()) if start is None else start
+        stop = int(second.max())
+        interval = max(-(-(stop - begin + 1000) // points), 1000)
+        interval = -(-interval // 1000) * 1000
+        buckets, bucket = np.unique((second - begin) // interval, return_inverse=True)
+        bucket = bucket.ravel()
+        counts = np.bincount(bucket, weights=count)
+        mean = np.bincount(bucket, weights=total) / counts
+        p95_mean = np.bincount(bucket, weights=p95 * count) / counts
+        lows = np.full(len(buckets), np.iinfo('int64').max)
+        np.minimum.at(lows, bucket, low)
+        highs = np.full(len(buckets), np.iinfo('int64').min)
+        np.maximum.at(highs, bucket, high)
+        return [{'x': begin + b * interval, 'y': round(avg, 2), 'min': lo, 'mean': round(avg, 2),
+                 'max': hi, 'p95_mean': round(pct, 2), 'count': int(n)}
+                for b, lo, avg, hi, pct, n in zip(buckets.tolist(), lows.tolist(), mean.tolist(), highs.tolist(),
+                                                 p95_mean.tolist(), counts.tolist())]
+
+    async def poll(self, flush: bool = False) -> None:
+        """read what was appended and publish the seconds that settled, stream and charts share it"""
+        async with self.polling:
+            samples = await asyncio.to_thread(self.read)
+            self.aggregate(samples)
+            self.settle(flush)
+
+    async def run(self) -> None:
+        running = True
+        try:
+            while self.subscribers:
+                running = self.is_running()
+                if not running and self.position == 0:
+                    # finished before anyone watched it, the analysis page covers it
+                    break
+                await self.poll(flush=not running)
+                if not running:
+                    break
+                await asyncio.sleep(self.INTERVAL)
+        except Exception as e:
+            logger.exception(e)
+            running = False
+        finally:
+            self.runner = None
+            self.publish(None)
+            if not running:
+                LiveMetrics.TAILERS.pop(self.task, None)
+
+
+class LiveMetrics(object):
+    """one tailer per running task, shared by every viewer of it"""
+
+    TAILERS = dict()
+
+    @classmethod
+    def tailer(cls, plan: str, task: str) -> JTLTailer:
+        tailer = cls.TAILERS.get(task)
+        if tailer is None:
+            tailer = cls.TAILERS[task] = JTLTailer(plan, task)
+        return tailer
+
+    @classmethod
+    def release(cls, task: str) -> None:
+        """drop the tailer of a finished task, one still streaming drops itself when its viewers got the end"""
+        tailer = cls.TAILERS.get(task)
+        if tailer is not None and tailer.runner is None:
+            cls.TAILERS.pop(task, None)
+
+    @classmethod
+    async def over_time(cls, plan: str, task: str, field: str, start: Optional[int] = None,
+                        end: Optional[int] = None, points: int = 1000, label: Optional[str] = None) -> list:
+        """over time buckets of a running task, [] for a task that is not running"""
+        tailer = cls.TAILERS.get(task)
+        if tailer is None:
+            if not JTLTailer(plan, task).is_running():
+                return []
+            tailer = cls.tailer(plan, task)
+        await tailer.poll()
+        return tailer.over_time(field, start, end, points, label)
+
+    @classmethod
+    async def stream(cls, plan: str, task: str) -> AsyncIterator[str]:
+        """server-sent events of the per-second aggregates, ends with an end event"""
+        tailer = cls.tailer(plan, task)
+        queue = tailer.subscribe()
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    yield 'event: end\ndata: {}\n\n'
+                    break
+                yield 'event: metrics\ndata: {}\n\n'.format(json.dumps(item))
+        finally:
+            tailer.unsubscribe(queue)
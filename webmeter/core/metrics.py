@@ -0,0 +1,229 @@
+import asyncio
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+from loguru import logger
+from starlette.responses import JSONResponse
+
+
+class Histogram(object):
+    """cumulative buckets per label values, in prometheus' text format"""
+
+    def __init__(self, name: str, help: str, labels: tuple, buckets: tuple):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = dict()
+
+    def observe(self, values: tuple, value: float) -> None:
+        series = self.series.get(values)
+        if series is None:
+            series = self.series.setdefault(values, [[0] * (len(self.buckets) + 1), 0.0])
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list:
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        for values, (counts, total) in sorted(self.series.items()):
+            labels = ServerMetrics.labels(self.labels, values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append('{}_bucket{{{}}} {}'.format(self.name, ','.join(filter(None, [labels, 'le="{}"'.format(le)])),
+                                                        cumulative))
+            suffix = '{{{}}}'.format(labels) if labels else ''
+            lines.append('{}_sum{} {}'.format(self.name, suffix, repr(total)))
+            lines.append('{}_count{} {}'.format(self.name, suffix, cumulative))
+        return lines
+
+
+class TimedJSONResponse(JSONResponse):
+    """json response whose encoding is counted as the serialize phase of the request"""
+
+    def render(self, content) -> bytes:
+        with ServerMetrics.phase('serialize'):
+            return super().render(content)
+
+
+class ServerMetrics(object):
+    """
+    per route latency and payload size, requests in flight, event loop lag and cache hits of
+    the webmeter server, rendered for prometheus at /metrics
+    requests slower than SLOW_SECONDS are logged with the time spent reading files and serializing
+    """
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+    LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+    LAG_INTERVAL = 0.5
+    SLOW_SECONDS = 1.0
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    latency = Histogram('webmeter_http_request_duration_seconds', 'time until the response of a request starts',
+                        ('method', 'route'), LATENCY_BUCKETS)
+    size = Histogram('webmeter_http_response_size_bytes', 'size of the response body',
+                     ('method', 'route'), SIZE_BUCKETS)
+    lag = Histogram('webmeter_event_loop_lag_seconds', 'delay of a timer on the event loop', (), LAG_BUCKETS)
+    responses = dict()  # (method, route, status) -> count
+    caches = dict()  # (cache, result) -> count
+    in_flight = 0
+    last_lag = 0.0
+    monitor = None
+
+    _phases = contextvars.ContextVar('phases', default=None)
+    _active = threading.local()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def labels(names: tuple, values: tuple) -> str:
+        return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                        for name, value in zip(names, values))
+
+    @classmethod
+    @contextmanager
+    def phase(cls, name: str):
+        """add the time spent in the block to the named phase of the current request"""
+        phases = cls._phases.get()
+        active = cls._active.__dict__.setdefault('names', set())
+        if phases is None or name in active:
+            # outside a request, or nested in the same phase which already counts the time
+            yield
+            return
+        active.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            active.discard(name)
+            with cls._lock:
+                phases[name] = phases.get(name, 0.0) + elapsed
+
+    @classmethod
+    def cache(cls, name: str, hit: bool) -> None:
+        key = (name, 'hit' if hit else 'miss')
+        with cls._lock:
+            cls.caches[key] = cls.caches.get(key, 0) + 1
+
+    @classmethod
+    def begin(cls) -> dict:
+        cls.in_flight += 1
+        phases = dict()
+        cls._phases.set(phases)
+        return phases
+
+    @classmethod
+    def answered(cls) -> None:
+        cls.in_flight -= 1
+
+    @classmethod
+    def end(cls, method: str, route: str, status: int, size: int, seconds: float, phases: dict) -> None:
+        cls.latency.observe((method, route), seconds)
+        cls.size.observe((method, route), size)
+        key = (method, route, status)
+        cls.responses[key] = cls.responses.get(key, 0) + 1
+        if seconds >= cls.SLOW_SECONDS:
+            logger.warning('slow request {} {} {}: {:.3f}s, read {:.3f}s, serialize {:.3f}s, other {:.3f}s, {} bytes'.format(
+                method, route, status, seconds, phases.get('read', 0.0), phases.get('serialize', 0.0),
+                max(seconds - sum(phases.values()), 0.0), size))
+
+    @classmethod
+    async def loop(cls) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(cls.LAG_INTERVAL)
+            cls.last_lag = max(time.perf_counter() - start - cls.LAG_INTERVAL, 0.0)
+            cls.lag.observe((), cls.last_lag)
+
+    @classmethod
+    def start(cls) -> None:
+        cls.monitor = asyncio.create_task(cls.loop())
+
+    @classmethod
+    async def shutdown(cls) -> None:
+        if cls.monitor is not None:
+            cls.monitor.cancel()
+            try:
+                await cls.monitor
+            except asyncio.CancelledError:
+                pass
+            cls.monitor = None
+
+    @classmethod
+    def render(cls, gauges: Optional[dict] = None) -> str:
+        """every metric in prometheus' text exposition format, gauges maps name -> (help, value)"""
+        lines = ['# HELP webmeter_http_requests_total requests answered',
+                 '# TYPE webmeter_http_requests_total counter']
+        for values, count in sorted(cls.responses.items()):
+            lines.append('webmeter_http_requests_total{{{}}} {}'.format(
+                cls.labels(('method', 'route', 'status'), values), count))
+        lines.extend(cls.latency.render())
+        lines.extend(cls.size.render())
+        lines.extend(cls.lag.render())
+        gauges = dict(gauges or dict())
+        gauges['webmeter_http_requests_in_flight'] = ('requests being answered', cls.in_flight)
+        gauges['webmeter_event_loop_lag_last_seconds'] = ('latest event loop lag', cls.last_lag)
+        for name, (help, value) in gauges.items():
+            lines.extend(['# HELP {} {}'.format(name, help), '# TYPE {} gauge'.format(name),
+                          '{} {}'.format(name, value)])
+        with cls._lock:
+            caches = dict(cls.caches)
+        lines.extend(['# HELP webmeter_cache_requests_total lookups of the jtl, aggregate and jmx caches',
+                      '# TYPE webmeter_cache_requests_total counter'])
+        for values, count in sorted(caches.items()):
+            lines.append('webmeter_cache_requests_total{{{}}} {}'.format(cls.labels(('cache', 'result'), values), count))
+        lines.extend(['# HELP webmeter_cache_hit_ratio share of the lookups served without a rebuild',
+                      '# TYPE webmeter_cache_hit_ratio gauge'])
+        for name in sorted({name for name, _ in caches}):
+            hits, misses = caches.get((name, 'hit'), 0), caches.get((name, 'miss'), 0)
+            lines.append('webmeter_cache_hit_ratio{{{}}} {}'.format(cls.labels(('cache',), (name,)),
+                                                                    round(hits / (hits + misses), 4)))
+        return '\n'.join(lines) + '\n'
+
+
+class RequestMetrics(object):
+    """
+    asgi middleware feeding ServerMetrics, routes are reported by their path template
+    a request is timed until its response starts, streamed bodies (live metrics, exports) last as
+    long as the test or the download and would otherwise read as slow requests
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        phases = ServerMetrics.begin()
+        response = {'status': 500, 'size': 0, 'seconds': None}
+
+        def answered() -> None:
+            if response['seconds'] is None:
+                response['seconds'] = time.perf_counter() - start
+                ServerMetrics.answered()
+
+        async def sending(message) -> None:
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                answered()
+            elif message['type'] == 'http.response.body':
+                response['size'] += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, sending)
+        finally:
+            # failed before its response started
+            answered()
+            route = scope.get('route')
+            # unmatched paths are grouped, raw urls would make a series per url
+            path = getattr(route, 'path', None) or ('/static' if scope['path'].startswith('/static/') else 'unmatched')
+            ServerMetrics.end(scope['method'], path, response['status'], response['size'],
+                              response['seconds'], phases)
@@ -0,0 +1,114 @@
+import socket
+import threading
+import time
+import datetime
+import psutil
+from collections import deque
+from typing import Optional
+from loguru import logger
+from webmeter.core.sqlhandle import crud
+
+
+class HostSampler(object):
+    """
+    sample cpu, memory, network and disk io of this machine in a background thread
+    the latest samples stay in a ring buffer for the monitor endpoints, samples taken
+    while tasks are running are written to the monitor table in batches
+    """
+
+    INTERVAL = 1.0
+    SIZE = 600
+    FLUSH = 10  # samples per batch written to the monitor table
+
+    buffer = deque(maxlen=SIZE)
+    pending = list()
+    machine = socket.gethostname()
+    _thread = None
+    _stopped = threading.Event()
+
+    @classmethod
+    def interval(cls) -> float:
+        try:
+            return max(float(crud.query_value('monitor_interval', cls.INTERVAL) or cls.INTERVAL), 0.1)
+        except ValueError:
+            return cls.INTERVAL
+
+    @classmethod
+    def start(cls) -> None:
+        if cls._thread is not None and cls._thread.is_alive():
+            return
+        cls._stopped.clear()
+        cls._thread = threading.Thread(target=cls.run, name='host-sampler', daemon=True)
+        cls._thread.start()
+
+    @classmethod
+    def stop(cls) -> None:
+        cls._stopped.set()
+        if cls._thread is not None:
+            cls._thread.join()
+            cls._thread = None
+        cls.flush()
+
+    @classmethod
+    def counters(cls) -> tuple:
+        net = psutil.net_io_counters()
+        disk = psutil.disk_io_counters()
+        return (time.time(), net.bytes_sent if net else 0, net.bytes_recv if net else 0,
+                disk.read_bytes if disk else 0, disk.write_bytes if disk else 0)
+
+    @classmethod
+    def run(cls) -> None:
+        psutil.cpu_percent(interval=None)
+        last = cls.counters()
+        while not cls._stopped.wait(cls.interval()):
+            try:
+                current = cls.counters()
+                seconds = max(current[0] - last[0], 1e-6)
+                sent, recv, read, write = [(now - before) / 1024 / seconds for now, before in zip(current[1:], last[1:])]
+                last = current
+                sample = {
+                    'time': int(current[0] * 1000),
+                    'cpu': psutil.cpu_percent(interval=None),
+                    'memory': psutil.virtual_memory().percent,
+                    'net_sent': round(sent, 2),
+                    'net_recv': round(recv, 2),
+                    'network': round(sent + recv, 2),
+                    'disk_read': round(read, 2),
+                    'disk_write': round(write, 2)
+                }
+                cls.buffer.append(sample)
+                cls.record(sample)
+            except Exception as e:
+                logger.exception(e)
+
+    @classmethod
+    def record(cls, sample: dict) -> None:
+        """tag the sample with the running tasks and write them once a batch is full"""
+        tasks = [task.get('task') for task in crud.query_task_running() or []]
+        if tasks:
+            ctime = datetime.datetime.fromtimestamp(sample['time'] / 1000).strftime('%y-%m-%d %H:%M:%S')
+            for task in tasks:
+                cls.pending.append({'machine': cls.machine, 'task': task, 'cpu': sample['cpu'],
+                                    'memory': sample['memory'], 'network': sample['network'],
+                                    'disk_read': sample['disk_read'], 'disk_write': sample['disk_write'],
+                                    'timestamp': sample['time'], 'ctime': ctime})
+        if len(cls.pending) >= cls.FLUSH or (cls.pending and not tasks):
+            cls.flush()
+
+    @classmethod
+    def flush(cls) -> None:
+        rows, cls.pending = cls.pending, list()
+        if rows:
+            try:
+                crud.create_monitors(rows)
+            except Exception as e:
+                logger.exception(e)
+
+    @classmethod
+    def latest(cls) -> Optional[dict]:
+        return cls.buffer[-1] if cls.buffer else None
+
+    @classmethod
+    def samples(cls, since: Optional[int] = None) -> list:
+        """buffered samples newer than since (ms)"""
+        return [sample for sample in list(cls.buffer) if since is None or sample['time'] > since]
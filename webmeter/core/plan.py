@@ -1,8 +1,12 @@
 import os
 import shutil
+import datetime
+from typing import Optional
 from loguru import logger
 from fastapi import UploadFile
-from webmeter.core.utils import Common, JMX
+from webmeter.core.utils import Common, JMX, JMXDocument
+from webmeter.core.sqlhandle import crud
+from webmeter.core.aggregate import TaskAggregate
 
 
 class Base(object):
@@ -39,13 +43,13 @@ class Base(object):
         return plan_info_dict
     
     @classmethod
-    def save(cls, jmx_path: str, content: dict) -> None:
+    def save(cls, document: JMXDocument, content: dict) -> None:
         logger.info(content)
-        JMX.write_testname(jmx_path,'TestPlan','TestPlan', content.get('new_plan_name'))
-        JMX.write_text(jmx_path, 'stringProp', 'TestPlan.comments', content.get('plan_comment'))
-        JMX.write_text(jmx_path, 'boolProp', 'TestPlan.functional_mode', Common.MAPPING.get(content.get('functional_mode')))
-        JMX.write_text(jmx_path, 'boolProp', 'TestPlan.tearDown_on_shutdown', Common.MAPPING.get(content.get('tearDown_on_shutdown')))
-        JMX.write_text(jmx_path, 'boolProp', 'TestPlan.serialize_threadgroups', Common.MAPPING.get(content.get('serialize_threadgroups')))
+        document.write_testname('TestPlan','TestPlan', content.get('new_plan_name'))
+        document.write_text('stringProp', 'TestPlan.comments', content.get('plan_comment'))
+        document.write_text('boolProp', 'TestPlan.functional_mode', Common.MAPPING.get(content.get('functional_mode')))
+        document.write_text('boolProp', 'TestPlan.tearDown_on_shutdown', Common.MAPPING.get(content.get('tearDown_on_shutdown')))
+        document.write_text('boolProp', 'TestPlan.serialize_threadgroups', Common.MAPPING.get(content.get('serialize_threadgroups')))
     
 class Thread_Group(object):
 
@@ -112,19 +116,19 @@ class Thread_Group(object):
         return thread_group_info_dict
     
     @classmethod
-    def save(cls, jmx_path: str, content: dict):
+    def save(cls, document: JMXDocument, content: dict):
         logger.info(content)
-        JMX.write_testname(jmx_path,'ThreadGroup','ThreadGroup', content.get('thread_group_name'))
-        JMX.write_text(jmx_path, 'stringProp', 'ThreadGroup.on_sample_error', content.get('on_sample_error'))
-        JMX.write_text(jmx_path, 'stringProp', 'ThreadGroup.num_threads', content.get('num_threads'))
-        JMX.write_text(jmx_path, 'stringProp', 'ThreadGroup.ramp_time', content.get('ramp_time'))
-        JMX.write_text(jmx_path, 'stringProp', 'LoopController.loops', content.get('loops'))
-        JMX.write_text(jmx_path, 'boolProp', 'ThreadGroup.same_user_on_next_iteration', 
-                       Common.MAPPING.get(content.get('same_user_on_next_iteration')))
-        JMX.write_text(jmx_path, 'boolProp', 'ThreadGroup.delayedStart', Common.MAPPING.get(content.get('delayedStart')))
-        JMX.write_text(jmx_path, 'boolProp', 'ThreadGroup.scheduler', Common.MAPPING.get(content.get('scheduler')))
-        JMX.write_text(jmx_path, 'stringProp', 'ThreadGroup.duration', content.get('loodurationps'))
-        JMX.write_text(jmx_path, 'stringProp', 'ThreadGroup.delay', content.get('delay'))
+        document.write_testname('ThreadGroup','ThreadGroup', content.get('thread_group_name'))
+        document.write_text('stringProp', 'ThreadGroup.on_sample_error', content.get('on_sample_error'))
+        document.write_text('stringProp', 'ThreadGroup.num_threads', content.get('num_threads'))
+        document.write_text('stringProp', 'ThreadGroup.ramp_time', content.get('ramp_time'))
+        document.write_text('stringProp', 'LoopController.loops', content.get('loops'))
+        document.write_text('boolProp', 'ThreadGroup.same_user_on_next_iteration', 
+                            Common.MAPPING.get(content.get('same_user_on_next_iteration')))
+        document.write_text('boolProp', 'ThreadGroup.delayedStart', Common.MAPPING.get(content.get('delayedStart')))
+        document.write_text('boolProp', 'ThreadGroup.scheduler', Common.MAPPING.get(content.get('scheduler')))
+        document.write_text('stringProp', 'ThreadGroup.duration', content.get('loodurationps'))
+        document.write_text('stringProp', 'ThreadGroup.delay', content.get('delay'))
 
 class Samplers(object):
     
@@ -208,26 +212,26 @@ class Samplers(object):
         return samplers_info_dict
     
     @classmethod
-    def save(cls, jmx_path: str, content: dict):
+    def save(cls, document: JMXDocument, content: dict):
         logger.info(content)
-        JMX.write_testname(jmx_path,'HTTPSamplerProxy','HTTPSamplerProxy', content.get('http_request_name'))
-        JMX.write_text(jmx_path, 'stringProp', 'HTTPSampler.protocol', content.get('protocol'))
-        JMX.write_text(jmx_path, 'stringProp', 'HTTPSampler.domain', content.get('domain'))
-        JMX.write_text(jmx_path, 'stringProp', 'HTTPSampler.port', content.get('port'))
-        JMX.write_text(jmx_path, 'stringProp', 'HTTPSampler.method', content.get('method'))
-        JMX.write_text(jmx_path, 'stringProp', 'HTTPSampler.path', content.get('path'))
-        JMX.write_text(jmx_path, 'stringProp', 'HTTPSampler.contentEncoding', content.get('contentEncoding'))
-        JMX.write_text(jmx_path, 'boolProp', 'HTTPSampler.follow_redirects', 
-                       Common.MAPPING.get(content.get('follow_redirects')))
-        JMX.write_text(jmx_path, 'boolProp', 'HTTPSampler.auto_redirects', 
-                       Common.MAPPING.get(content.get('auto_redirects')))
-        JMX.write_text(jmx_path, 'boolProp', 'HTTPSampler.use_keepalive', 
-                       Common.MAPPING.get(content.get('use_keepalive')))
-        JMX.write_text(jmx_path, 'boolProp', 'HTTPSampler.DO_MULTIPART_POST', 
-                       Common.MAPPING.get(content.get('DO_MULTIPART_POST')))
-        JMX.write_text(jmx_path, 'boolProp', 'HTTPSampler.BROWSER_COMPATIBLE_MULTIPART', 
-                       Common.MAPPING.get(content.get('BROWSER_COMPATIBLE_MULTIPART')))
-        JMX.write_text(jmx_path, 'stringProp', 'Argument.value', content.get('body_data'))
+        document.write_testname('HTTPSamplerProxy','HTTPSamplerProxy', content.get('http_request_name'))
+        document.write_text('stringProp', 'HTTPSampler.protocol', content.get('protocol'))
+        document.write_text('stringProp', 'HTTPSampler.domain', content.get('domain'))
+        document.write_text('stringProp', 'HTTPSampler.port', content.get('port'))
+        document.write_text('stringProp', 'HTTPSampler.method', content.get('method'))
+        document.write_text('stringProp', 'HTTPSampler.path', content.get('path'))
+        document.write_text('stringProp', 'HTTPSampler.contentEncoding', content.get('contentEncoding'))
+        document.write_text('boolProp', 'HTTPSampler.follow_redirects', 
+                            Common.MAPPING.get(content.get('follow_redirects')))
+        document.write_text('boolProp', 'HTTPSampler.auto_redirects', 
+                            Common.MAPPING.get(content.get('auto_redirects')))
+        document.write_text('boolProp', 'HTTPSampler.use_keepalive', 
+                            Common.MAPPING.get(content.get('use_keepalive')))
+        document.write_text('boolProp', 'HTTPSampler.DO_MULTIPART_POST', 
+                            Common.MAPPING.get(content.get('DO_MULTIPART_POST')))
+        document.write_text('boolProp', 'HTTPSampler.BROWSER_COMPATIBLE_MULTIPART', 
+                            Common.MAPPING.get(content.get('BROWSER_COMPATIBLE_MULTIPART')))
+        document.write_text('stringProp', 'Argument.value', content.get('body_data'))
 
 
 class TestPlan(Base, Thread_Group, Samplers):
@@ -245,6 +249,7 @@ class TestPlan(Base, Thread_Group, Samplers):
         plan_path = Common.make_dir_file(dir=plan_dir, filename='plan.jmx', content=content)
         JMX.write_testname(jmx_path_or_name=os.path.join(self.root_dir, plan_name, 'plan.jmx'),
                                      tag='TestPlan', attr='TestPlan', testname=plan_name)
+        crud.save_plan(plan_name)
         logger.info('create plan success: {}'.format(plan_path))
         return plan_path
     
@@ -260,6 +265,7 @@ class TestPlan(Base, Thread_Group, Samplers):
         plan_path = Common.make_dir_file(dir=plan_dir, filename='plan.jmx', content=content)
         JMX.write_testname(jmx_path_or_name=os.path.join(self.root_dir, plan_name, 'plan.jmx'),
                                      tag='TestPlan', attr='TestPlan', testname=plan_name)
+        crud.save_plan(plan_name)
         logger.info('import plan success: {}'.format(plan_path))
         return plan_path
 
@@ -285,17 +291,23 @@ class TestPlan(Base, Thread_Group, Samplers):
     def edit(self, content: dict) -> None:
         """edit plan content"""
         jmx_path = os.path.join(self.root_dir, content['old_plan_name'], 'plan.jmx')
-        # edit plan info
-        Base.save(jmx_path, content)
-        Thread_Group.save(jmx_path, content)
-        Samplers.save(jmx_path, content)
+        # edit plan info, one parse and one write for all fields
+        with JMX.edit(jmx_path) as document:
+            Base.save(document, content)
+            Thread_Group.save(document, content)
+            Samplers.save(document, content)
         old_plan_dir = os.path.join(self.root_dir, content['old_plan_name'])
         new_plan_dir = os.path.join(self.root_dir, content['new_plan_name'])
         os.rename(old_plan_dir, new_plan_dir)
+        if content['old_plan_name'] != content['new_plan_name']:
+            crud.rename_plan(content['old_plan_name'], content['new_plan_name'])
+        else:
+            crud.save_plan(content['new_plan_name'])
 
     def remove(self, plan: str) -> None:
         """remove one plan"""
         shutil.rmtree(os.path.join(self.root_dir, plan), True)
+        crud.remove_plan(plan)
         logger.warning('remove {} success'.format(plan))
     
     def remove_all(self) -> None:
@@ -304,43 +316,51 @@ class TestPlan(Base, Thread_Group, Samplers):
         for plan in dirs:
             shutil.rmtree(os.path.join(self.root_dir, plan), True)
             logger.warning('remove {} success'.format(plan))
+        crud.remove_plan()
 
-    def get_all_plan(self) -> list:
-        """get all plan"""
-        dirs = os.listdir(self.root_dir)
-        dir_list = reversed(sorted(dirs, key=lambda x: os.path.getmtime(os.path.join(self.root_dir, x))))
-        plan_sorted_list = [plan for plan in dir_list if plan.__contains__('.') is False]
-        plan_list = list()
-        for plan in plan_sorted_list:
-            plan_dict = dict()
-            plan_dict['name'] = plan
-            plan_dict['checked'] =True if plan_sorted_list.index(plan) == 0 else False
-            plan_list.append(plan_dict)
-        return plan_list
+    def get_all_plan(self, page: int = 1, limit: Optional[int] = None) -> list:
+        """get all plan, the most recently modified first"""
+        _, plan_names = crud.query_plan_page(page, limit)
+        return [{'name': plan, 'checked': index == 0 and page <= 1} for index, plan in enumerate(plan_names)]
     
-    def checked_one_plan(self, plan_name) -> list:
+    def checked_one_plan(self, plan_name, page: int = 1, limit: Optional[int] = None) -> list:
         """checked one plan"""
-        dirs = os.listdir(self.root_dir)
-        dir_list = reversed(sorted(dirs, key=lambda x: os.path.getmtime(os.path.join(self.root_dir, x))))
-        plan_sorted_list = [plan for plan in dir_list if plan.__contains__('.') is False]
-        plan_list = list()
-        for plan in plan_sorted_list:
-            plan_dict = dict()
-            plan_dict['name'] = plan
-            plan_dict['checked'] =True if plan == plan_name else False
-            plan_list.append(plan_dict)
-        return plan_list
+        _, plan_names = crud.query_plan_page(page, limit)
+        return [{'name': plan, 'checked': plan == plan_name} for plan in plan_names]
     
+    def count_plan(self) -> int:
+        total, _ = crud.query_plan_page(1, 1)
+        return total
+
     def get_all_task(self, plan_name) -> dict:
         """get plan tasks list"""
         task_dict = dict()
-        log_dirs = os.path.join(self.root_dir, plan_name, 'log')
-        if os.path.exists(log_dirs):
-            task_dirs = os.listdir(log_dirs)
-            task_list = reversed(sorted(task_dirs, key=lambda x: os.path.getmtime(os.path.join(log_dirs, x))))
-            task_sorted_list = [task for task in task_list]
-            task_dict['tasks'] = task_sorted_list
-        else:
-            task_dict['tasks'] = []    
+        task_dict['tasks'] = crud.query_plan_tasks(plan_name)
         return task_dict
-        
\ No newline at end of file
+
+    def reconcile(self) -> None:
+        """bring the plan catalog and the tasks table in line with the plan directories"""
+        plans = dict()
+        for plan in os.listdir(self.root_dir):
+            plan_dir = os.path.join(self.root_dir, plan)
+            if plan.__contains__('.') is False and os.path.isdir(plan_dir):
+                plans[plan] = os.path.getmtime(plan_dir)
+        for plan in set(crud.query_plan_names()) - set(plans):
+            logger.warning('plan {} is not on disk anymore'.format(plan))
+            crud.remove_plan(plan)
+        known = set(crud.query_plan_names())
+        for plan, mtime in plans.items():
+            if plan not in known:
+                crud.save_plan(plan, mtime)
+            log_dir = os.path.join(self.root_dir, plan, 'log')
+            if os.path.exists(log_dir):
+                tasks = dict()
+                for task in os.listdir(log_dir):
+                    report_dir = os.path.join(self.root_dir, plan, 'report', task)
+                    # aggregate-only runs write no result.jtl, only their statistics
+                    status = 'Done' if any(os.path.exists(os.path.join(report_dir, name)) for name in (
+                        'result.jtl', 'result.jtl.gz', 'statistics.json', TaskAggregate.FILE)) else 'Error'
+                    stime = datetime.datetime.fromtimestamp(
+                        os.path.getmtime(os.path.join(log_dir, task))).strftime('%y-%m-%d %H:%M:%S')
+                    tasks[task] = (status, stime)
+                crud.sync_tasks(plan, tasks)
@@ -0,0 +1,254 @@
+import os
+import re
+import json
+import subprocess
+import psutil
+from typing import Optional
+from loguru import logger
+from webmeter.core.utils import Common, JMX
+from webmeter.core.sqlhandle import crud
+from webmeter.core.task import JTL_FIELDS
+
+
+class RunProfile(object):
+    """
+    jvm heap, gc and jmeter settings of a local run sized from the plan's thread count and the free
+    memory of this machine, handed to jmeter through JVM_ARGS, the only variable jmeter.sh passes on
+    after the run the gc log tells whether collections took enough time to distort the latencies
+    """
+
+    BASE_MB = 512
+    PER_THREAD_MB = 1.0
+    MIN_MB = 512
+    MAX_SHARE = 0.75  # of the memory available when the run starts
+    SMALL_MB = 1024  # below it one gc thread is enough and leaves the cpu to the samplers
+    LARGE_THREADS = 1000  # above it thread stacks are kept small
+    GC_FILE = 'gc.log'
+    SUSPECT_RATIO = 0.05  # share of the run spent in gc pauses
+    SUSPECT_PAUSE_MS = 1000
+
+    _java = None
+
+    @classmethod
+    def java_version(cls) -> int:
+        """major version of the java on PATH, 0 when there is none"""
+        if cls._java is None:
+            try:
+                output = subprocess.run(['java', '-version'], capture_output=True, text=True, timeout=30).stderr
+                match = re.search(r'version "(\d+)(?:\.(\d+))?', output)
+                major = int(match.group(1)) if match else 0
+                cls._java = int(match.group(2)) if major == 1 else major
+            except (OSError, subprocess.SubprocessError, ValueError):
+                cls._java = 0
+        return cls._java
+
+    @classmethod
+    def threads(cls, jmx_path: str) -> int:
+        """threads of every thread group with a fixed count"""
+        document = JMX.document(jmx_path)
+        return sum(int(element.text) for element in document.find_name('stringProp', 'ThreadGroup.num_threads')
+                   if (element.text or '').strip().isdigit())
+
+    @classmethod
+    def derive(cls, threads: int, available: Optional[int] = None) -> dict:
+        available = psutil.virtual_memory().available if available is None else available
+        ceiling = max(int(available / 1024 / 1024 * cls.MAX_SHARE), cls.MIN_MB)
+        wanted = int(cls.BASE_MB + threads * cls.PER_THREAD_MB)
+        heap = max(min(wanted, ceiling), cls.MIN_MB)
+        if heap < wanted:
+            logger.warning('{} threads want a {}m heap, only {}m fit in the free memory'.format(threads, wanted, heap))
+        if heap < cls.SMALL_MB:
+            gc = '-XX:+UseSerialGC'
+        else:
+            gc = '-XX:+UseG1GC -XX:MaxGCPauseMillis=100 -XX:G1ReservePercent=20'
+        jvm = list()
+        if threads > cls.LARGE_THREADS:
+            # stacks live outside the heap, 256k is plenty for samplers
+            jvm.append('-Xss256k')
+        return {
+            'threads': threads,
+            'available_mb': int(available / 1024 / 1024),
+            'heap_mb': heap,
+            'undersized': heap < wanted,
+            'heap': '-Xms{0}m -Xmx{0}m -XX:MaxMetaspaceSize=256m'.format(heap),
+            'gc': gc,
+            'jvm_args': ' '.join(jvm),
+            # lingering sampler threads must not keep the jvm of a finished run alive
+            'properties': ['-Jjmeterengine.force.system.exit=true']
+        }
+
+    @classmethod
+    def environ(cls, profile: dict, log_path: str) -> dict:
+        gc_log = os.path.join(log_path, cls.GC_FILE)
+        if cls.java_version() >= 9:
+            verbose = '-Xlog:gc:file={}:uptime'.format(gc_log)
+        else:
+            verbose = '-Xloggc:{} -XX:+PrintGCDetails'.format(gc_log)
+        # jmeter.sh sets JMETER_COMPLETE_ARGS, bin/jmeter then drops HEAP, GC_ALGO and VERBOSE_GC
+        # jmeter.bat still reads them, they repeat the same flags so its defaults cannot conflict
+        jvm_args = ' '.join(filter(None, [os.environ.get('JVM_ARGS'), profile['heap'], profile['gc'], verbose,
+                                          profile['jvm_args']]))
+        return dict(os.environ, HEAP=profile['heap'], GC_ALGO=profile['gc'], VERBOSE_GC=verbose, JVM_ARGS=jvm_args)
+
+    @classmethod
+    def pauses(cls, gc_log: str) -> list:
+        """pause times in ms, from unified (java 9+) or legacy gc logs"""
+        pauses = list()
+        unified = re.compile(r'Pause.*?(\d+(?:\.\d+)?)ms\s*$')
+        legacy = re.compile(r'\[(?:Full )?GC.*?(\d+(?:\.\d+)?) secs\]')
+        with open(file=gc_log, mode='r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                match = unified.search(line)
+                if match:
+                    pauses.append(float(match.group(1)))
+                    continue
+                match = legacy.search(line)
+                if match:
+                    pauses.append(float(match.group(1)) * 1000)
+        return pauses
+
+    @classmethod
+    def inspect(cls, profile: dict, log_path: str, duration: float) -> dict:
+        """add the gc pauses of the run to its profile and flag runs that gc distorted"""
+        gc_log = os.path.join(log_path, cls.GC_FILE)
+        if not os.path.exists(gc_log):
+            return profile
+        pauses = cls.pauses(gc_log)
+        total = sum(pauses)
+        ratio = total / 1000 / duration if duration else 0
+        profile.update({
+            'gc_pauses': len(pauses),
+            'gc_pause_ms': round(total, 3),
+            'gc_max_pause_ms': round(max(pauses), 3) if pauses else 0,
+            'gc_ratio': round(ratio, 4),
+            'suspect': ratio > cls.SUSPECT_RATIO or (max(pauses) if pauses else 0) > cls.SUSPECT_PAUSE_MS
+        })
+        if profile['suspect']:
+            logger.warning('gc took {:.1%} of the run, max pause {}ms, latencies are suspect'.format(
+                ratio, profile['gc_max_pause_ms']))
+        return profile
+
+
+class ResultProfile(object):
+    """
+    what a run of a plan writes per sample: every column (full), the columns webmeter and jmeter's
+    dashboard read (lean), one in rate samples (sampled, lite runs only) or no samples at all (aggregate)
+    the exact totals of sampled and aggregate runs come from the summariser lines of result.log
+    """
+
+    MODES = ('full', 'lean', 'sampled', 'aggregate')
+    DEFAULTS = {'mode': 'full', 'rate': 10}
+    # saveservice switches a lean result.jtl turns off, and the columns they remove
+    LEAN = {'data_type': 'dataType', 'url': 'URL', 'idle_time': 'IdleTime', 'subresults': None}
+    SUMMARY = re.compile(r'summary ([+=])\s+(\d+) in (\d+):(\d+):(\d+) =\s+[\d.]+/s Avg:\s+(-?\d+) '
+                         r'Min:\s+(-?\d+) Max:\s+(-?\d+) Err:\s+(\d+)')
+
+    @classmethod
+    def check(cls, profile: dict) -> dict:
+        mode = profile.get('mode') or cls.DEFAULTS['mode']
+        if mode not in cls.MODES:
+            raise Exception('result profile must be one of {}'.format(', '.join(cls.MODES)))
+        rate = int(profile.get('rate') or cls.DEFAULTS['rate'])
+        if rate < 1:
+            raise Exception('rate must be at least 1')
+        return {'mode': mode, 'rate': rate}
+
+    @classmethod
+    def check_model(cls, profile: dict, model: str) -> dict:
+        """jmeter cannot thin its own sample stream, only the lite engine writes sampled results"""
+        if profile['mode'] == 'sampled' and model != 'lite':
+            raise Exception('the sampled result profile needs the lite engine, '
+                            'jmeter writes every sample: choose lean or aggregate for {} runs'.format(model))
+        return profile
+
+    @classmethod
+    def config(cls, plan: str) -> dict:
+        content = crud.query_plan_results(plan)
+        return cls.check(json.loads(content)) if content else dict(cls.DEFAULTS)
+
+    @classmethod
+    def set_config(cls, plan: str, content: dict, model: Optional[str] = None) -> dict:
+        profile = cls.check(dict(cls.config(plan), **{key: value for key, value in content.items()
+                                                      if key in cls.DEFAULTS and value is not None}))
+        if model is not None:
+            cls.check_model(profile, model)
+        crud.save_plan_results(plan, json.dumps(profile))
+        return profile
+
+    @classmethod
+    def fields(cls, profile: dict) -> list:
+        """result.jtl columns written under the profile"""
+        if profile['mode'] == 'full':
+            return list(JTL_FIELDS)
+        dropped = set(cls.LEAN.values())
+        return [field for field in JTL_FIELDS if field not in dropped]
+
+    @classmethod
+    def properties(cls, profile: dict, remote: bool = False) -> list:
+        """saveservice properties of a jmeter run, also sent to the jmeter-servers of a remote run"""
+        settings = {'output_format': 'csv', 'print_field_names': 'true', 'timestamp_format': 'ms'}
+        # always explicit, a warm jmeter-server keeps the global properties of the previous run
+        settings.update({name: 'true' if profile['mode'] == 'full' else 'false' for name in cls.LEAN})
+        cls.check_model(profile, 'remote' if remote else 'local')
+        properties = ['-Jjmeter.save.saveservice.{}={}'.format(name, value) for name, value in settings.items()]
+        if remote:
+            properties.extend(['-Gjmeter.save.saveservice.{}={}'.format(name, value) for name, value in settings.items()])
+        if profile['mode'] in ('sampled', 'aggregate'):
+            properties.append('-Jsummariser.name=summary')
+        return properties
+
+    @classmethod
+    def summary(cls, log_path: str) -> Optional[dict]:
+        """totals of the summariser lines of a run, None when it logged none"""
+        if not os.path.exists(log_path):
+            return None
+        total = None
+        interval = list()
+        with Common.open_file(log_path, mode='r') as f:
+            for line in f:
+                match = cls.SUMMARY.search(line)
+                if not match:
+                    continue
+                sign, count, hours, minutes, seconds, mean, low, high, errors = match.groups()
+                item = {'count': int(count), 'seconds': int(hours) * 3600 + int(minutes) * 60 + int(seconds),
+                        'mean': int(mean), 'min': int(low), 'max': int(high), 'errors': int(errors)}
+                if sign == '=':
+                    # the running total covers every interval logged before it
+                    total, interval = item, list()
+                elif item['count']:
+                    interval.append(item)
+        items = ([total] if total else []) + interval
+        count = sum(item['count'] for item in items)
+        if not count:
+            return None
+        return {
+            'count': count,
+            'errors': sum(item['errors'] for item in items),
+            'seconds': sum(item['seconds'] for item in items),
+            'mean': round(sum(item['mean'] * item['count'] for item in items) / count, 2),
+            'min': min(item['min'] for item in items if item['count']),
+            'max': max(item['max'] for item in items if item['count'])
+        }
+
+    @classmethod
+    def statistics(cls, summary: dict, statistics: Optional[dict] = None) -> dict:
+        """
+        statistics.json of a run from its summary, the statistics of a sampled run are scaled
+        up to the summary and keep the response times estimated from its samples
+        """
+        total = {'transaction': 'Total', 'sampleCount': summary['count'], 'errorCount': summary['errors'],
+                 'errorPct': round(summary['errors'] * 100 / summary['count'], 2)}
+        if statistics:
+            scale = summary['count'] / statistics['Total']['sampleCount']
+            for item in statistics.values():
+                item['sampleCount'] = int(round(item['sampleCount'] * scale))
+                item['errorCount'] = int(round(item['errorCount'] * scale))
+                for key in ('throughput', 'receivedKBytesPerSec', 'sentKBytesPerSec'):
+                    item[key] = item[key] * scale
+            statistics['Total'].update(total)
+            return statistics
+        total.update({'meanResTime': summary['mean'], 'medianResTime': None, 'minResTime': summary['min'],
+                      'maxResTime': summary['max'], 'pct1ResTime': None, 'pct2ResTime': None, 'pct3ResTime': None,
+                      'throughput': summary['count'] / summary['seconds'] if summary['seconds'] else 0.0,
+                      'receivedKBytesPerSec': None, 'sentKBytesPerSec': None})
+        return {'Total': total}
@@ -0,0 +1,120 @@
+import asyncio
+import numpy as np
+from typing import Optional
+from loguru import logger
+from webmeter.core.sqlhandle import crud
+from webmeter.core.task import JTLColumns, TaskBase
+from webmeter.core.live import LiveMetrics
+
+
+class TaskRollup(object):
+    """
+    per second, per label aggregates of a finished task kept in the rollups table,
+    the over time charts merge them in sql instead of scanning result.jtl, a running task is
+    charted from the per second aggregates of its live tailer
+    rows with label None hold every label of that second together
+    """
+
+    FIELDS = {'elapsed': 'elapsed', 'latency': 'Latency', 'connect': 'Connect'}
+    OVER_TIME_POINTS = 1000
+    PERCENTILES = (50, 90, 95, 99)
+    UNFINISHED = ('Queued', 'Running')
+
+    @classmethod
+    def build(cls, task: str, columns: JTLColumns) -> list:
+        """rollup rows of one column cache, the total of a second is grouped under label code -1"""
+        if not len(columns):
+            return []
+        second = np.asarray(columns['timeStamp']) // 1000 * 1000
+        code = np.asarray(columns['label'], dtype='int64')
+        second = np.concatenate([second, second])
+        code = np.concatenate([code, np.full(len(code), -1, dtype='int64')])
+        groups, group = np.unique(np.stack([second, code]), axis=1, return_inverse=True)
+        group = group.ravel()
+        count = np.bincount(group)
+        first = np.r_[0, np.cumsum(count)[:-1]]
+        values = {
+            'count': count,
+            'errors': np.bincount(group, weights=~np.tile(np.asarray(columns['success']), 2)),
+            'bytes': np.bincount(group, weights=np.tile(np.asarray(columns['bytes']), 2)),
+            'sent_bytes': np.bincount(group, weights=np.tile(np.asarray(columns['sentBytes']), 2))
+        }
+        for name, field in cls.FIELDS.items():
+            y = np.tile(np.asarray(columns[field], dtype='int64'), 2)
+            y = y[np.lexsort((y, group))]
+            values['{}_min'.format(name)] = y[first]
+            values['{}_max'.format(name)] = y[first + count - 1]
+            values['{}_mean'.format(name)] = np.round(np.add.reduceat(y, first) / count, 2)
+            for percentile in cls.PERCENTILES:
+                # nearest rank, like the live tailer
+                values['{}_p{}'.format(name, percentile)] = y[first + np.ceil(count * percentile / 100).astype('int64') - 1]
+        labels = columns.strings['label']
+        rows = [{'task': task, 'second': s, 'label': labels[c] if c >= 0 else None}
+                for s, c in zip(groups[0].tolist(), groups[1].tolist())]
+        for key, value in values.items():
+            for row, item in zip(rows, value.tolist()):
+                row[key] = int(item) if key in ('count', 'errors', 'bytes', 'sent_bytes') else item
+        return rows
+
+    @classmethod
+    def save(cls, plan: str, task: str) -> int:
+        rows = cls.build(task, TaskBase.read_result_columns(plan, task))
+        logger.info('save {} rollups of {}'.format(len(rows), task))
+        return crud.save_rollups(task, rows)
+
+    @classmethod
+    def ensure(cls, plan: str, task: str) -> bool:
+        """rollups of a finished task, built on first use for tasks that ran before the table existed"""
+        if crud.has_rollups(task):
+            return True
+        status = (crud.query_task_one(plan, task) or {}).get('status')
+        if status is None or status in cls.UNFINISHED:
+            return False
+        return cls.save(plan, task) > 0
+
+    @classmethod
+    def initOverTime(cls, task: str, name: str, start: Optional[int] = None, end: Optional[int] = None,
+                     points: int = OVER_TIME_POINTS, label: Optional[str] = None) -> list:
+        """
+        at most points buckets of whole seconds over [start, end], read from the rollups
+        percentiles of several seconds cannot be merged, a bucket reports p95_mean, the count
+        weighted mean of its per second p95, which is the p95 itself only for one second buckets
+        """
+        first, last = crud.query_rollup_range(task)
+        start = None if start is None else int(start) // 1000 * 1000
+        end = None if end is None else int(end)
+        begin = first if start is None else start
+        stop = last if end is None else min(end, last)
+        if stop < begin:
+            return []
+        interval = max(-(-(stop - begin + 1000) // points), 1000)
+        interval = -(-interval // 1000) * 1000
+        rows = crud.query_rollup_over_time(task, name, label, start, end, begin, interval)
+        return [{'x': begin + bucket * interval, 'y': round(mean, 2), 'min': low, 'mean': round(mean, 2),
+                 'max': high, 'p95_mean': round(float(p95_mean), 2), 'count': count}
+                for bucket, low, mean, high, p95_mean, count in rows]
+
+    @classmethod
+    async def overTime(cls, plan: str, task: str, name: str, start: Optional[int] = None,
+                       end: Optional[int] = None, points: Optional[int] = None,
+                       label: Optional[str] = None) -> list:
+        points = max(int(points or cls.OVER_TIME_POINTS), 1)
+        if await asyncio.to_thread(cls.ensure, plan, task):
+            return await asyncio.to_thread(cls.initOverTime, task, name, start, end, points, label)
+        # still running, the rollups are written when it finishes
+        return await LiveMetrics.over_time(plan, task, cls.FIELDS[name], start, end, points, label)
+
+    @classmethod
+    async def initResponseOverTime(cls, plan: str, task: str, start: Optional[int] = None, end: Optional[int] = None,
+                                   points: Optional[int] = None, label: Optional[str] = None) -> list:
+        return await cls.overTime(plan, task, 'elapsed', start, end, points, label)
+
+    @classmethod
+    async def initConnectOverTime(cls, plan: str, task: str, start: Optional[int] = None, end: Optional[int] = None,
+                                  points: Optional[int] = None, label: Optional[str] = None) -> list:
+        return await cls.overTime(plan, task, 'connect', start, end, points, label)
+
+    @classmethod
+    async def initLatencyOverTime(cls, plan: str, task: str, start: Optional[int] = None, end: Optional[int] = None,
+                                  points: Optional[int] = None, label: Optional[str] = None) -> list:
+        return await cls.overTime(plan, task, 'latency', start, end, points, label)
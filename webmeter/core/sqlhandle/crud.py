@@ -1,8 +1,8 @@
 from typing import Optional
 from loguru import logger
-import os, shutil, datetime
+import os, shutil, datetime, json
+from sqlalchemy import func
 from webmeter.core.sqlhandle import models, schemas, database
-from webmeter.core.plan import TestPlan
 
 def create_task(tasks: dict):
     with database.dbConnect() as session:
@@ -11,10 +11,12 @@ def create_task(tasks: dict):
         if(result is None):
             db_task = models.Task(plan=tasks['plan'],task=tasks['task'],
                                   model=tasks['model'], threads=tasks['threads'],
+                                  status=tasks.get('status', 'Running'),
+                                  priority=tasks.get('priority', 0),
+                                  content=tasks.get('content'),
                                   stime=cur_time, etime=cur_time)
             session.add(db_task)
             session.commit()
-            session.refresh(db_task)
         else:
             raise Exception('{} is existed'.format(result.task))    
 
@@ -23,14 +25,13 @@ def update_task(tasks: dict):
         cur_time = datetime.datetime.now().strftime('%y-%m-%d %H:%M:%S')
         result = session.query(models.Task).filter(models.Task.task == tasks['task']).first()
         if(result):
-            result.success_num = tasks.get('success_num')
-            result.fail_num = tasks.get('fail_num')
-            result.status = tasks.get('status')
+            for key, value in tasks.items():
+                if key != 'task':
+                    setattr(result, key, value)
             result.etime = cur_time
             session.commit()
-            session.refresh(result)
         else:
-            raise Exception('{} is not existed'.format(result.task))
+            raise Exception('{} is not existed'.format(tasks['task']))
         
 def query_task_one(plan: str, task: str) -> dict:
     with database.dbConnect() as session:
@@ -46,6 +47,15 @@ def query_task_one(plan: str, task: str) -> dict:
         result_dict['fail_num'] = results.fail_num
         result_dict['stime'] = results.stime
         result_dict['etime'] = results.etime
+        result_dict['pid'] = results.pid
+        result_dict['exit_code'] = results.exit_code
+        result_dict['duration'] = results.duration
+        result_dict['priority'] = results.priority
+        result_dict['warm'] = results.warm
+        result_dict['startup'] = results.startup
+        result_dict['profile'] = json.loads(results.profile) if results.profile else None
+        result_dict['suspect'] = results.suspect
+        result_dict['results'] = json.loads(results.results) if results.results else None
         return result_dict
 
 def query_task_all() -> list:
@@ -55,31 +65,187 @@ def query_task_all() -> list:
                         'model': result.model, 'status': result.status,
                         'threads': result.threads, 'success_num': result.success_num,
                         'fail_num': result.fail_num, 'stime': result.stime,
-                        'etime': result.etime}  for  result in results]
+                        'etime': result.etime, 'pid': result.pid,
+                        'exit_code': result.exit_code, 'duration': result.duration,
+                        'warm': result.warm, 'startup': result.startup,
+                        'suspect': result.suspect}  for  result in results]
         return result_list
 
+def query_task_running() -> list:
+    with database.dbConnect() as session:
+        results = session.query(models.Task).filter(models.Task.status == 'Running').all()
+        return [{'plan': result.plan, 'task': result.task, 'pid': result.pid} for result in results]
+
+def query_task_counts() -> dict:
+    """number of tasks per status"""
+    with database.dbConnect() as session:
+        results = session.query(models.Task.status, func.count(models.Task.id)).group_by(models.Task.status).all()
+        return {status: count for status, count in results}
+
+def query_startup_stats() -> dict:
+    """mean startup of finished local runs, keyed by whether they ran on the warm jmeter-server"""
+    with database.dbConnect() as session:
+        results = session.query(models.Task.warm, func.avg(models.Task.startup), func.count(models.Task.id)).filter(
+            models.Task.model == 'local', models.Task.status == 'Done',
+            models.Task.startup.isnot(None)).group_by(models.Task.warm).all()
+        return {bool(warm): (startup, count) for warm, startup, count in results}
+
+def query_task_queued() -> list:
+    with database.dbConnect() as session:
+        results = session.query(models.Task).filter(models.Task.status == 'Queued').order_by(
+            models.Task.priority.desc(), models.Task.id).all()
+        return [{'plan': result.plan, 'task': result.task, 'model': result.model,
+                 'threads': result.threads, 'priority': result.priority,
+                 'stime': result.stime, 'content': result.content} for result in results]
+
 def remove_task_one(plan: str, task: str):
     logger.warning('remove task data : {}'.format(task))
     TASK_LOG_DIR = os.path.join(os.getcwd(), 'webmeter', plan, 'log', task)
     TASK_REPORT_DIR = os.path.join(os.getcwd(), 'webmeter', plan, 'report', task)
+    TASK_CACHE_DIR = os.path.join(os.getcwd(), 'webmeter', plan, 'cache', task)
     with database.dbConnect() as session:
         session.query(models.Task).filter(models.Task.plan == plan,
                                            models.Task.task == task).delete()
+        session.query(models.Rollup).filter(models.Rollup.task == task).delete()
 
     if os.path.exists(TASK_LOG_DIR):
         shutil.rmtree(TASK_LOG_DIR, True)
 
     if os.path.exists(TASK_REPORT_DIR):
         shutil.rmtree(TASK_REPORT_DIR, True)
+
+    if os.path.exists(TASK_CACHE_DIR):
+        shutil.rmtree(TASK_CACHE_DIR, True)
         
 def remove_task_all():
     logger.warning('remove all task datas')
     with database.dbConnect() as session:
         session.query(models.Task).delete()
-    plan = TestPlan()
-    for item in plan.get_all_plan():
-        shutil.rmtree(os.path.join(plan.root_dir, item.get('name'), 'log'), True)
-        shutil.rmtree(os.path.join(plan.root_dir, item.get('name'), 'report'), True)    
+        session.query(models.Rollup).delete()
+    root_dir = os.path.join(os.getcwd(), 'webmeter')
+    for name in query_plan_names():
+        shutil.rmtree(os.path.join(root_dir, name, 'log'), True)
+        shutil.rmtree(os.path.join(root_dir, name, 'report'), True)    
+        shutil.rmtree(os.path.join(root_dir, name, 'cache'), True)
+
+def query_plan_tasks(plan: str) -> list:
+    """tasks of a plan that were started, newest first"""
+    with database.dbConnect() as session:
+        results = session.query(models.Task.task).filter(
+            models.Task.plan == plan, models.Task.status.notin_(['Queued', 'Cancelled'])).order_by(
+            models.Task.stime.desc(), models.Task.id.desc()).all()
+        return [result.task for result in results]
+
+def sync_tasks(plan: str, tasks: dict):
+    """add the tasks found on disk but missing in the tasks table, tasks maps name to status"""
+    with database.dbConnect() as session:
+        existed = {result.task for result in session.query(models.Task.task).filter(
+            models.Task.task.in_(list(tasks))).all()}
+        for task, (status, stime) in tasks.items():
+            if task not in existed:
+                session.add(models.Task(plan=plan, task=task, model='local', status=status,
+                                        stime=stime, etime=stime))
+        session.commit()
+
+def save_plan(name: str, mtime: Optional[float] = None):
+    """add a plan to the catalog or mark it as modified"""
+    with database.dbConnect() as session:
+        mtime = datetime.datetime.now().timestamp() if mtime is None else mtime
+        result = session.query(models.Plan).filter(models.Plan.name == name).first()
+        if(result is None):
+            session.add(models.Plan(name=name, mtime=mtime,
+                                    ctime=datetime.datetime.now().strftime('%y-%m-%d %H:%M:%S')))
+        else:
+            result.mtime = mtime
+        session.commit()
+
+def rename_plan(old_name: str, new_name: str):
+    with database.dbConnect() as session:
+        session.query(models.Plan).filter(models.Plan.name == old_name).update(
+            {'name': new_name, 'mtime': datetime.datetime.now().timestamp()})
+        session.query(models.Task).filter(models.Task.plan == old_name).update({'plan': new_name})
+        session.commit()
+
+def remove_plan(name: Optional[str] = None):
+    """remove one plan from the catalog, all plans when name is None"""
+    with database.dbConnect() as session:
+        query = session.query(models.Plan)
+        if name is not None:
+            query = query.filter(models.Plan.name == name)
+        query.delete()
+
+def query_plan_results(name: str) -> Optional[str]:
+    with database.dbConnect() as session:
+        result = session.query(models.Plan.results).filter(models.Plan.name == name).first()
+        return None if result is None else result.results
+
+def save_plan_results(name: str, results: str):
+    with database.dbConnect() as session:
+        result = session.query(models.Plan).filter(models.Plan.name == name).first()
+        if(result is None):
+            session.add(models.Plan(name=name, mtime=datetime.datetime.now().timestamp(), results=results,
+                                    ctime=datetime.datetime.now().strftime('%y-%m-%d %H:%M:%S')))
+        else:
+            result.results = results
+        session.commit()
+
+def query_plan_names() -> list:
+    with database.dbConnect() as session:
+        return [result.name for result in session.query(models.Plan.name).order_by(models.Plan.mtime.desc()).all()]
+
+def query_plan_page(page: int = 1, limit: Optional[int] = None) -> tuple:
+    """(total, names) of one page of plans, the most recently modified first"""
+    with database.dbConnect() as session:
+        query = session.query(models.Plan.name).order_by(models.Plan.mtime.desc(), models.Plan.id.desc())
+        total = query.count()
+        if limit:
+            query = query.offset((max(page, 1) - 1) * limit).limit(limit)
+        return total, [result.name for result in query.all()]
+
+def create_monitors(monitors: list) -> int:
+    return database.bulk_insert(models.Monitor.__table__, monitors)
+
+def save_rollups(task: str, rollups: list) -> int:
+    """replace the per second rollups of a task"""
+    return database.bulk_insert(models.Rollup.__table__, rollups, replace=models.Rollup.task == task)
+
+def has_rollups(task: str) -> bool:
+    with database.dbConnect() as session:
+        return session.query(models.Rollup.id).filter(models.Rollup.task == task).first() is not None
+
+def query_rollup_over_time(task: str, field: str, label: Optional[str] = None, start: Optional[int] = None,
+                           end: Optional[int] = None, begin: int = 0, interval: int = 1000) -> list:
+    """merge the rollups of one label into buckets of interval ms counted from begin, with the count weighted mean of the per second p95"""
+    count = models.Rollup.count
+    low = getattr(models.Rollup, '{}_min'.format(field))
+    mean = getattr(models.Rollup, '{}_mean'.format(field))
+    high = getattr(models.Rollup, '{}_max'.format(field))
+    p95 = getattr(models.Rollup, '{}_p95'.format(field))
+    bucket = ((models.Rollup.second - begin) // interval).label('bucket')
+    with database.dbConnect() as session:
+        query = session.query(bucket, func.min(low), func.sum(mean * count) / func.sum(count),
+                              func.max(high), func.sum(p95 * count) / func.sum(count), func.sum(count)).filter(
+            models.Rollup.task == task,
+            models.Rollup.label.is_(None) if label is None else models.Rollup.label == label)
+        if start is not None:
+            query = query.filter(models.Rollup.second >= start)
+        if end is not None:
+            query = query.filter(models.Rollup.second <= end)
+        return query.group_by(bucket).order_by(bucket).all()
+
+def query_rollup_range(task: str) -> tuple:
+    """first and last second of the rollups of a task"""
+    with database.dbConnect() as session:
+        return session.query(func.min(models.Rollup.second), func.max(models.Rollup.second)).filter(
+            models.Rollup.task == task).one()
+
+def query_monitor_task(task: str) -> list:
+    with database.dbConnect() as session:
+        results = session.query(models.Monitor).filter(models.Monitor.task == task).order_by(
+            models.Monitor.timestamp).all()
+        return [{'machine': result.machine, 'time': result.timestamp, 'cpu': result.cpu,
+                 'memory': result.memory, 'network': result.network, 'disk_read': result.disk_read,
+                 'disk_write': result.disk_write} for result in results]
 
 def create_key(keys: schemas.keyCreate):
     with database.dbConnect() as session:
@@ -88,7 +254,6 @@ def create_key(keys: schemas.keyCreate):
             db_key = models.Key(key=keys.key, value=keys.value)
             session.add(db_key)
             session.commit()
-            session.refresh(db_key)
 
 def update_value(keys: schemas.keyUpdate):
     with database.dbConnect() as session:
@@ -102,4 +267,18 @@ def update_value(keys: schemas.keyUpdate):
 def query_key(keys: schemas.keyQuery):
     with database.dbConnect() as session:
         result = session.query(models.Key).filter(models.Key.key == keys.key).first()
-        return result.value   
\ No newline at end of file
+        return result.value
+
+def query_value(key: str, default: Optional[str] = None) -> Optional[str]:
+    with database.dbConnect() as session:
+        result = session.query(models.Key).filter(models.Key.key == key).first()
+        return default if result is None else result.value
+
+def save_value(key: str, value: str):
+    with database.dbConnect() as session:
+        result = session.query(models.Key).filter(models.Key.key == key).first()
+        if(result is None):
+            session.add(models.Key(key=key, value=value))
+        else:
+            result.value = value
+        session.commit()
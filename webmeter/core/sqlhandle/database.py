@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, delete, event, inspect, insert, text
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from contextlib import contextmanager
@@ -9,13 +10,63 @@ from webmeter.core.utils import Common
 SQL_DIR = Common.make_dir(os.path.join(os.getcwd(), 'webmeter'))
 SQLALCHEMY_DATABASE_URL = "sqlite:///{}/app.db".format(SQL_DIR)
 
+# wal lets the ui, the live monitor and the sampler read while a task is written,
+# busy_timeout makes concurrent writers wait for the lock instead of failing
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+    'cache_size': -16000
+}
+
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 5},
+    poolclass=QueuePool, pool_size=5, max_overflow=10, pool_pre_ping=True
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+@event.listens_for(engine, 'connect')
+def set_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for key, value in PRAGMAS.items():
+        cursor.execute('PRAGMA {}={}'.format(key, value))
+    cursor.close()
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 Base = declarative_base()
 
+def upgrade_tables():
+    """add columns introduced by newer versions to tables of an existing app.db"""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existed = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existed:
+                    logger.info('add column {}.{}'.format(table.name, column.name))
+                    connection.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        table.name, column.name, column.type.compile(engine.dialect))))
+            for index in inspector.get_indexes(table.name):
+                column = table.columns.get(index['column_names'][0])
+                if index['unique'] and len(index['column_names']) == 1 and column is not None and not column.unique:
+                    logger.info('drop unique constraint of {}.{}'.format(table.name, column.name))
+                    connection.execute(text('DROP INDEX {}'.format(index['name'])))
+                    connection.execute(text('CREATE INDEX {} ON {} ({})'.format(index['name'], table.name, column.name)))
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+def bulk_insert(table, rows: list, chunk: int = 500, replace=None) -> int:
+    """insert many rows with one executemany per chunk, replace deletes the matching rows first in the same transaction"""
+    with engine.begin() as connection:
+        if replace is not None:
+            connection.execute(delete(table).where(replace))
+        for i in range(0, len(rows), chunk):
+            connection.execute(insert(table), rows[i:i + chunk])
+    return len(rows)
+
 @contextmanager
 def dbConnect():
     session = SessionLocal()
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, Integer, String, DateTime, Float
+from sqlalchemy import Boolean, Column, Integer, String, DateTime, Float, Index
 from webmeter.core.sqlhandle.database import Base
 
 
@@ -8,7 +8,7 @@ class Task(Base):
     id = Column(Integer, primary_key=True, index=True)
     plan = Column(String, index=True)
     task = Column(String, index=True, unique=True)
-    model = Column(String, index=True, default='local') #local | remote
+    model = Column(String, index=True, default='local') #local | remote | lite
     master_host = Column(String, index=True, default=None)
     slave_host = Column(String, index=True, default=None)
     success_num = Column(Integer, index=True, default=0)
@@ -17,18 +17,74 @@ class Task(Base):
     status = Column(String, index=True, default='Running')
     stime = Column(String, index=True)
     etime = Column(String, index=True)
+    pid = Column(Integer, default=None)
+    exit_code = Column(Integer, default=None)
+    duration = Column(Float, default=None)
+    priority = Column(Integer, default=0)
+    content = Column(String, default=None) #run request of a queued task
+    warm = Column(Boolean, default=False) #sent to the warm local jmeter-server
+    startup = Column(Float, default=None) #seconds from start to the first sample
+    profile = Column(String, default=None) #jvm heap/gc profile and gc pauses, json
+    suspect = Column(Boolean, default=False) #gc pauses may have inflated the latencies
+    results = Column(String, default=None) #result profile of the run, json
+
+class Plan(Base):
+    __tablename__ = "plans"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, index=True, unique=True)
+    mtime = Column(Float, index=True, default=0)
+    ctime = Column(String, index=True, default=None)
+    results = Column(String, default=None) #result profile of its runs, json
 
 class Monitor(Base):
     __tablename__ = "monitor"
 
     id = Column(Integer, primary_key=True, index=True)
-    machine = Column(String, index=True, unique=True)
-    task =  Column(String, index=True, unique=True)
+    machine = Column(String, index=True)
+    task =  Column(String, index=True)
     cpu = Column(Float, index=True, default=0)
     memory = Column(Float, index=True, default=0)
-    network = Column(Float, index=True, default=0)
+    network = Column(Float, index=True, default=0) #KB/s sent and received
+    disk_read = Column(Float, default=0) #KB/s
+    disk_write = Column(Float, default=0) #KB/s
+    timestamp = Column(Integer, index=True, default=None) #ms
     ctime = Column(String, index=True, default=None)
 
+class Rollup(Base):
+    __tablename__ = "rollups"
+    __table_args__ = (Index('ix_rollups_task_label_second', 'task', 'label', 'second'),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    task = Column(String)
+    label = Column(String, default=None) #None for all labels together
+    second = Column(Integer, default=None) #ms at the start of the second
+    count = Column(Integer, default=0)
+    errors = Column(Integer, default=0)
+    bytes = Column(Integer, default=0)
+    sent_bytes = Column(Integer, default=0)
+    elapsed_min = Column(Integer, default=None)
+    elapsed_mean = Column(Float, default=None)
+    elapsed_max = Column(Integer, default=None)
+    elapsed_p50 = Column(Integer, default=None)
+    elapsed_p90 = Column(Integer, default=None)
+    elapsed_p95 = Column(Integer, default=None)
+    elapsed_p99 = Column(Integer, default=None)
+    latency_min = Column(Integer, default=None)
+    latency_mean = Column(Float, default=None)
+    latency_max = Column(Integer, default=None)
+    latency_p50 = Column(Integer, default=None)
+    latency_p90 = Column(Integer, default=None)
+    latency_p95 = Column(Integer, default=None)
+    latency_p99 = Column(Integer, default=None)
+    connect_min = Column(Integer, default=None)
+    connect_mean = Column(Float, default=None)
+    connect_max = Column(Integer, default=None)
+    connect_p50 = Column(Integer, default=None)
+    connect_p90 = Column(Integer, default=None)
+    connect_p95 = Column(Integer, default=None)
+    connect_p99 = Column(Integer, default=None)
+
 class Key(Base):
     __tablename__ = "key"
     
@@ -1,42 +1,332 @@
 from loguru import logger
-import json, os
-from typing import Optional
+import csv, gzip, json, mmap, os, sys, threading
+import numpy as np
+from array import array
+from collections import namedtuple
+from contextlib import contextmanager
+from itertools import chain
+from typing import Iterator, Optional
 from webmeter.core.utils import Common
+from webmeter.core.metrics import ServerMetrics
 from webmeter.core.sqlhandle import crud
 
+JTL_FIELDS = ('timeStamp', 'elapsed', 'label', 'responseCode', 'responseMessage',
+              'threadName', 'dataType', 'success', 'failureMessage', 'bytes',
+              'sentBytes', 'grpThreads', 'allThreads', 'URL', 'Latency',
+              'IdleTime', 'Connect')
+
+JTLSample = namedtuple('JTLSample', JTL_FIELDS)
+
+
+class JTLReader(object):
+    """stream result.jtl samples by its csv header"""
+
+    INT_FIELDS = frozenset(('timeStamp', 'elapsed', 'bytes', 'sentBytes', 'grpThreads',
+                            'allThreads', 'Latency', 'IdleTime', 'Connect'))
+    INTERN_FIELDS = frozenset(('label', 'responseCode', 'responseMessage', 'threadName', 'dataType'))
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.position = 0
+
+    @staticmethod
+    def to_int(value: str) -> int:
+        try:
+            return int(value)
+        except ValueError:
+            return 0
+
+    @staticmethod
+    def to_bool(value: str) -> bool:
+        return value == 'true'
+
+    @staticmethod
+    def to_str(value: str) -> str:
+        return sys.intern(value)
+
+    @classmethod
+    def converter(cls, field: str):
+        if field in cls.INT_FIELDS:
+            return cls.to_int
+        if field == 'success':
+            return cls.to_bool
+        if field in cls.INTERN_FIELDS:
+            return cls.to_str
+        return str
+
+    @classmethod
+    def default(cls, field: str) -> any:
+        if field in cls.INT_FIELDS:
+            return 0
+        if field == 'success':
+            return False
+        return ''
+
+    def lines(self, f) -> Iterator[str]:
+        """decode binary lines, tracking the byte position reached in the file"""
+        for raw in f:
+            self.position += len(raw)
+            yield raw.decode('utf-8')
+
+    @classmethod
+    def columns(cls, header: list) -> list:
+        index = {name: i for i, name in enumerate(header)}
+        return [(index.get(field), cls.converter(field), cls.default(field)) for field in JTL_FIELDS]
+
+    @staticmethod
+    def sample(columns: list, row: list) -> JTLSample:
+        return JTLSample._make([default if i is None else convert(row[i])
+                                for i, convert, default in columns])
+
+    def records(self) -> Iterator[tuple]:
+        """yield (byte offset, sample) for every complete record"""
+        self.position = 0
+        with Common.open_file(self.file_path, mode='rb') as f:
+            reader = csv.reader(self.lines(f))
+            header = next(reader, None)
+            if header is None:
+                return
+            rows = reader
+            offset = self.position
+            if 'timeStamp' not in header:
+                # jtl written without field names, fall back to jmeter's default column order
+                rows = chain([header], reader)
+                header = JTL_FIELDS[:len(header)]
+                offset = 0
+            columns = self.columns(header)
+            width = len(header)
+            for row in rows:
+                if len(row) >= width:
+                    # shorter rows are incomplete lines jmeter is still writing
+                    yield offset, self.sample(columns, row)
+                offset = self.position
+
+    def __iter__(self) -> Iterator[JTLSample]:
+        for _, sample in self.records():
+            yield sample
+
+    @contextmanager
+    def seekable(self):
+        """the jtl mapped in memory, or its decompressing stream which only seeks forward cheaply"""
+        if self.file_path.endswith('.gz'):
+            with gzip.open(self.file_path, mode='rb') as f:
+                yield f
+        else:
+            with open(file=self.file_path, mode='rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+
+    def read_at(self, offsets: list) -> list:
+        """random access to the records starting at the given byte offsets"""
+        if not len(offsets):
+            return []
+        with ServerMetrics.phase('read'), self.seekable() as f:
+            lines = iter(lambda: f.readline().decode('utf-8'), '')
+            header = next(csv.reader(lines))
+            if 'timeStamp' not in header:
+                header = JTL_FIELDS[:len(header)]
+            columns = self.columns(header)
+            samples = [None] * len(offsets)
+            read = dict()
+            # visit the offsets in file order, a compressed jtl is then decompressed at most once
+            for i in sorted(range(len(offsets)), key=offsets.__getitem__):
+                if offsets[i] not in read:
+                    f.seek(offsets[i])
+                    read[offsets[i]] = self.sample(columns, next(csv.reader(lines)))
+                samples[i] = read[offsets[i]]
+            return samples
+
+
+class JTLColumns(object):
+    """column arrays of one result.jtl, string columns are dictionary encoded"""
+
+    def __init__(self, arrays: dict, strings: dict):
+        self.arrays = arrays
+        self.strings = strings
+
+    def __len__(self) -> int:
+        return len(self.arrays['timeStamp']) if self.arrays else 0
+
+    def __getitem__(self, field: str) -> np.ndarray:
+        return self.arrays[field]
+
+
+class JTLCache(object):
+    """
+    columnar cache of result.jtl stored as .npy files, opened with mmap, the cache of a task lives
+    outside its report directory, which jmeter's -e -o writes the dashboard to while the run goes on
+    the offset column is the byte offset index of every record in result.jtl,
+    the free text columns (messages, URL) are read back through it
+    """
+
+    CACHE_DIR = 'jtl_cache'
+    META_FILE = 'meta.json'
+    VERSION = 2
+    DTYPES = {
+        'timeStamp': 'int64',
+        'elapsed': 'int32',
+        'success': 'bool',
+        'bytes': 'int64',
+        'sentBytes': 'int64',
+        'grpThreads': 'int32',
+        'allThreads': 'int32',
+        'Latency': 'int32',
+        'IdleTime': 'int32',
+        'Connect': 'int32',
+        'offset': 'int64'
+    }
+    STRING_FIELDS = ('label', 'responseCode', 'threadName')
+
+    _opened = dict()
+    _locks = dict()  # per result directory, a cold build only holds up the requests for its own task
+
+    @classmethod
+    def lock(cls, jtl_path: str) -> threading.Lock:
+        # result.jtl and result.jtl.gz share the cache beside them, so they share a lock
+        return cls._locks.setdefault(os.path.dirname(jtl_path), threading.Lock())
+
+    @classmethod
+    def stamp(cls, jtl_path: str) -> list:
+        stat = os.stat(jtl_path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    @classmethod
+    def load(cls, jtl_path: str, cache_dir: Optional[str] = None) -> JTLColumns:
+        """open the cache of jtl_path (in cache_dir, beside it by default), (re)building it when the jtl changed"""
+        if not os.path.exists(jtl_path):
+            logger.warning('No file found')
+            return JTLColumns(dict(), dict())
+        with cls.lock(jtl_path), ServerMetrics.phase('read'):
+            stamp = cls.stamp(jtl_path)
+            opened = cls._opened.get(jtl_path)
+            if opened and opened[0] == stamp:
+                ServerMetrics.cache('jtl', True)
+                return opened[1]
+            cache_dir = cache_dir or os.path.join(os.path.dirname(jtl_path), cls.CACHE_DIR)
+            meta = cls.read_meta(cache_dir)
+            stale = meta is None or meta['version'] != cls.VERSION or meta['stamp'] != stamp
+            ServerMetrics.cache('jtl', not stale)
+            if stale:
+                meta = cls.build(jtl_path, cache_dir, stamp)
+            arrays = {field: np.load(os.path.join(cache_dir, '{}.npy'.format(field)), mmap_mode='r')
+                      for field in meta['fields']}
+            columns = JTLColumns(arrays, meta['strings'])
+            cls._opened[jtl_path] = (stamp, columns)
+            return columns
+
+    @classmethod
+    def restamp(cls, jtl_path: str, stamp: list, cache_dir: Optional[str] = None) -> None:
+        """move a cache built for stamp over to jtl_path, which holds the same records (e.g. compressed)"""
+        cache_dir = cache_dir or os.path.join(os.path.dirname(jtl_path), cls.CACHE_DIR)
+        with cls.lock(jtl_path):
+            meta = cls.read_meta(cache_dir)
+            if meta is None or meta['version'] != cls.VERSION or meta['stamp'] != stamp:
+                return
+            meta['stamp'] = cls.stamp(jtl_path)
+            meta_path = os.path.join(cache_dir, cls.META_FILE)
+            Common.write_file_content(meta_path + '.tmp', json.dumps(meta))
+            os.replace(meta_path + '.tmp', meta_path)
+            for path in [path for path in list(cls._opened) if os.path.dirname(path) == os.path.dirname(jtl_path)]:
+                cls._opened.pop(path, None)
+
+    @classmethod
+    def read_meta(cls, cache_dir: str) -> Optional[dict]:
+        meta_path = os.path.join(cache_dir, cls.META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            return json.loads(Common.read_file_content(meta_path))
+        except ValueError:
+            logger.warning('broken jtl cache: {}'.format(cache_dir))
+            return None
+
+    @classmethod
+    def build(cls, jtl_path: str, cache_dir: str, stamp: list) -> dict:
+        """convert result.jtl into one .npy file per column, sorted by timeStamp"""
+        logger.info('build jtl cache: {}'.format(jtl_path))
+        os.makedirs(cache_dir, exist_ok=True)
+        numeric = {field: array('q') for field in cls.DTYPES}
+        codes = {field: array('l') for field in cls.STRING_FIELDS}
+        lookup = {field: dict() for field in cls.STRING_FIELDS}
+        for offset, sample in JTLReader(jtl_path).records():
+            numeric['offset'].append(offset)
+            for field, values in numeric.items():
+                if field != 'offset':
+                    values.append(getattr(sample, field))
+            for field, values in codes.items():
+                value = getattr(sample, field)
+                table = lookup[field]
+                code = table.get(value)
+                if code is None:
+                    code = table[value] = len(table)
+                values.append(code)
+        order = np.argsort(np.frombuffer(numeric['timeStamp'], dtype='int64'), kind='stable')
+        for field, values in numeric.items():
+            column = np.frombuffer(values, dtype='int64').astype(cls.DTYPES[field])[order]
+            np.save(os.path.join(cache_dir, '{}.npy'.format(field)), column)
+        for field, values in codes.items():
+            column = np.frombuffer(values, dtype=np.dtype('l')).astype('int32')[order]
+            np.save(os.path.join(cache_dir, '{}.npy'.format(field)), column)
+        meta = {
+            'version': cls.VERSION,
+            'stamp': stamp,
+            'rows': len(order),
+            'fields': list(cls.DTYPES) + list(cls.STRING_FIELDS),
+            'strings': {field: list(table) for field, table in lookup.items()}
+        }
+        # meta.json is written last, so an interrupted build is never mistaken for a valid cache
+        meta_path = os.path.join(cache_dir, cls.META_FILE)
+        Common.write_file_content(meta_path + '.tmp', json.dumps(meta))
+        os.replace(meta_path + '.tmp', meta_path)
+        return meta
+
 
 class TaskBase(object):
 
     ROOT_DIR = Common.make_dir(os.path.join(os.getcwd(), 'webmeter'))
+    COMPRESSED = '.gz'
 
     @classmethod
     def read_statistics_file(cls, plan: str, task: str) -> dict:
         """read statistics.json content"""
         statistics_file_path = os.path.join(cls.ROOT_DIR, plan, 'report', task,'statistics.json')
         if os.path.exists(statistics_file_path):
-            content = Common.read_file_content(statistics_file_path)
+            with ServerMetrics.phase('read'):
+                content = Common.read_file_content(statistics_file_path)
             return json.loads(content)
         else:
             logger.warning('No file found')
             return None
         
     @classmethod
-    def read_result_file(cls, plan: str, task: str) -> list:
-        """read result.jtl content"""
-        result_file_path = os.path.join(cls.ROOT_DIR, plan, 'report', task,'result.jtl')
-        if os.path.exists(result_file_path):
-            content = Common.read_file_lines(result_file_path)
-            return content
-        else:
-            logger.warning('No file found')
-            return None
+    def stored_path(cls, file_path: str) -> str:
+        """file_path, or its compressed copy once the task was archived"""
+        if not os.path.exists(file_path) and os.path.exists(file_path + cls.COMPRESSED):
+            return file_path + cls.COMPRESSED
+        return file_path
+
+    @classmethod
+    def result_file_path(cls, plan: str, task: str) -> str:
+        return cls.stored_path(os.path.join(cls.ROOT_DIR, plan, 'report', task, 'result.jtl'))
+
+    @classmethod
+    def log_file_path(cls, plan: str, task: str) -> str:
+        return cls.stored_path(os.path.join(cls.ROOT_DIR, plan, 'log', task, 'result.log'))
+
+    @classmethod
+    def cache_path(cls, plan: str, task: str) -> str:
+        return os.path.join(cls.ROOT_DIR, plan, 'cache', task)
+
+    @classmethod
+    def read_result_columns(cls, plan: str, task: str) -> JTLColumns:
+        """load result.jtl through its columnar cache"""
+        return JTLCache.load(cls.result_file_path(plan, task), cls.cache_path(plan, task))
 
     @classmethod
     def read_log_file(cls, plan: str, task: str) -> Optional[str]:
         """read result.log content"""
         log_dir = os.path.join(cls.ROOT_DIR, plan, 'log')
         if os.path.exists(log_dir):
-            log_file_path = os.path.join(log_dir, task,'result.log')
+            log_file_path = cls.log_file_path(plan, task)
             content = Common.read_file_content(log_file_path)
             return content.strip()
         else:
@@ -44,6 +334,24 @@ class TaskBase(object):
             return None
         
 class TaskDetail(TaskBase):
+
+    SUMMARY_LIMIT = 50
+    SUMMARY_KEYS = {'timeStamp': 'timeStamp',
+                    'responseTime': 'elapsed',
+                    'lable': 'label',
+                    'responseCode': 'responseCode',
+                    'responseMessage': 'responseMessage',
+                    'threadName': 'threadName',
+                    'dataType': 'dataType',
+                    'success': 'success',
+                    'failureMessage': 'failureMessage',
+                    'bytes': 'bytes',
+                    'sentBytes': 'sentBytes',
+                    'allThreads': 'allThreads',
+                    'URL': 'URL',
+                    'Latency': 'Latency',
+                    'IdleTime': 'IdleTime',
+                    'Connect': 'Connect'}
     
     @classmethod
     def getTestAndReportInfo(cls, plan: str, task: str) -> dict:
@@ -55,53 +363,51 @@ class TaskDetail(TaskBase):
         return result
     
     @classmethod
-    def getRequestSummary(cls, plan: str, task: str) -> list:
-        jtlContent = TaskBase.read_result_file(plan, task)
-        jtlContent.pop(0)
-        jtlList = [{'timeStamp':item.split(',')[0],
-                    'responseTime':item.split(',')[1],
-                    'lable':item.split(',')[2], 
-                    'responseCode':item.split(',')[3],
-                    'responseMessage':item.split(',')[4], 
-                    'threadName': item.split(',')[5],
-                    'dataType':item.split(',')[6],
-                    'success':item.split(',')[7],
-                    'failureMessage':item.split(',')[8],
-                    'bytes': item.split(',')[9],
-                    'sentBytes': item.split(',')[10],
-                    'allThreads':item.split(',')[12],
-                    'URL': item.split(',')[13],
-                    'Latency':item.split(',')[14],
-                    'IdleTime':item.split(',')[15],
-                    'Connect': item.split(',')[16]}  for item in jtlContent]
-        return jtlList
-    
-    @classmethod
-    def tagetKey(cls, dictTaget):
-        return dictTaget['x']
-
-    @classmethod
-    def initResponseOverTime(cls, plan: str, task: str) -> list:
-        jtlContent = TaskBase.read_result_file(plan, task)
-        jtlContent.pop(0)
-        responseOverTimeList =[{'x':item.split(',')[0], 'y':item.split(',')[1]} for item in jtlContent]
-        sortResponseOverTimeList = sorted(responseOverTimeList, key=cls.tagetKey)
-        return sortResponseOverTimeList
-    
-    @classmethod
-    def initConnectOverTime(cls, plan: str, task: str) -> list:
-        jtlContent = TaskBase.read_result_file(plan, task)
-        jtlContent.pop(0)
-        connectOverTimeList =[{'x':item.split(',')[0], 'y':item.split(',')[16]} for item in jtlContent]
-        sortConnectOverTimeList = sorted(connectOverTimeList, key=cls.tagetKey)
-        return sortConnectOverTimeList
-    
-    @classmethod
-    def initLatencyOverTime(cls, plan: str, task: str) -> list:
-        jtlContent = TaskBase.read_result_file(plan, task)
-        jtlContent.pop(0)
-        latencyOverTimeList =[{'x':item.split(',')[0], 'y':item.split(',')[14]} for item in jtlContent]
-        sortLatencyOverTimeList = sorted(latencyOverTimeList, key=cls.tagetKey)
-        return sortLatencyOverTimeList
-        
- 
\ No newline at end of file
+    def getRequestSummary(cls, plan: str, task: str, page: int = 1, limit: int = 50,
+                          label: Optional[str] = None, responseCode: Optional[str] = None,
+                          success: Optional[bool] = None, threadName: Optional[str] = None,
+                          min_elapsed: Optional[int] = None, max_elapsed: Optional[int] = None,
+                          sort: Optional[str] = None, order: str = 'asc') -> dict:
+        """one page of samples, filtered and sorted on the column cache"""
+        page = max(int(page or 1), 1)
+        limit = max(int(limit or cls.SUMMARY_LIMIT), 1)
+        result = {'total': 0, 'page': page, 'limit': limit, 'rows': []}
+        columns = TaskBase.read_result_columns(plan, task)
+        if not len(columns):
+            return result
+        mask = np.ones(len(columns), dtype='bool')
+        for field, value in (('label', label), ('responseCode', responseCode), ('threadName', threadName)):
+            if value not in (None, ''):
+                strings = columns.strings[field]
+                code = strings.index(value) if value in strings else -1
+                mask &= columns[field] == code
+        if success not in (None, ''):
+            if not isinstance(success, bool):
+                # MAPPING turns 'true'/'false' into booleans, anything else is no filter we know
+                success = Common.MAPPING.get(str(success).lower())
+                if success is None:
+                    raise Exception('success must be true or false')
+            mask &= columns['success'] == success
+        if min_elapsed not in (None, ''):
+            mask &= columns['elapsed'] >= int(min_elapsed)
+        if max_elapsed not in (None, ''):
+            mask &= columns['elapsed'] <= int(max_elapsed)
+        index = np.flatnonzero(mask)
+        field = cls.SUMMARY_KEYS.get(sort, sort)
+        if sort not in (None, '') and (field not in columns.arrays or field == 'offset'):
+            # only the columns of the cache are sortable, free text (URL, messages) is read per page
+            raise Exception('cannot sort by {}'.format(sort))
+        if sort not in (None, ''):
+            key = columns[field][index]
+            if field in columns.strings:
+                # codes are in first-seen order, rank them alphabetically
+                key = np.argsort(np.argsort(np.asarray(columns.strings[field], dtype=object)))[key]
+            index = index[np.argsort(key, kind='stable')]
+        if order == 'desc':
+            index = index[::-1]
+        offsets = columns['offset'][index[(page - 1) * limit: page * limit]].tolist()
+        samples = JTLReader(TaskBase.result_file_path(plan, task)).read_at(offsets)
+        result['total'] = len(index)
+        result['rows'] = [{key: getattr(sample, field) for key, field in cls.SUMMARY_KEYS.items()}
+                          for sample in samples]
+        return result
@@ -1,12 +1,16 @@
 import socket
 import os
+import gzip
 from enum import Enum, unique
 import platform
 import psutil
+import threading
+from collections import OrderedDict
 from loguru import logger
 from xml.etree import ElementTree
-from typing import Optional
+from typing import Iterator, Optional
 from contextlib import contextmanager
+from webmeter.core.metrics import ServerMetrics
 
 
 @unique
@@ -35,16 +39,13 @@ class Common(object):
             ip = '127.0.0.1'    
         return ip
     
-    @contextmanager
     @classmethod
-    def open_file(cls, path, mode):
-        try:
-            file = open(path, mode)
-            yield file
-        except Exception as e:
-            raise e    
-        finally:
-            file.close()
+    def open_file(cls, file_path, mode='r'):
+        """open a file for reading, .gz files are decompressed as a stream"""
+        encoding = None if 'b' in mode else 'utf-8'
+        if file_path.endswith('.gz'):
+            return gzip.open(file_path, mode=mode if 'b' in mode else mode + 't', encoding=encoding)
+        return open(file=file_path, mode=mode, encoding=encoding)
 
     @classmethod
     def exec_cmd(cls, cmd: str) -> int:
@@ -70,7 +71,7 @@ class Common(object):
    
     @classmethod
     def read_file_content(cls, file_path) -> str:
-        with open(file=file_path, mode='r', encoding='utf-8') as f:
+        with cls.open_file(file_path, mode='r') as f:
             content = f.read() 
             return content
     
@@ -81,7 +82,7 @@ class Common(object):
 
     @classmethod
     def read_file_lines(cls, file_path) -> list:
-        with open(file=file_path, mode='r', encoding='utf-8') as f:
+        with cls.open_file(file_path, mode='r') as f:
             content = f.readlines() 
             return content        
     
@@ -100,18 +101,83 @@ class Common(object):
             return Platform.LINUX.value
         
 
+class JMXDocument(object):
+    """a parsed jmx file and its elements indexed by (tag, name) and (tag, testclass)"""
+
+    def __init__(self, tree: ElementTree.ElementTree):
+        self.tree = tree
+        self.changed = False
+        self.names = dict()
+        self.testclasses = dict()
+        for element in tree.getroot().iter():
+            if 'name' in element.attrib:
+                self.names.setdefault((element.tag, element.attrib['name']), []).append(element)
+            if 'testclass' in element.attrib:
+                self.testclasses.setdefault((element.tag, element.attrib['testclass']), []).append(element)
+
+    def find_name(self, tag: str, name: str) -> list:
+        return self.names.get((tag, name), [])
+
+    def find_testclass(self, tag: str, testclass: str) -> list:
+        return self.testclasses.get((tag, testclass), [])
+
+    def write_text(self, tag: str, name: str, text: str) -> bool:
+        tag_object = self.find_name(tag, name)
+        if tag_object:
+            tag_object[0].text = text
+            self.changed = True
+            return True
+        return False
+
+    def write_testname(self, tag: str, attr: str, testname: str) -> bool:
+        tag_object = self.find_testclass(tag, attr)
+        if tag_object:
+            tag_object[0].attrib['testname'] = testname
+            self.changed = True
+            return True
+        return False
+
+
 class JMX(object):
 
+    CACHE_SIZE = 16
+    _documents = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def document(cls, jmx_path_or_name: str) -> JMXDocument:
+        """parsed jmx file, parsed again only when its mtime or size changed"""
+        stat = os.stat(jmx_path_or_name)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        key = os.path.abspath(jmx_path_or_name)
+        with cls._lock:
+            cached = cls._documents.get(key)
+            if cached and cached[0] == stamp:
+                cls._documents.move_to_end(key)
+                ServerMetrics.cache('jmx', True)
+                return cached[1]
+        ServerMetrics.cache('jmx', False)
+        with ServerMetrics.phase('read'):
+            document = JMXDocument(ElementTree.parse(jmx_path_or_name))
+        with cls._lock:
+            cls._documents[key] = (stamp, document)
+            cls._documents.move_to_end(key)
+            while len(cls._documents) > cls.CACHE_SIZE:
+                cls._documents.popitem(last=False)
+        return document
+
+    @classmethod
+    def evict(cls, jmx_path_or_name: str) -> None:
+        with cls._lock:
+            cls._documents.pop(os.path.abspath(jmx_path_or_name), None)
+
     @classmethod
     def read_text(cls, jmx_path_or_name: str, tag: str, 
                   name: str, default: any) -> any:
         """read text from jmx file"""
-        jmxElementTreeDom =ElementTree.parse(jmx_path_or_name)
-        jmxElementRootDom = jmxElementTreeDom.getroot()
-        tag_object = jmxElementRootDom.iter(tag)
-        for tag_target in tag_object:
-            if tag_target.attrib['name'] == name:
-                return tag_target.text
+        tag_object = cls.document(jmx_path_or_name).find_name(tag, name)
+        if tag_object:
+            return tag_object[0].text
         logger.warning('no found {}'.format(name))
         return default
     
@@ -119,18 +185,8 @@ class JMX(object):
     def read_text_list(cls, jmx_path_or_name: str, tag: str, 
                   name: str, key: str) -> list:
         """read text list from jmx file"""
-        element_list = list()
-        element_dict = dict()
-        jmxElementTreeDom =ElementTree.parse(jmx_path_or_name)
-        jmxElementRootDom = jmxElementTreeDom.getroot()
-        tag_object = jmxElementRootDom.iter(tag)
-        for tag_target in tag_object:
-            tag_dict = dict()
-            if tag_target.attrib['name'] == name:
-                element_dict[key] = tag_target.text
-                tag_dict.update(element_dict)
-                element_list.append(tag_dict)
-        return element_list
+        tag_object = cls.document(jmx_path_or_name).find_name(tag, name)
+        return [{key: tag_target.text} for tag_target in tag_object]
     
     @classmethod
     def read_proxy(cls, jmx_path_or_name: str) -> list:
@@ -168,49 +224,64 @@ class JMX(object):
     def read_testname(cls, jmx_path_or_name: str, tag: str,
                       attr: str, default: any) -> any:
         """read attr from jmx file"""
-        jmxElementTreeDom =ElementTree.parse(jmx_path_or_name)
-        jmxElementRootDom = jmxElementTreeDom.getroot()
-        tag_object = jmxElementRootDom.iter(tag)
-        for tag_target in tag_object:
-            if tag_target.attrib['testclass'] == attr:
-                return tag_target.attrib['testname']
+        tag_object = cls.document(jmx_path_or_name).find_testclass(tag, attr)
+        if tag_object:
+            return tag_object[0].attrib['testname']
         logger.warning('no found {}'.format(attr))
         return default
     
+    @classmethod
+    def parse(cls, jmx_path_or_name: str) -> JMXDocument:
+        """a private parsed copy, changing it does not touch the cached document"""
+        return JMXDocument(ElementTree.parse(jmx_path_or_name))
+
+    @classmethod
+    @contextmanager
+    def edit(cls, jmx_path_or_name: str) -> Iterator[JMXDocument]:
+        """apply several updates to one parsed tree, the file is replaced once when the block succeeds"""
+        document = cls.parse(jmx_path_or_name)
+        yield document
+        if document.changed:
+            cls.save(jmx_path_or_name, document)
+
+    @classmethod
+    def save(cls, jmx_path_or_name: str, document: JMXDocument) -> None:
+        """write to a temporary file and rename it, a crash never leaves a half written plan"""
+        temp_path = '{}.{}.tmp'.format(jmx_path_or_name, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                document.tree.write(f, encoding='utf-8')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, jmx_path_or_name)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        document.changed = False
+        stat = os.stat(jmx_path_or_name)
+        with cls._lock:
+            cls._documents[os.path.abspath(jmx_path_or_name)] = ((stat.st_mtime_ns, stat.st_size), document)
+
     @classmethod
     def write_testname(cls, jmx_path_or_name: str, tag: str,
-                       attr: str, testname: str) -> str:
+                       attr: str, testname: str) -> bool:
         """update testname to jmx file"""
-        jmxElementTreeDom =ElementTree.parse(jmx_path_or_name)
-        jmxElementRootDom = jmxElementTreeDom.getroot()
-        tag_object = jmxElementRootDom.iter(tag)
-        for tag_target in tag_object:
-            if tag_target.attrib['testclass'] == attr:
-                tag_target.attrib['testname'] = testname
-                jmxElementTreeDom.write(jmx_path_or_name, encoding='utf-8')
-                return True
-        return False
+        with cls.edit(jmx_path_or_name) as document:
+            return document.write_testname(tag, attr, testname)
     
     @classmethod
     def write_text(cls, jmx_path_or_name: str, tag: str,
-                   name: str, text: str) -> str:
+                   name: str, text: str) -> bool:
         """write text to jmx file"""
-        jmxElementTreeDom =ElementTree.parse(jmx_path_or_name)
-        jmxElementRootDom = jmxElementTreeDom.getroot()
-        tag_object = jmxElementRootDom.iter(tag)
-        for tag_target in tag_object:
-            if tag_target.attrib['name'] == name:
-                tag_target.text = text
-                jmxElementTreeDom.write(jmx_path_or_name, encoding='utf-8')
-                return True
-        return False
+        with cls.edit(jmx_path_or_name) as document:
+            return document.write_text(tag, name, text)
     
 
 class Performance(object):
         
     @classmethod
-    def getMachineCPU(cls) -> float:
-        percent = psutil.cpu_percent(interval=1)
+    def getMachineCPU(cls, interval: Optional[float] = 1) -> float:
+        percent = psutil.cpu_percent(interval=interval)
         return percent
         
     @classmethod
@@ -1,4 +1,5 @@
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 import requests
@@ -6,9 +7,29 @@ import webbrowser
 from loguru import logger
 from view import page,api
 from core.utils import Common
-from core.engine import EngineServie
+from core.engine import EngineServie, RunScheduler, JmeterWorker
+from core.monitor import HostSampler
+from core.archive import TaskArchive
+from core.metrics import RequestMetrics, ServerMetrics, TimedJSONResponse
 
-app = FastAPI(debug=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    api.test_plan.reconcile()
+    EngineServie.recover()
+    RunScheduler.start()
+    HostSampler.start()
+    TaskArchive.start()
+    ServerMetrics.start()
+    yield
+    await ServerMetrics.shutdown()
+    await TaskArchive.shutdown()
+    await RunScheduler.shutdown()
+    await JmeterWorker.shutdown()
+    HostSampler.stop()
+
+app = FastAPI(debug=True, lifespan=lifespan, default_response_class=TimedJSONResponse)
+app.add_middleware(RequestMetrics)
 app.include_router(page.router)
 app.include_router(api.router)
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -1,15 +1,26 @@
+import asyncio
 from loguru import logger
-from typing import Union
-from fastapi import APIRouter, UploadFile, File, Form
+from typing import Optional, Union
+from fastapi import APIRouter, UploadFile, File, Form, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from webmeter.core.plan import TestPlan
-from webmeter.core.engine import EngineServie
+from webmeter.core.engine import EngineServie, RunScheduler, JmeterWorker
+from webmeter.core.live import LiveMetrics
+from webmeter.core.monitor import HostSampler
 from webmeter.core.sqlhandle import crud, models, schemas
-from webmeter.core.sqlhandle.database import engine
+from webmeter.core.sqlhandle.database import engine, upgrade_tables
 from webmeter.core.task import TaskDetail
+from webmeter.core.export import TaskExport
+from webmeter.core.aggregate import TaskAggregate, TaskComparison
+from webmeter.core.rollup import TaskRollup
+from webmeter.core.archive import TaskArchive
+from webmeter.core.profile import ResultProfile
+from webmeter.core.metrics import ServerMetrics
 from webmeter.core.utils import Performance
 router = APIRouter()
 test_plan = TestPlan()
 models.Base.metadata.create_all(bind=engine)
+upgrade_tables()
 
 
 @router.post("/api/initialize")
@@ -43,10 +54,11 @@ async def get_language(keys: schemas.keyQuery):
    return result
 
 @router.post("/api/plan/all")
-async def get_all_plan():
+async def get_all_plan(content: Optional[dict] = None):
+   content = content or dict()
    try:
-      plan_list = test_plan.get_all_plan()
-      result = {'status':1, 'plan_list':plan_list, 'length':len(plan_list), 'msg': 'get success'}
+      plan_list = test_plan.get_all_plan(page=int(content.get('page') or 1), limit=int(content.get('limit') or 0) or None)
+      result = {'status':1, 'plan_list':plan_list, 'length':len(plan_list), 'total': test_plan.count_plan(), 'msg': 'get success'}
    except Exception as e:
       logger.exception(e)
       result = {'status':0, 'msg': str(e)}
@@ -56,8 +68,8 @@ async def get_all_plan():
 async def checked_one_plan(content: dict):
    plan_name = content.get('plan_name')
    try:
-      plan_list = test_plan.checked_one_plan(plan_name)
-      result = {'status':1, 'plan_list':plan_list, 'length':plan_list.__len__(), 'msg': 'get success'}
+      plan_list = test_plan.checked_one_plan(plan_name, page=int(content.get('page') or 1), limit=int(content.get('limit') or 0) or None)
+      result = {'status':1, 'plan_list':plan_list, 'length':plan_list.__len__(), 'total': test_plan.count_plan(), 'msg': 'get success'}
    except Exception as e:
       logger.exception(e)
       result = {'status':0, 'msg': str(e)}
@@ -143,12 +155,40 @@ async def remote_hosts():
       result = {'status':0, 'msg': str(e)}
    return result       
 
+@router.post("/api/plan/hosts/capacity")
+async def remote_hosts_capacity(content: dict):
+   try:
+      if content.get('capacity') is not None:
+         capacity = EngineServie.set_host_capacity(content.get('capacity'))
+      else:
+         capacity = EngineServie.host_capacity()
+      hosts = EngineServie.remote_hosts_list()
+      result = {'status':1, 'capacity': capacity,
+                'threads': EngineServie.shard_threads(int(content.get('threads') or 0), hosts) if hosts else dict()}
+   except Exception as e:
+      logger.exception(e)
+      result = {'status':0, 'msg': str(e)}
+   return result
+
+@router.post("/api/plan/results")
+async def plan_results(content: dict):
+   try:
+      if content.get('results') is not None:
+         data = ResultProfile.set_config(content.get('plan'), content.get('results'))
+      else:
+         data = ResultProfile.config(content.get('plan'))
+      result = {'status':1, 'msg': 'success', 'data': data}
+   except Exception as e:
+      logger.exception(e)
+      result = {'status':0, 'msg': str(e)}
+   return result
+
 @router.post("/api/plan/run")
 async def run(content: dict):
    try:
       if EngineServie.check_JavaEnvironment() == 0:
-         EngineServie.run(content=content, model=content.get('model'))
-         result = {'status':1, 'msg': 'run success'}   
+         task = await EngineServie.run(content=content, model=content.get('model'))
+         result = {'status':1, 'msg': 'run success', 'task': task}   
    except Exception as e:
       logger.exception(e)
       result = {'status':0, 'msg': str(e)}
@@ -164,6 +204,66 @@ async def stop():
       result = {'status':0, 'msg': str(e)}
    return result
 
+@router.post("/api/run/queue")
+async def run_queue():
+   try:
+      data = RunScheduler.queue()
+      result = {'status':1, 'msg': 'success', 'data': data, 'config': RunScheduler.config()}
+   except Exception as e:
+      logger.exception(e)
+      result = {'status':0, 'msg': str(e)}
+   return result
+
+@router.post("/api/run/cancel")
+async def run_cancel(content: dict):
+   try:
+      RunScheduler.cancel(content.get('task'))
+      result = {'status':1, 'msg': 'cancel success'}
+   except Exception as e:
+      logger.exception(e)
+      result = {'status':0, 'msg': str(e)}
+   return result
+
+@router.post("/api/run/reorder")
+async def run_reorder(content: dict):
+   try:
+      data = RunScheduler.reorder(content.get('tasks') or list())
+      result = {'status':1, 'msg': 'success', 'data': data}
+   except Exception as e:
+      logger.exception(e)
+      result = {'status':0, 'msg': str(e)}
+   return result
+
+@router.post("/api/run/config")
+async def run_config(content: dict):
+   try:
+      data = RunScheduler.set_config(content)
+      result = {'status':1, 'msg': 'success', 'data': data}
+   except Exception as e:
+      logger.exception(e)
+      result = {'status':0, 'msg': str(e)}
+   return result
+
+@router.post("/api/run/warm")
+async def run_warm(content: dict):
+   try:
+      data = await JmeterWorker.set_config(content)
+      result = {'status':1, 'msg': 'success', 'data': data}
+   except Exception as e:
+      logger.exception(e)
+      result = {'status':0, 'msg': str(e)}
+   return result
+
+@router.post("/api/task/archive/config")
+async def archive_config(content: dict):
+   try:
+      data = TaskArchive.set_config(content)
+      result = {'status':1, 'msg': 'success', 'data': data}
+   except Exception as e:
+      logger.exception(e)
+      result = {'status':0, 'msg': str(e)}
+   return result
+
 @router.post("/api/task/query/all")
 async def query_task_all():
    try:
@@ -174,6 +274,32 @@ async def query_task_all():
       result = {'status':0, 'msg': str(e)}
    return result
 
+@router.post("/api/task/compare")
+async def task_compare(content: dict):
+   try:
+      plan = content.get('plan')
+      # aggregates of a task seen for the first time are built from result.jtl, off the event loop
+      baseline = await asyncio.to_thread(TaskAggregate.load, content.get('baseline_plan') or plan, content.get('baseline'))
+      candidate = await asyncio.to_thread(TaskAggregate.load, content.get('candidate_plan') or plan, content.get('candidate'))
+      data = await asyncio.to_thread(TaskComparison.compare, baseline, candidate, content.get('labels'))
+      result = {'status':1, 'msg': 'success', 'data': data}
+   except Exception as e:
+      logger.exception(e)
+      result = {'status':0, 'msg': str(e)}
+   return result
+
+@router.post("/api/task/status")
+async def query_task_status(content: dict):
+   try:
+      plan = content.get('plan')
+      task = content.get('task')
+      data = crud.query_task_one(plan=plan, task=task)
+      result = {'status':1, 'msg': 'success', 'data': data}
+   except Exception as e:
+      logger.exception(e)
+      result = {'status':0, 'msg': str(e)}
+   return result
+
 @router.post("/api/task/remove/one")
 async def remove_task_one(content: dict):
    try:
@@ -213,7 +339,17 @@ async def requests_summary(content: dict):
    plan = content.get('plan')
    task = content.get('task')
    try:
-      data = TaskDetail.getRequestSummary(plan, task)
+      data = await asyncio.to_thread(TaskDetail.getRequestSummary, plan, task,
+                                     page=content.get('page'),
+                                     limit=content.get('limit'),
+                                     label=content.get('label'),
+                                     responseCode=content.get('responseCode'),
+                                     success=content.get('success'),
+                                     threadName=content.get('threadName'),
+                                     min_elapsed=content.get('min_elapsed'),
+                                     max_elapsed=content.get('max_elapsed'),
+                                     sort=content.get('sort'),
+                                     order=content.get('order', 'asc'))
       result = {'status':1, 'msg': 'success', 'data': data}
    except Exception as e:
       logger.exception(e)
@@ -225,7 +361,15 @@ async def statistics(content: dict):
    plan = content.get('plan')
    task = content.get('task')
    try:
-      data = TaskDetail.read_statistics_file(plan, task)
+      # percentiles of a window need the mergeable sketches of TaskAggregate, not per second rollups
+      if content.get('start') is None and content.get('end') is None and content.get('labels') is None:
+         data = TaskDetail.read_statistics_file(plan, task)
+      else:
+         data = None
+      if data is None:
+         aggregate = await asyncio.to_thread(TaskAggregate.load, plan, task)
+         data = await asyncio.to_thread(aggregate.statistics, start=content.get('start'), end=content.get('end'),
+                                        labels=content.get('labels'))
       result = {'status':1, 'msg': 'success', 'data': data}
    except Exception as e:
       logger.exception(e)
@@ -237,7 +381,9 @@ async def responsetime(content: dict):
    plan = content.get('plan')
    task = content.get('task')
    try:
-      data = TaskDetail.initResponseOverTime(plan, task)
+      data = await TaskRollup.initResponseOverTime(plan, task, start=content.get('start'),
+                                                   end=content.get('end'), points=content.get('points'),
+                                                   label=content.get('label'))
       result = {'status':1, 'msg': 'success', 'data': data}
    except Exception as e:
       logger.exception(e)
@@ -249,7 +395,9 @@ async def connct_time(content: dict):
    plan = content.get('plan')
    task = content.get('task')
    try:
-      data = TaskDetail.initConnectOverTime(plan, task)
+      data = await TaskRollup.initConnectOverTime(plan, task, start=content.get('start'),
+                                                  end=content.get('end'), points=content.get('points'),
+                                                  label=content.get('label'))
       result = {'status':1, 'msg': 'success', 'data': data}
    except Exception as e:
       logger.exception(e)
@@ -261,13 +409,33 @@ async def latency(content: dict):
    plan = content.get('plan')
    task = content.get('task')
    try:
-      data = TaskDetail.initLatencyOverTime(plan, task)
+      data = await TaskRollup.initLatencyOverTime(plan, task, start=content.get('start'),
+                                                  end=content.get('end'), points=content.get('points'),
+                                                  label=content.get('label'))
       result = {'status':1, 'msg': 'success', 'data': data}
    except Exception as e:
       logger.exception(e)
       result = {'status':0, 'msg': str(e)}
    return result
 
+@router.get("/api/task/live")
+async def task_live(plan: str, task: str):
+   return StreamingResponse(LiveMetrics.stream(plan, task), media_type='text/event-stream',
+                            headers={'Cache-Control': 'no-cache'})
+
+@router.get("/api/task/export")
+async def task_export(plan: str, task: str, format: str = 'parquet', labels: Optional[list[str]] = Query(None),
+                      start: Optional[int] = None, end: Optional[int] = None):
+   try:
+      jtl_path = TaskExport.check(plan, task, format)
+   except Exception as e:
+      logger.exception(e)
+      return {'status':0, 'msg': str(e)}
+   return StreamingResponse(TaskExport.stream(jtl_path, format, labels=labels, start=start, end=end),
+                            media_type=TaskExport.FORMATS[format][0],
+                            headers={'Content-Disposition': 'attachment; filename="{}"'.format(
+                               TaskExport.filename(task, format))})
+
 @router.post("/api/task/log")
 async def task_log(content: dict):
    plan = content.get('plan')
@@ -306,7 +474,8 @@ async def write_config_file(content: dict):
 @router.post("/api/monitor/cpu")
 async def monitor_cpu():
    try:
-      data = Performance.getMachineCPU()
+      sample = HostSampler.latest()
+      data = sample.get('cpu') if sample else Performance.getMachineCPU(interval=None)
       result = {'status':1, 'msg': 'success', 'data': data}
    except Exception as e:
       logger.exception(e)
@@ -316,9 +485,50 @@ async def monitor_cpu():
 @router.post("/api/monitor/memory")
 async def monitor_memory():
    try:
-      data = Performance.getMachineMemory()
+      sample = HostSampler.latest()
+      data = sample.get('memory') if sample else Performance.getMachineMemory()
       result = {'status':1, 'msg': 'success', 'data': data}
    except Exception as e:
       logger.exception(e)
       result = {'status':0, 'msg': str(e)}
-   return result
\ No newline at end of file
+   return result
+
+@router.post("/api/monitor/host")
+async def monitor_host(content: dict):
+   try:
+      data = HostSampler.samples(since=content.get('since'))
+      result = {'status':1, 'msg': 'success', 'data': data}
+   except Exception as e:
+      logger.exception(e)
+      result = {'status':0, 'msg': str(e)}
+   return result
+
+@router.post("/api/monitor/task")
+async def monitor_task(content: dict):
+   try:
+      data = crud.query_monitor_task(content.get('task'))
+      result = {'status':1, 'msg': 'success', 'data': data}
+   except Exception as e:
+      logger.exception(e)
+      result = {'status':0, 'msg': str(e)}
+   return result
+
+@router.get("/metrics")
+async def metrics():
+   counts = crud.query_task_counts() or dict()
+   gauges = {
+      'webmeter_runs_active': ('runs in progress', counts.get('Running', 0)),
+      'webmeter_runs_queued': ('runs waiting for a slot', counts.get('Queued', 0))
+   }
+   return PlainTextResponse(ServerMetrics.render(gauges), media_type=ServerMetrics.CONTENT_TYPE)
+
+@router.post("/api/monitor/config")
+async def monitor_config(content: dict):
+   try:
+      if content.get('interval') is not None:
+         crud.save_value('monitor_interval', str(float(content.get('interval'))))
+      result = {'status':1, 'msg': 'success', 'data': {'interval': HostSampler.interval()}}
+   except Exception as e:
+      logger.exception(e)
+      result = {'status':0, 'msg': str(e)}
+   return result
@@ -1,10 +1,12 @@
 from fastapi import Request
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, FileResponse
 from fastapi import APIRouter
 import os
+from loguru import logger
 from webmeter.core.utils import Common
+from webmeter.core.engine import EngineServie
 
 router = APIRouter()
 
@@ -31,4 +33,17 @@ async def result(request: Request, plan: str, task: str):
 @router.get("/config", response_class=HTMLResponse)
 async def result(request: Request):
    platform = Common.pc_platform()
-   return templates.TemplateResponse("config.html", {"request": request, 'platform': platform})
\ No newline at end of file
+   return templates.TemplateResponse("config.html", {"request": request, 'platform': platform})
+
+@router.get("/dashboard/{plan}/{task}/{path:path}")
+async def dashboard(request: Request, plan: str, task: str, path: str):
+   try:
+      dashboard_path = os.path.realpath(await EngineServie.dashboard(plan, task))
+   except Exception as e:
+      # pruned samples, a failing jmeter -g
+      logger.exception(e)
+      return templates.TemplateResponse(request, "error.html", status_code=500)
+   file_path = os.path.realpath(os.path.join(dashboard_path, path or 'index.html'))
+   if not file_path.startswith(dashboard_path + os.sep) or not os.path.isfile(file_path):
+      return HTMLResponse(status_code=404)
+   return FileResponse(file_path)
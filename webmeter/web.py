@@ -1,4 +1,5 @@
 import uvicorn
+from contextlib import asynccontextmanager
 import os
 from fastapi import FastAPI
 import requests
@@ -8,9 +9,29 @@ from fastapi.staticfiles import StaticFiles
 from loguru import logger
 from webmeter.view import page,api
 from webmeter.core.utils import Common
-from webmeter.core.engine import EngineServie
+from webmeter.core.engine import EngineServie, RunScheduler, JmeterWorker
+from webmeter.core.monitor import HostSampler
+from webmeter.core.archive import TaskArchive
+from webmeter.core.metrics import RequestMetrics, ServerMetrics, TimedJSONResponse
 
-app = FastAPI(debug=False)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    api.test_plan.reconcile()
+    EngineServie.recover()
+    RunScheduler.start()
+    HostSampler.start()
+    TaskArchive.start()
+    ServerMetrics.start()
+    yield
+    await ServerMetrics.shutdown()
+    await TaskArchive.shutdown()
+    await RunScheduler.shutdown()
+    await JmeterWorker.shutdown()
+    HostSampler.stop()
+
+app = FastAPI(debug=False, lifespan=lifespan, default_response_class=TimedJSONResponse)
+app.add_middleware(RequestMetrics)
 app.include_router(page.router)
 app.include_router(api.router)
 STATICPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "static")